@@ -1,6 +1,7 @@
 # 🔄 ПОЛНАЯ ЗАМЕНА api.py - добавлены endpoints консультаций
 
 import os
+import json
 import uuid
 import logging
 import base64
@@ -11,7 +12,8 @@ import time
 
 from fastapi import FastAPI, HTTPException, Request, Response
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse, JSONResponse, RedirectResponse
+from fastapi.responses import HTMLResponse, JSONResponse, RedirectResponse, StreamingResponse
+from starlette.background import BackgroundTask
 import uvicorn
 from pydantic import BaseModel
 import asyncio
@@ -22,8 +24,11 @@ except:
     financial_service = None
 
 # Импорты проекта
-from database import MishuraDB
-from gemini_ai import MishuraGeminiAI
+from database import MishuraDB, AsyncMishuraDB, close_all_pools, InvalidCursorError, QUERY_STATS
+from gemini_ai import (MishuraGeminiAI, shutdown_gemini_executor, circuit_breaker, key_pool,
+                       model_router, GeminiUnavailableError)
+from image_processing import warm_up_image_pool, shutdown_image_pool
+from gemini_scheduler import gemini_scheduler, GeminiTicket, SchedulerBusyError, PRIORITY_PAID, PRIORITY_FREE
 from payment_service import PaymentService
 
 # 🌐 НОВЫЕ ИМПОРТЫ ДЛЯ СИСТЕМЫ ОТЗЫВОВ
@@ -40,6 +45,7 @@ logger = logging.getLogger(__name__)
 
 # Глобальные переменные
 db: Optional[MishuraDB] = None
+adb: Optional[AsyncMishuraDB] = None
 gemini_ai: Optional[MishuraGeminiAI] = None
 payment_service: Optional[PaymentService] = None
 financial_service: Optional[Any] = None
@@ -116,14 +122,16 @@ except ImportError as e:
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    global db, gemini_ai, payment_service, financial_service
+    global db, adb, gemini_ai, payment_service, financial_service
     # Startup
     logger.info("🚀 Запуск МИШУРА API Server...")
     try:
         db = MishuraDB()
         logger.info("✅ Database инициализирована")
-        db.init_db()
-        logger.info("✅ Таблицы базы данных проверены/созданы")
+        if not db.init_db():
+            raise RuntimeError("Не удалось применить миграции базы данных")
+        logger.info("✅ Миграции базы данных применены")
+        adb = AsyncMishuraDB(db)
         # 🔐 НОВОЕ: АВТОМАТИЧЕСКАЯ ИНИЦИАЛИЗАЦИЯ ФИНАНСОВОЙ БЕЗОПАСНОСТИ
         try:
             logger.info("🔐 Инициализация финансовой безопасности...")
@@ -148,8 +156,10 @@ async def lifespan(app: FastAPI):
             logger.error(f"❌ Критическая ошибка инициализации финансовой безопасности: {e}")
             financial_service = None
             logger.warning("⚠️ Система запущена БЕЗ финансовой безопасности (fallback режим)")
-        gemini_ai = MishuraGeminiAI()
+        gemini_ai = MishuraGeminiAI(cache_store=adb)
+        gemini_ai.warm_up()
         logger.info("✅ Gemini AI инициализирован")
+        await warm_up_image_pool()
         if YOOKASSA_SHOP_ID and YOOKASSA_SECRET_KEY:
             payment_service = PaymentService(
                 shop_id=YOOKASSA_SHOP_ID,
@@ -165,6 +175,11 @@ async def lifespan(app: FastAPI):
         logger.error(f"❌ Критическая ошибка при запуске: {e}", exc_info=True)
         raise
     yield
+    if adb:
+        adb.shutdown()
+    shutdown_gemini_executor()
+    shutdown_image_pool()
+    close_all_pools()
     logger.info("🛑 Сервер МИШУРА API остановлен.")
 
 # 🔐 НОВАЯ ФУНКЦИЯ: добавить ПОСЛЕ lifespan
@@ -172,40 +187,47 @@ async def _init_balance_locks_for_existing_users(db, financial_service):
     """Асинхронная инициализация balance_locks для существующих пользователей"""
     
     try:
-        conn = db.get_connection()
-        cursor = conn.cursor()
-        
-        # Получаем всех существующих пользователей
-        cursor.execute("SELECT telegram_id FROM users")
-        users = cursor.fetchall()
-        
-        initialized_count = 0
-        
-        for user in users:
-            telegram_id = user[0]
+        # Запросы к БД - в пуле потоков adb, не в event loop
+        def init_locks():
+            conn = db.get_connection()
             try:
-                if db.DB_CONFIG['type'] == 'postgresql':
-                    cursor.execute("""
-                        INSERT INTO balance_locks (telegram_id, version_number, last_updated)
-                        VALUES (%s, 1, CURRENT_TIMESTAMP)
-                        ON CONFLICT (telegram_id) DO NOTHING
-                    """, (telegram_id,))
-                else:
-                    cursor.execute("""
-                        INSERT OR IGNORE INTO balance_locks (telegram_id, version_number)
-                        VALUES (?, 1)
-                    """, (telegram_id,))
+                cursor = conn.cursor()
                 
-                if cursor.rowcount > 0:
-                    initialized_count += 1
-                    
-            except Exception as e:
-                logger.warning(f"⚠️ Не удалось инициализировать balance_lock для {telegram_id}: {e}")
+                # Получаем всех существующих пользователей
+                cursor.execute("SELECT telegram_id FROM users")
+                users = cursor.fetchall()
+                
+                initialized_count = 0
+                
+                for user in users:
+                    telegram_id = user[0]
+                    try:
+                        if db.DB_CONFIG['type'] == 'postgresql':
+                            cursor.execute("""
+                                INSERT INTO balance_locks (telegram_id, version_number, last_updated)
+                                VALUES (%s, 1, CURRENT_TIMESTAMP)
+                                ON CONFLICT (telegram_id) DO NOTHING
+                            """, (telegram_id,))
+                        else:
+                            cursor.execute("""
+                                INSERT OR IGNORE INTO balance_locks (telegram_id, version_number)
+                                VALUES (?, 1)
+                            """, (telegram_id,))
+                        
+                        if cursor.rowcount > 0:
+                            initialized_count += 1
+                            
+                    except Exception as e:
+                        logger.warning(f"⚠️ Не удалось инициализировать balance_lock для {telegram_id}: {e}")
+                
+                conn.commit()
+                return initialized_count, len(users)
+            finally:
+                conn.close()
         
-        conn.commit()
-        conn.close()
+        initialized_count, users_count = await adb.run_sync(init_locks)
         
-        logger.info(f"✅ Balance locks инициализированы для {initialized_count} новых пользователей из {len(users)}")
+        logger.info(f"✅ Balance locks инициализированы для {initialized_count} новых пользователей из {users_count}")
         
     except Exception as e:
         logger.error(f"❌ Ошибка инициализации balance_locks: {e}")
@@ -322,6 +344,7 @@ async def health_check():
                 "gemini_ai": "healthy" if gemini_status else "unhealthy",
                 "payments": "healthy" if payment_service else "disabled"
             },
+            "database_pool": db.get_pool_stats(),
             "version": "2.6.1",
             "environment": ENVIRONMENT
         }
@@ -346,13 +369,13 @@ async def health_check():
 async def get_user_balance(telegram_id: int):
     """Получение баланса пользователя с дополнительной информацией"""
     try:
-        balance = db.get_user_balance(telegram_id)
+        balance = await adb.get_user_balance(telegram_id)
         
         # Дополнительная информация если доступен financial_service
         additional_info = {}
         if financial_service:
             try:
-                recent_transactions = financial_service.get_transaction_history(telegram_id, 5)
+                recent_transactions = await adb.run_sync(financial_service.get_transaction_history, telegram_id, 5)
                 additional_info['recent_transactions_count'] = len(recent_transactions)
                 
                 if recent_transactions:
@@ -378,7 +401,7 @@ async def get_user_balance(telegram_id: int):
 async def sync_user_balance(telegram_id: int):
     """Принудительная синхронизация баланса"""
     try:
-        balance = db.get_user_balance(telegram_id)
+        balance = await adb.get_user_balance(telegram_id)
         return {
             "telegram_id": telegram_id,
             "balance": balance,
@@ -388,6 +411,29 @@ async def sync_user_balance(telegram_id: int):
         logger.error(f"Ошибка синхронизации баланса для {telegram_id}: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/api/v1/users/{telegram_id}/consultations")
+async def get_user_consultations_history(telegram_id: int, limit: int = 20, cursor: Optional[str] = None):
+    """История консультаций пользователя постранично (next_cursor -> следующая страница)"""
+    try:
+        user_id = await adb.get_internal_user_id(telegram_id)
+        if user_id is None:
+            page = {'items': [], 'next_cursor': None}
+        else:
+            page = await adb.get_user_consultations_page(user_id, limit, cursor)
+        
+        return {
+            "telegram_id": telegram_id,
+            "consultations": page['items'],
+            "count": len(page['items']),
+            "next_cursor": page['next_cursor'],
+            "timestamp": datetime.now().isoformat()
+        }
+    except InvalidCursorError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(f"Ошибка получения истории консультаций для {telegram_id}: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
 @app.get("/api/v1/pricing/plans")
 async def get_pricing_plans():
     """Получение тарифных планов"""
@@ -404,6 +450,7 @@ async def analyze_consultation(request: Request):
     
     correlation_id = str(uuid.uuid4())
     start_time = time.time()
+    ticket = None
     
     try:
         data = await request.json()
@@ -417,9 +464,12 @@ async def analyze_consultation(request: Request):
         if not image_data or not user_id:
             raise HTTPException(status_code=400, detail="Отсутствуют обязательные данные")
         
+        # 🚦 Место в очереди Gemini - до списания (при перегрузке сразу 429)
+        ticket = await _reserve_gemini_slot(user_id)
+        
         # 🔐 БЕЗОПАСНОЕ СПИСАНИЕ через financial_service
         if financial_service:
-            operation_result = financial_service.safe_balance_operation(
+            operation_result = await adb.run_sync(financial_service.safe_balance_operation,
                 telegram_id=user_id,
                 amount_change=-10,
                 operation_type="consultation_analysis",
@@ -444,7 +494,7 @@ async def analyze_consultation(request: Request):
                     raise HTTPException(status_code=500, detail="Ошибка обработки платежа")
         else:
             # Fallback на старую систему
-            current_balance = db.get_user_balance(user_id)
+            current_balance = await adb.get_user_balance(user_id)
             if current_balance < 10:
                 raise HTTPException(status_code=400, detail="Недостаточно STcoins для консультации")
         
@@ -454,7 +504,7 @@ async def analyze_consultation(request: Request):
         except Exception as e:
             # 🚨 КОМПЕНСАЦИЯ: возвращаем средства если изображение некорректно
             if financial_service:
-                financial_service.safe_balance_operation(
+                await adb.run_sync(financial_service.safe_balance_operation,
                     telegram_id=user_id,
                     amount_change=10,
                     operation_type="consultation_refund",
@@ -464,19 +514,22 @@ async def analyze_consultation(request: Request):
             raise HTTPException(status_code=400, detail="Некорректные данные изображения")
         
         # 🤖 АНАЛИЗ ЧЕРЕЗ GEMINI AI (с timeout и retry)
+        usage = {}
         try:
             analysis = await asyncio.wait_for(
-                gemini_ai.analyze_clothing_image(
+                ticket.run(lambda: gemini_ai.analyze_clothing_image(
                     image_data=image_bytes,
                     occasion=occasion,
-                    preferences=preferences
-                ),
-                timeout=60.0  # 60 секунд timeout
+                    preferences=preferences,
+                    user_id=user_id,
+                    usage=usage
+                )),
+                timeout=60.0  # 60 секунд timeout (включая ожидание в очереди)
             )
         except asyncio.TimeoutError:
             # 🚨 КОМПЕНСАЦИЯ: возвращаем средства при timeout
             if financial_service:
-                financial_service.safe_balance_operation(
+                await adb.run_sync(financial_service.safe_balance_operation,
                     telegram_id=user_id,
                     amount_change=10,
                     operation_type="consultation_refund",
@@ -488,7 +541,7 @@ async def analyze_consultation(request: Request):
         except Exception as e:
             # 🚨 КОМПЕНСАЦИЯ: возвращаем средства при ошибке Gemini
             if financial_service:
-                financial_service.safe_balance_operation(
+                await adb.run_sync(financial_service.safe_balance_operation,
                     telegram_id=user_id,
                     amount_change=10,
                     operation_type="consultation_refund",
@@ -500,13 +553,13 @@ async def analyze_consultation(request: Request):
         
         # Списываем средства ТОЛЬКО если анализ успешен (в случае fallback)
         if not financial_service:
-            new_balance = db.update_user_balance(user_id, -10, "consultation")
+            new_balance = await adb.update_user_balance(user_id, -10, "consultation")
         else:
             new_balance = operation_result['new_balance']
         
         # 📝 СОХРАНЯЕМ КОНСУЛЬТАЦИЮ
         try:
-            consultation_id = db.save_consultation(
+            consultation_id = await adb.save_consultation(
                 user_id=user_id,
                 occasion=occasion,
                 preferences=preferences,
@@ -516,6 +569,7 @@ async def analyze_consultation(request: Request):
         except Exception as e:
             logger.warning(f"[{correlation_id}] Failed to save consultation: {e}")
             consultation_id = None
+        await _save_usage(consultation_id, user_id, "analyze", usage, correlation_id)
         
         processing_time = time.time() - start_time
         
@@ -536,6 +590,9 @@ async def analyze_consultation(request: Request):
     except Exception as e:
         logger.error(f"❌ [{correlation_id}] Критическая ошибка анализа: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail="Внутренняя ошибка сервера")
+    finally:
+        if ticket:
+            ticket.release()
 
 @app.post("/api/v1/consultations/compare")
 async def compare_consultation(request: Request):
@@ -543,6 +600,7 @@ async def compare_consultation(request: Request):
     
     correlation_id = str(uuid.uuid4())
     start_time = time.time()
+    ticket = None
     
     try:
         data = await request.json()
@@ -562,9 +620,12 @@ async def compare_consultation(request: Request):
         if len(images_data) > 4:
             raise HTTPException(status_code=400, detail="Максимум 4 изображения для сравнения")
         
+        # 🚦 Место в очереди Gemini - до списания (при перегрузке сразу 429)
+        ticket = await _reserve_gemini_slot(user_id)
+        
         # 🔐 БЕЗОПАСНОЕ СПИСАНИЕ (15 STcoins за сравнение)
         if financial_service:
-            operation_result = financial_service.safe_balance_operation(
+            operation_result = await adb.run_sync(financial_service.safe_balance_operation,
                 telegram_id=user_id,
                 amount_change=-15,
                 operation_type="consultation_compare",
@@ -590,7 +651,7 @@ async def compare_consultation(request: Request):
                     raise HTTPException(status_code=500, detail="Ошибка обработки платежа")
         else:
             # Fallback на старую систему
-            current_balance = db.get_user_balance(user_id)
+            current_balance = await adb.get_user_balance(user_id)
             if current_balance < 15:
                 raise HTTPException(status_code=400, detail="Недостаточно STcoins для сравнения")
         
@@ -603,7 +664,7 @@ async def compare_consultation(request: Request):
         except Exception as e:
             # 🚨 КОМПЕНСАЦИЯ: возвращаем средства если изображения некорректны
             if financial_service:
-                financial_service.safe_balance_operation(
+                await adb.run_sync(financial_service.safe_balance_operation,
                     telegram_id=user_id,
                     amount_change=15,
                     operation_type="consultation_refund",
@@ -613,19 +674,21 @@ async def compare_consultation(request: Request):
             raise HTTPException(status_code=400, detail=f"Некорректные данные изображения #{i+1}")
         
         # 🤖 СРАВНЕНИЕ ЧЕРЕЗ GEMINI AI (с timeout)
+        usage = {}
         try:
             comparison = await asyncio.wait_for(
-                gemini_ai.compare_clothing_images(
+                ticket.run(lambda: gemini_ai.compare_clothing_images(
                     image_data_list=decoded_images,
                     occasion=occasion,
-                    preferences=preferences
-                ),
-                timeout=90.0  # 90 секунд для сравнения
+                    preferences=preferences,
+                    usage=usage
+                )),
+                timeout=90.0  # 90 секунд для сравнения (включая ожидание в очереди)
             )
         except asyncio.TimeoutError:
             # 🚨 КОМПЕНСАЦИЯ: возвращаем средства при timeout
             if financial_service:
-                financial_service.safe_balance_operation(
+                await adb.run_sync(financial_service.safe_balance_operation,
                     telegram_id=user_id,
                     amount_change=15,
                     operation_type="consultation_refund",
@@ -637,7 +700,7 @@ async def compare_consultation(request: Request):
         except Exception as e:
             # 🚨 КОМПЕНСАЦИЯ: возвращаем средства при ошибке Gemini
             if financial_service:
-                financial_service.safe_balance_operation(
+                await adb.run_sync(financial_service.safe_balance_operation,
                     telegram_id=user_id,
                     amount_change=15,
                     operation_type="consultation_refund",
@@ -649,13 +712,13 @@ async def compare_consultation(request: Request):
         
         # Списываем средства ТОЛЬКО если сравнение успешно (в случае fallback)
         if not financial_service:
-            new_balance = db.update_user_balance(user_id, -15, "comparison")
+            new_balance = await adb.update_user_balance(user_id, -15, "comparison")
         else:
             new_balance = operation_result['new_balance']
         
         # 📝 СОХРАНЯЕМ КОНСУЛЬТАЦИЮ
         try:
-            consultation_id = db.save_consultation(
+            consultation_id = await adb.save_consultation(
                 user_id=user_id,
                 occasion=occasion,
                 preferences=preferences,
@@ -665,6 +728,7 @@ async def compare_consultation(request: Request):
         except Exception as e:
             logger.warning(f"[{correlation_id}] Failed to save consultation: {e}")
             consultation_id = None
+        await _save_usage(consultation_id, user_id, "compare", usage, correlation_id)
         
         processing_time = time.time() - start_time
         
@@ -685,6 +749,311 @@ async def compare_consultation(request: Request):
     except Exception as e:
         logger.error(f"❌ [{correlation_id}] Критическая ошибка сравнения: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail="Внутренняя ошибка сервера")
+    finally:
+        if ticket:
+            ticket.release()
+
+# === ПОТОКОВЫЕ КОНСУЛЬТАЦИИ (SSE) ===
+
+async def _reserve_gemini_slot(user_id: int) -> GeminiTicket:
+    """
+    🚦 Занять место в планировщике Gemini. Пользователи с оплатой - в приоритете.
+    Если очередь заполнена - сразу 429 с Retry-After, если Gemini недоступен
+    (разомкнут circuit breaker) - сразу 503. Средства в обоих случаях не списываются.
+    В half_open допускается один пробный запрос, допуск снимается с освобождением места.
+    """
+    try:
+        admission = circuit_breaker.admit()
+    except GeminiUnavailableError as e:
+        logger.warning(f"🔌 Запрос user_id={user_id} отклонен: circuit breaker Gemini разомкнут")
+        raise HTTPException(
+            status_code=503,
+            detail=f"Сервис анализа временно недоступен. Повторите через {e.retry_after} с",
+            headers={"Retry-After": str(e.retry_after)}
+        )
+    try:
+        priority = PRIORITY_PAID if await adb.is_paying_user(user_id) else PRIORITY_FREE
+        ticket = gemini_scheduler.reserve(user_id, priority)
+    except SchedulerBusyError as e:
+        circuit_breaker.release_admission(admission)
+        logger.warning(f"🚦 Запрос user_id={user_id} отклонен планировщиком: {e}")
+        raise HTTPException(
+            status_code=429,
+            detail=f"{e}. Повторите через {e.retry_after} с",
+            headers={"Retry-After": str(e.retry_after)}
+        )
+    except BaseException:
+        circuit_breaker.release_admission(admission)
+        raise
+    if admission:
+        ticket.add_release_callback(lambda: circuit_breaker.release_admission(admission))
+    return ticket
+
+# Ссылки на фоновые задачи (возвраты средств), чтобы их не собрал GC
+_background_tasks: set = set()
+
+def _sse_event(event: str, data: dict) -> str:
+    """Событие Server-Sent Events"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+async def _debit_consultation(user_id: int, cost: int, operation_type: str, correlation_id: str,
+                              metadata: dict) -> Optional[int]:
+    """
+    🔐 Списание за консультацию до начала генерации.
+    Возвращает новый баланс (None - fallback режим: списание после успеха).
+    """
+    if financial_service:
+        operation_result = await adb.run_sync(financial_service.safe_balance_operation,
+            telegram_id=user_id,
+            amount_change=-cost,
+            operation_type=operation_type,
+            correlation_id=correlation_id,
+            metadata=metadata
+        )
+        if not operation_result['success']:
+            if operation_result.get('error') == 'insufficient_balance':
+                raise HTTPException(
+                    status_code=400,
+                    detail=f"Недостаточно STcoins. Требуется: {operation_result.get('required', cost)}, доступно: {operation_result.get('available', 0)}"
+                )
+            logger.error(f"[{correlation_id}] Financial operation failed: {operation_result}")
+            raise HTTPException(status_code=500, detail="Ошибка обработки платежа")
+        return operation_result['new_balance']
+
+    # Fallback на старую систему
+    current_balance = await adb.get_user_balance(user_id)
+    if current_balance < cost:
+        raise HTTPException(status_code=400, detail="Недостаточно STcoins для консультации")
+    return None
+
+async def _refund_consultation(user_id: int, cost: int, correlation_id: str, metadata: dict):
+    """🚨 КОМПЕНСАЦИЯ: возврат средств, если консультация не состоялась"""
+    if financial_service:
+        await adb.run_sync(financial_service.safe_balance_operation,
+            telegram_id=user_id,
+            amount_change=cost,
+            operation_type="consultation_refund",
+            correlation_id=correlation_id,
+            metadata=metadata
+        )
+
+async def _save_usage(consultation_id: Optional[int], user_id: int, endpoint: str,
+                      usage: dict, correlation_id: str):
+    """📊 Сохранить учет токенов, задержки и стоимости Gemini рядом с консультацией"""
+    if not usage:
+        return
+    logger.info(f"📊 [{correlation_id}] {endpoint}: source={usage.get('source')}, model={usage.get('model')}, "
+                f"tokens={usage.get('prompt_tokens')}+{usage.get('output_tokens')}, "
+                f"gemini={usage.get('gemini_latency_ms')}ms, cost=${usage.get('cost_usd', 0):.6f}, "
+                f"abandoned={usage.get('abandoned_calls', 0)}")
+    await adb.save_consultation_usage(consultation_id, user_id, endpoint, usage)
+
+def _stream_consultation(chunks, ticket: GeminiTicket, user_id: int, occasion: str, preferences: str,
+                         cost: int, new_balance: Optional[int], fallback_operation: str, timeout: float,
+                         correlation_id: str, start_time: float, usage: dict, endpoint: str) -> StreamingResponse:
+    """
+    SSE-ответ консультации: события start, chunk (фрагменты текста), затем done
+    (консультация сохранена) или error (средства возвращены).
+    Слот планировщика удерживается до конца генерации; usage заполняется
+    генератором chunks и сохраняется вместе с консультацией.
+    Если клиент ушел раньше первого шага генератора, его finally не выполнится -
+    слот и средства тогда освобождает фоновая задача ответа (cleanup).
+    """
+    state = {"completed": False, "refunded": False}
+
+    def refund_disconnected():
+        """Возврат при отключении клиента - отдельной задачей, ее не отменит отмена запроса"""
+        if state["completed"] or state["refunded"]:
+            return None
+        state["refunded"] = True
+        logger.warning(f"⚠️ [{correlation_id}] Клиент отключился до конца консультации")
+        task = asyncio.ensure_future(_refund_consultation(
+            user_id, cost, correlation_id, {"reason": "client_disconnected"}
+        ))
+        _background_tasks.add(task)
+        task.add_done_callback(_background_tasks.discard)
+        return task
+
+    async def cleanup():
+        ticket.release()
+        task = refund_disconnected()
+        if task is not None:
+            await chunks.aclose()
+
+    async def event_stream():
+        yield _sse_event("start", {"correlation_id": correlation_id, "cost": cost})
+
+        parts = []
+        first_chunk_time = None
+        deadline = time.monotonic() + timeout
+        try:
+            await asyncio.wait_for(ticket.acquire(), timeout=timeout)
+            async for text in chunks:
+                if first_chunk_time is None:
+                    first_chunk_time = time.time() - start_time
+                    logger.info(f"⚡ [{correlation_id}] Первый фрагмент через {first_chunk_time:.2f}s")
+                parts.append(text)
+                yield _sse_event("chunk", {"text": text})
+                if time.monotonic() > deadline:
+                    raise asyncio.TimeoutError()
+            state["completed"] = True
+        except asyncio.TimeoutError:
+            state["refunded"] = True
+            await _refund_consultation(user_id, cost, correlation_id, {"reason": "gemini_timeout"})
+            yield _sse_event("error", {"detail": "Консультация заняла слишком много времени",
+                                       "correlation_id": correlation_id})
+            return
+        except Exception as e:
+            state["refunded"] = True
+            await _refund_consultation(user_id, cost, correlation_id, {"reason": "gemini_error", "error": str(e)})
+            logger.error(f"[{correlation_id}] Gemini streaming failed: {e}")
+            yield _sse_event("error", {"detail": "Сервис анализа временно недоступен",
+                                       "correlation_id": correlation_id})
+            return
+        finally:
+            ticket.release()
+            # Возврат планируется до aclose(): при отключении клиента это
+            # ожидание само может быть отменено
+            refund_disconnected()
+            await chunks.aclose()
+
+        advice = "".join(parts)
+        balance = new_balance
+        # Списываем средства ТОЛЬКО если консультация успешна (в случае fallback)
+        if balance is None:
+            balance = await adb.update_user_balance(user_id, -cost, fallback_operation)
+
+        # 📝 СОХРАНЯЕМ КОНСУЛЬТАЦИЮ
+        try:
+            consultation_id = await adb.save_consultation(
+                user_id=user_id,
+                occasion=occasion,
+                preferences=preferences,
+                image_path=None,
+                advice=advice
+            )
+        except Exception as e:
+            logger.warning(f"[{correlation_id}] Failed to save consultation: {e}")
+            consultation_id = None
+        await _save_usage(consultation_id, user_id, endpoint, usage, correlation_id)
+
+        processing_time = time.time() - start_time
+        logger.info(f"✅ [{correlation_id}] Потоковая консультация завершена: user_id={user_id}, "
+                    f"first_chunk={first_chunk_time or 0:.2f}s, time={processing_time:.2f}s, balance={balance}")
+        yield _sse_event("done", {
+            "consultation_id": consultation_id,
+            "balance": balance,
+            "cost": cost,
+            "correlation_id": correlation_id,
+            "time_to_first_chunk": round(first_chunk_time or 0, 2),
+            "processing_time": round(processing_time, 2),
+            "status": "success"
+        })
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        background=BackgroundTask(cleanup)
+    )
+
+@app.post("/api/v1/consultations/analyze/stream")
+async def analyze_consultation_stream(request: Request):
+    """🔐 Анализ с потоковой выдачей совета (SSE)"""
+
+    correlation_id = str(uuid.uuid4())
+    start_time = time.time()
+
+    data = await request.json()
+    user_id = data.get('user_id')
+    occasion = data.get('occasion', 'повседневный')
+    preferences = data.get('preferences', '')
+    image_data = data.get('image_data')
+
+    logger.info(f"🎨 [{correlation_id}] Потоковый запрос анализа от user_id: {user_id}")
+
+    if not image_data or not user_id:
+        raise HTTPException(status_code=400, detail="Отсутствуют обязательные данные")
+
+    try:
+        image_bytes = base64.b64decode(image_data)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Некорректные данные изображения")
+
+    ticket = await _reserve_gemini_slot(user_id)
+    try:
+        new_balance = await _debit_consultation(user_id, 10, "consultation_analysis", correlation_id, {
+            "occasion": occasion,
+            "service": "single_analysis",
+            "endpoint": "/consultations/analyze/stream"
+        })
+    except BaseException:
+        ticket.release()
+        raise
+
+    usage = {}
+    chunks = gemini_ai.stream_clothing_analysis(
+        image_data=image_bytes,
+        occasion=occasion,
+        preferences=preferences,
+        user_id=user_id,
+        usage=usage
+    )
+    return _stream_consultation(chunks, ticket, user_id, occasion, preferences, 10, new_balance,
+                                "consultation", 60.0, correlation_id, start_time, usage, "analyze_stream")
+
+@app.post("/api/v1/consultations/compare/stream")
+async def compare_consultation_stream(request: Request):
+    """🔐 Сравнение с потоковой выдачей совета (SSE)"""
+
+    correlation_id = str(uuid.uuid4())
+    start_time = time.time()
+
+    data = await request.json()
+    user_id = data.get('user_id')
+    occasion = data.get('occasion', 'повседневный')
+    preferences = data.get('preferences', '')
+    images_data = data.get('images_data', [])
+
+    logger.info(f"⚖️ [{correlation_id}] Потоковый запрос сравнения от user_id: {user_id}, изображений: {len(images_data)}")
+
+    if not user_id:
+        raise HTTPException(status_code=400, detail="Отсутствует user_id")
+
+    if len(images_data) < 2:
+        raise HTTPException(status_code=400, detail="Нужно минимум 2 изображения для сравнения")
+
+    if len(images_data) > 4:
+        raise HTTPException(status_code=400, detail="Максимум 4 изображения для сравнения")
+
+    decoded_images = []
+    for i, img_data in enumerate(images_data):
+        try:
+            decoded_images.append(base64.b64decode(img_data))
+        except Exception:
+            raise HTTPException(status_code=400, detail=f"Некорректные данные изображения #{i+1}")
+
+    ticket = await _reserve_gemini_slot(user_id)
+    try:
+        new_balance = await _debit_consultation(user_id, 15, "consultation_compare", correlation_id, {
+            "occasion": occasion,
+            "service": "comparison",
+            "images_count": len(images_data),
+            "endpoint": "/consultations/compare/stream"
+        })
+    except BaseException:
+        ticket.release()
+        raise
+
+    usage = {}
+    chunks = gemini_ai.stream_clothing_comparison(
+        image_data_list=decoded_images,
+        occasion=occasion,
+        preferences=preferences,
+        usage=usage
+    )
+    return _stream_consultation(chunks, ticket, user_id, occasion, preferences, 15, new_balance,
+                                "comparison", 90.0, correlation_id, start_time, usage, "compare_stream")
 
 # === ПЛАТЕЖИ ENDPOINTS ===
 
@@ -711,33 +1080,14 @@ async def create_payment_endpoint(request: PaymentRequest):
         
         plan = PRICING_PLANS[request.plan_id]
         
-        # Проверка/создание пользователя
-        user = db.get_user_by_telegram_id(request.telegram_id)
-        logger.info(f"🔍 Проверка пользователя: {user}")
-        
-        if not user:
-            # Создаем нового пользователя
-            user_id = db.save_user(
-                telegram_id=request.telegram_id,
-                username="webapp_user",
-                first_name="WebApp",
-                last_name="User"
-            )
-            logger.info(f"✅ Создан новый пользователь: user_id={user_id}, telegram_id={request.telegram_id}")
-            
-            # 🚨 Устанавливаем начальный баланс 0 для нового пользователя
-            db.update_user_balance(request.telegram_id, 0, "initialization")
-            
-            # Получаем созданного пользователя
-            user = db.get_user_by_telegram_id(request.telegram_id)
-        
-        logger.info(f"🔍 Верификация пользователя: {user}")
-        
-        if not user:
-            logger.error(f"❌ Не удалось создать/найти пользователя для telegram_id: {request.telegram_id}")
+        # Проверка/создание пользователя одним запросом (существующий профиль не меняется)
+        try:
+            user_id, _ = await adb.upsert_user(request.telegram_id)
+        except Exception as e:
+            logger.error(f"❌ Не удалось создать/найти пользователя для telegram_id: {request.telegram_id}: {e}")
             raise HTTPException(status_code=500, detail="Ошибка создания пользователя")
         
-        user_id = user['id']
+        logger.info(f"🔍 Пользователь: user_id={user_id}, telegram_id={request.telegram_id}")
         
         # Генерируем уникальный ID платежа
         payment_id = str(uuid.uuid4())
@@ -745,7 +1095,7 @@ async def create_payment_endpoint(request: PaymentRequest):
         logger.info(f"💎 Тарифный план: {plan}")
         
         # 🚨 КРИТИЧЕСКИ ВАЖНО: Правильный return_url для секции баланса
-        payment_result = payment_service.create_payment(
+        payment_result = await adb.run_sync(payment_service.create_payment,
             payment_id=payment_id,
             amount=plan['price'],
             description=f"МИШУРА - {plan['name']} ({plan['stcoins']} STCoins)",
@@ -813,7 +1163,7 @@ async def payment_webhook_endpoint(request: Request):
             logger.info(f"💰 Обработка успешного платежа: {yookassa_payment_id}")
             
             # 🚨 КРИТИЧЕСКИ ВАЖНО: Обрабатываем платеж
-            success = payment_service.process_successful_payment(yookassa_payment_id)
+            success = await adb.run_sync(payment_service.process_successful_payment, yookassa_payment_id)
             
             if success:
                 logger.info(f"✅ Платеж {yookassa_payment_id} успешно обработан")
@@ -842,7 +1192,7 @@ async def get_payment_status(payment_id: str, telegram_id: int):
         raise HTTPException(status_code=503, detail="Платежи недоступны")
     
     try:
-        payment_info = payment_service.get_payment_status(payment_id, telegram_id)
+        payment_info = await adb.run_sync(payment_service.get_payment_status, payment_id, telegram_id)
         
         if not payment_info:
             raise HTTPException(status_code=404, detail="Платеж не найден")
@@ -876,7 +1226,7 @@ async def financial_health_check():
             })
         else:
             try:
-                stats = financial_service.get_financial_stats()
+                stats = await adb.run_sync(financial_service.get_financial_stats)
                 health['metrics'] = stats
                 
                 # Алерты на основе метрик
@@ -910,7 +1260,7 @@ async def get_user_transactions(telegram_id: int, limit: int = 20):
         if not financial_service:
             raise HTTPException(status_code=503, detail="Financial service unavailable")
         
-        transactions = financial_service.get_transaction_history(telegram_id, limit)
+        transactions = await adb.run_sync(financial_service.get_transaction_history, telegram_id, limit)
         
         return {
             "telegram_id": telegram_id,
@@ -934,31 +1284,34 @@ async def recover_failed_payments():
         logger.info("🔧 Запуск восстановления неудачных платежей...")
         
         # 🔧 ИСПРАВЛЕНО: Используем правильный API database.py
-        conn = db.get_connection()
-        cursor = conn.cursor()
-        
-        # Получаем платежи со статусом pending за последние 24 часа
-        if db.DB_CONFIG['type'] == 'postgresql':
-            recovery_query = """
-                SELECT yookassa_payment_id, telegram_id, stcoins_amount, created_at
-                FROM payments 
-                WHERE status = 'pending' 
-                AND created_at >= NOW() - INTERVAL '24 hours'
-                ORDER BY created_at DESC
-            """
-            cursor.execute(recovery_query)
-        else:
-            recovery_query = """
-                SELECT yookassa_payment_id, telegram_id, stcoins_amount, created_at
-                FROM payments 
-                WHERE status = 'pending' 
-                AND datetime(created_at) >= datetime('now', '-24 hours')
-                ORDER BY created_at DESC
-            """
-            cursor.execute(recovery_query)
-        
-        pending_payments = cursor.fetchall()
-        conn.close()
+        def fetch_pending_payments():
+            conn = db.get_connection()
+            try:
+                cursor = conn.cursor()
+                
+                # Получаем платежи со статусом pending за последние 24 часа
+                if db.DB_CONFIG['type'] == 'postgresql':
+                    recovery_query = """
+                        SELECT yookassa_payment_id, telegram_id, stcoins_amount, created_at
+                        FROM payments 
+                        WHERE status = 'pending' 
+                        AND created_at >= NOW() - INTERVAL '24 hours'
+                        ORDER BY created_at DESC
+                    """
+                else:
+                    recovery_query = """
+                        SELECT yookassa_payment_id, telegram_id, stcoins_amount, created_at
+                        FROM payments 
+                        WHERE status = 'pending' 
+                        AND datetime(created_at) >= datetime('now', '-24 hours')
+                        ORDER BY created_at DESC
+                    """
+                cursor.execute(recovery_query)
+                return cursor.fetchall()
+            finally:
+                conn.close()
+        
+        pending_payments = await adb.run_sync(fetch_pending_payments)
         
         recovered_count = 0
         recovery_details = []
@@ -972,13 +1325,13 @@ async def recover_failed_payments():
             try:
                 # Проверяем статус в ЮKassa
                 from yookassa import Payment
-                yookassa_payment = Payment.find_one(yookassa_payment_id)
+                yookassa_payment = await adb.run_sync(Payment.find_one, yookassa_payment_id)
                 
                 if yookassa_payment and yookassa_payment.status == 'succeeded':
                     logger.info(f"🔧 Восстанавливаем платеж: {yookassa_payment_id} для user {telegram_id}")
                     
                     # Обрабатываем платеж
-                    success = payment_service.process_successful_payment(yookassa_payment_id)
+                    success = await adb.run_sync(payment_service.process_successful_payment, yookassa_payment_id)
                     
                     if success:
                         recovered_count += 1
@@ -1072,7 +1425,7 @@ async def submit_feedback(request: Request):
             raise HTTPException(status_code=400, detail="Обнаружен спам в тексте отзыва")
         
         # Сохраняем отзыв в БД
-        feedback_id = db.save_feedback_submission(
+        feedback_id = await adb.save_feedback_submission(
             telegram_id=telegram_id,
             feedback_text=feedback_text,
             feedback_rating=feedback_rating,
@@ -1086,7 +1439,7 @@ async def submit_feedback(request: Request):
         
         # 🔔 НОВОЕ: ОТПРАВЛЯЕМ УВЕДОМЛЕНИЕ АДМИНУ
         try:
-            user_data = db.get_user(telegram_id)
+            user_data = await adb.get_user(telegram_id)
             feedback_notification_data = {
                 'id': feedback_id,
                 'telegram_id': telegram_id,
@@ -1108,7 +1461,7 @@ async def submit_feedback(request: Request):
         
         if len(feedback_text) >= 150:
             if financial_service:
-                bonus_result = financial_service.safe_balance_operation(
+                bonus_result = await adb.run_sync(financial_service.safe_balance_operation,
                     telegram_id=telegram_id,
                     amount_change=10,  # +1 консультация = 10 STcoins
                     operation_type="feedback_bonus",
@@ -1126,7 +1479,7 @@ async def submit_feedback(request: Request):
                     new_balance = bonus_result['new_balance']
                     
                     # Отмечаем что бонус начислен
-                    db.mark_feedback_bonus_awarded(feedback_id)
+                    await adb.mark_feedback_bonus_awarded(feedback_id)
                     
                     logger.info(f"💰 [{correlation_id}] Бонус начислен: user_id={telegram_id}, new_balance={new_balance}")
                 else:
@@ -1134,15 +1487,15 @@ async def submit_feedback(request: Request):
             else:
                 # Fallback на старую систему
                 try:
-                    new_balance = db.update_user_balance(telegram_id, 10, "feedback_bonus")
+                    new_balance = await adb.update_user_balance(telegram_id, 10, "feedback_bonus")
                     bonus_awarded = True
-                    db.mark_feedback_bonus_awarded(feedback_id)
+                    await adb.mark_feedback_bonus_awarded(feedback_id)
                     logger.info(f"💰 [{correlation_id}] Бонус начислен (fallback): user_id={telegram_id}, new_balance={new_balance}")
                 except Exception as e:
                     logger.error(f"❌ [{correlation_id}] Ошибка начисления бонуса (fallback): {e}")
         
         # Логируем успешное завершение
-        db.log_feedback_prompt(telegram_id, consultation_id or 0, 'completed')
+        await adb.log_feedback_prompt(telegram_id, consultation_id or 0, 'completed')
         
         processing_time = time.time() - start_time
         
@@ -1170,7 +1523,7 @@ async def submit_feedback(request: Request):
 async def can_show_feedback_prompt(telegram_id: int):
     """Проверка возможности показа формы отзыва"""
     try:
-        can_show = db.can_show_feedback_prompt(telegram_id)
+        can_show = await adb.can_show_feedback_prompt(telegram_id)
         
         return {
             "telegram_id": telegram_id,
@@ -1196,7 +1549,7 @@ async def log_feedback_prompt_action(request: Request):
         if not telegram_id:
             raise HTTPException(status_code=400, detail="Отсутствует telegram_id")
         
-        success = db.log_feedback_prompt(
+        success = await adb.log_feedback_prompt(
             telegram_id=telegram_id,
             consultation_id=consultation_id,
             action=action,
@@ -1223,7 +1576,7 @@ async def log_feedback_prompt_action(request: Request):
 async def get_feedback_stats():
     """📊 Статистика системы отзывов"""
     try:
-        stats = db.get_feedback_stats()
+        stats = await adb.get_feedback_stats()
         
         return {
             "stats": stats,
@@ -1257,6 +1610,52 @@ async def test_notifications():
         logger.error(f"Ошибка тестирования уведомлений: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/api/v1/admin/db/stats")
+async def get_db_query_stats(top: int = 50):
+    """⏱️ Статистика запросов к БД: время, гистограммы, медленные запросы, соединения"""
+    try:
+        stats = await adb.run_sync(db.get_query_stats)
+        stats['queries'] = stats['queries'][:max(1, top)]
+        return {
+            "stats": stats,
+            "timestamp": datetime.now().isoformat()
+        }
+    except Exception as e:
+        logger.error(f"Ошибка получения статистики запросов: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/api/v1/admin/db/stats/reset")
+async def reset_db_query_stats():
+    """Сбросить накопленную статистику запросов"""
+    QUERY_STATS.reset()
+    return {"status": "reset", "timestamp": datetime.now().isoformat()}
+
+@app.get("/api/v1/admin/gemini/scheduler")
+async def get_gemini_scheduler_stats():
+    """🚦 Метрики планировщика Gemini: занятые слоты, глубина очереди, время ожидания"""
+    return {
+        "stats": gemini_scheduler.get_stats(),
+        "circuit_breaker": circuit_breaker.get_stats(),
+        "api_keys": key_pool.get_stats(),
+        "timestamp": datetime.now().isoformat()
+    }
+
+@app.get("/api/v1/admin/gemini/usage")
+async def get_gemini_usage(days: int = 7, telegram_id: Optional[int] = None, limit: int = 500):
+    """📊 Токены, стоимость и задержки Gemini по дням, пользователям и endpoint'ам"""
+    rows = await adb.get_usage_rollup(days=days, telegram_id=telegram_id, limit=limit)
+    totals = await adb.get_usage_totals(days=days, telegram_id=telegram_id)
+    # Токены брошенных вызовов известны только в памяти процесса (с момента запуска)
+    abandoned = {key: model_router.stats[key]
+                 for key in ("abandoned_calls", "abandoned_tokens", "abandoned_cost_usd")}
+    return {
+        "days": days,
+        "totals": totals,
+        "abandoned_since_start": abandoned,
+        "rows": rows,
+        "timestamp": datetime.now().isoformat()
+    }
+
 # === ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ===
 
 def is_spam_text(text: str) -> bool:
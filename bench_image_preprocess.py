@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+# bench_image_preprocess.py - Сравнение путей подготовки изображений МИШУРА
+
+"""
+⏱️ БЕНЧМАРК ПОДГОТОВКИ ИЗОБРАЖЕНИЙ
+Сравнивает прежний путь (полное декодирование, LANCZOS до 1024px, всегда
+перекодирование с optimize=True) с текущим preprocess_image_bytes
+(JPEG draft/reduce, пропуск перекодирования для маленьких JPEG).
+
+Каждый путь выполняется в отдельном дочернем процессе: замеряются время на
+фото и пиковая память процесса (VmHWM/ru_maxrss) относительно пустого процесса
+с теми же импортами.
+
+Запуск: python bench_image_preprocess.py [каталог_с_фото] [повторов]
+Без каталога генерируется синтетический набор "телефонных" фото 4000x3000.
+"""
+
+import os
+import sys
+import glob
+import random
+import time
+import shutil
+import logging
+import resource
+import tempfile
+import multiprocessing
+from io import BytesIO
+
+from PIL import Image
+
+from image_processing import preprocess_image_bytes
+
+PHOTO_EXTENSIONS = ('*.jpg', '*.jpeg', '*.JPG', '*.JPEG', '*.png', '*.PNG', '*.webp')
+
+
+def legacy_preprocess(image_data: bytes, max_size: int = 1024, quality: int = 85) -> bytes:
+    """Прежний путь optimize_image - для сравнения"""
+    img = Image.open(BytesIO(image_data))
+    width, height = img.size
+    if width > max_size or height > max_size:
+        if width > height:
+            new_size = (max_size, int(height * (max_size / width)))
+        else:
+            new_size = (int(width * (max_size / height)), max_size)
+        img = img.resize(new_size, Image.Resampling.LANCZOS)
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    out = BytesIO()
+    img.save(out, format='JPEG', quality=quality, optimize=True)
+    return out.getvalue()
+
+
+def current_preprocess(image_data: bytes) -> bytes:
+    return preprocess_image_bytes(image_data)[0]
+
+
+PATHS = {
+    'baseline': None,
+    'legacy': legacy_preprocess,
+    'fast': current_preprocess,
+}
+
+
+def make_synthetic_corpus(workdir: str, count: int = 8) -> list:
+    """Сгенерировать JPEG 12 Мп с градиентом и шумом, похожие на фото с телефона"""
+    files = []
+    for i in range(count):
+        base = Image.linear_gradient('L').resize((4000, 3000))
+        noise = Image.effect_noise((4000, 3000), 40 + i * 5)
+        img = Image.merge('RGB', (base, noise, base.rotate(90 * (i % 4)).resize((4000, 3000))))
+        path = os.path.join(workdir, f"photo_{i}.jpg")
+        img.save(path, format='JPEG', quality=random.choice((88, 92, 95)))
+        files.append(path)
+    # Уже подготовленные фото (как после пересылки из мессенджера)
+    for i in range(count // 2):
+        img = Image.open(files[i])
+        img.draft('RGB', (1000, 750))
+        path = os.path.join(workdir, f"small_{i}.jpg")
+        img.convert('RGB').resize((1000, 750)).save(path, format='JPEG', quality=80)
+        files.append(path)
+    return files
+
+
+def peak_rss_kb() -> int:
+    """
+    Пиковая память процесса в КБ. В Linux берется VmHWM: ru_maxrss
+    наследуется через exec от родителя, который генерировал набор фото.
+    """
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def run_path(name: str, files: list, repeats: int, result_queue):
+    """Выполняется в дочернем процессе: прогнать путь по всему набору"""
+    logging.disable(logging.CRITICAL)
+    func = PATHS[name]
+    corpus = [open(path, 'rb').read() for path in files]
+    output_bytes = 0
+    started = time.perf_counter()
+    if func is not None:
+        for _ in range(repeats):
+            for data in corpus:
+                output_bytes += len(func(data))
+    elapsed = time.perf_counter() - started
+    result_queue.put((elapsed, peak_rss_kb(), output_bytes))
+
+
+def bench_path(name: str, files: list, repeats: int) -> tuple:
+    ctx = multiprocessing.get_context('spawn')
+    result_queue = ctx.Queue()
+    child = ctx.Process(target=run_path, args=(name, files, repeats, result_queue))
+    child.start()
+    result = result_queue.get()
+    child.join()
+    return result
+
+
+def main():
+    corpus_dir = sys.argv[1] if len(sys.argv) > 1 else None
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+
+    workdir = None
+    if corpus_dir:
+        files = sorted(f for pattern in PHOTO_EXTENSIONS for f in glob.glob(os.path.join(corpus_dir, pattern)))
+    else:
+        workdir = tempfile.mkdtemp(prefix="mishura_images_")
+        files = make_synthetic_corpus(workdir)
+
+    if not files:
+        print(f"❌ В каталоге {corpus_dir} нет фотографий")
+        return
+
+    print("⏱️ БЕНЧМАРК ПОДГОТОВКИ ИЗОБРАЖЕНИЙ")
+    print(f"   фото: {len(files)}, повторов: {repeats}"
+          f"{'' if corpus_dir else ' (синтетический набор)'}")
+    print("=" * 60)
+
+    try:
+        results = {name: bench_path(name, files, repeats) for name in PATHS}
+    finally:
+        if workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    baseline_rss = results['baseline'][1]
+    processed = len(files) * repeats
+    for name in ('legacy', 'fast'):
+        elapsed, maxrss, output_bytes = results[name]
+        print(f"🔹 {name:<7} мс/фото: {elapsed * 1000 / processed:>7.1f}   "
+              f"пик памяти: +{(maxrss - baseline_rss) / 1024:>6.1f} МБ   "
+              f"выход: {output_bytes / processed / 1024:>6.1f} КБ/фото")
+
+    legacy, fast = results['legacy'], results['fast']
+    print("=" * 60)
+    if fast[0]:
+        print(f"📈 Время: x{legacy[0] / fast[0]:.2f}")
+    if fast[1] > baseline_rss:
+        print(f"📉 Память: x{(legacy[1] - baseline_rss) / (fast[1] - baseline_rss):.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# bench_sqlite_profile.py - Сравнение профилей SQLite на нагрузке МИШУРА
+
+"""
+⏱️ БЕНЧМАРК ПРОФИЛЯ SQLITE
+Сравнивает пропускную способность чтения/записи со старыми настройками
+соединения (rollback journal, synchronous=FULL) и с профилем SQLITE_PROFILE
+(WAL, synchronous=NORMAL, mmap, cache, read-only соединения для чтения).
+
+Нагрузка повторяет styleai.db: читатели запрашивают баланс и профиль
+пользователя, писатели сохраняют консультации и действия с формой отзыва.
+
+Запуск: python bench_sqlite_profile.py [секунд_на_профиль] [читателей] [писателей]
+"""
+
+import os
+import sys
+import random
+import shutil
+import tempfile
+import threading
+import time
+import logging
+
+import database
+from database import MishuraDB, close_all_pools
+
+LEGACY_PROFILE = {
+    'journal_mode': 'DELETE',
+    'synchronous': 'FULL',
+    'mmap_size': 0,
+    'cache_size': -2000,
+    'temp_store': 'DEFAULT',
+    'busy_timeout_ms': 10000,
+    'read_only_readers': False,
+}
+
+SEED_USERS = 2000
+
+
+def run_workload(db: MishuraDB, duration: float, readers: int, writers: int) -> dict:
+    """Запустить смешанную нагрузку и вернуть число операций"""
+    counters = {'reads': 0, 'writes': 0, 'errors': 0}
+    lock = threading.Lock()
+    stop_at = time.monotonic() + duration
+
+    def reader():
+        done = 0
+        while time.monotonic() < stop_at:
+            telegram_id = random.randint(1, SEED_USERS)
+            db.get_user_balance(telegram_id)
+            db.get_user(telegram_id)
+            done += 2
+        with lock:
+            counters['reads'] += done
+
+    def writer():
+        done = errors = 0
+        while time.monotonic() < stop_at:
+            telegram_id = random.randint(1, SEED_USERS)
+            try:
+                consultation_id = db.save_consultation(
+                    telegram_id, 'деловая встреча', '', None, 'Совет стилиста ' * 50
+                )
+                db.log_feedback_prompt(telegram_id, consultation_id or 0, 'shown')
+                done += 2
+            except Exception:
+                errors += 1
+        with lock:
+            counters['writes'] += done
+            counters['errors'] += errors
+
+    threads = [threading.Thread(target=reader) for _ in range(readers)]
+    threads += [threading.Thread(target=writer) for _ in range(writers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return counters
+
+
+def bench_profile(name: str, profile: dict, workdir: str, duration: float,
+                  readers: int, writers: int) -> dict:
+    """Подготовить отдельную БД с заданным профилем и прогнать нагрузку"""
+    database.SQLITE_PROFILE.clear()
+    database.SQLITE_PROFILE.update(profile)
+
+    db_path = os.path.join(workdir, f"bench_{name}.db")
+    db = MishuraDB(db_path)
+    db.init_db()
+
+    conn = db.get_connection()
+    cursor = conn.cursor()
+    cursor.executemany(
+        "INSERT OR IGNORE INTO users (telegram_id, username, first_name, last_name, balance) VALUES (?, ?, ?, ?, ?)",
+        [(i, f"user{i}", 'Bench', 'User', 200) for i in range(1, SEED_USERS + 1)]
+    )
+    conn.commit()
+    conn.close()
+
+    counters = run_workload(db, duration, readers, writers)
+    close_all_pools()
+    return counters
+
+
+def main():
+    duration = float(sys.argv[1]) if len(sys.argv) > 1 else 5.0
+    readers = int(sys.argv[2]) if len(sys.argv) > 2 else 6
+    writers = int(sys.argv[3]) if len(sys.argv) > 3 else 2
+
+    # Логи запросов на каждой операции искажают замеры
+    logging.getLogger("MishuraDB").setLevel(logging.ERROR)
+
+    tuned_profile = dict(database.SQLITE_PROFILE)
+    workdir = tempfile.mkdtemp(prefix="mishura_bench_")
+
+    print("⏱️ БЕНЧМАРК ПРОФИЛЯ SQLITE")
+    print(f"   {duration:.0f}с на профиль, читателей: {readers}, писателей: {writers}")
+    print("=" * 60)
+
+    results = {}
+    try:
+        for name, profile in (('legacy', LEGACY_PROFILE), ('tuned', tuned_profile)):
+            counters = bench_profile(name, profile, workdir, duration, readers, writers)
+            results[name] = counters
+            print(f"🔹 {name:<7} чтений/с: {counters['reads'] / duration:>9.0f}   "
+                  f"записей/с: {counters['writes'] / duration:>8.0f}   ошибок: {counters['errors']}")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    legacy, tuned = results.get('legacy'), results.get('tuned')
+    if legacy and tuned:
+        print("=" * 60)
+        for kind, label in (('reads', 'Чтение'), ('writes', 'Запись')):
+            if legacy[kind]:
+                print(f"📈 {label}: x{tuned[kind] / legacy[kind]:.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -10,9 +10,21 @@
 """
 import sqlite3
 import os
-from datetime import datetime
+import re
+import base64
+import binascii
+import asyncio
+import functools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from collections import deque, OrderedDict
+from datetime import datetime, timedelta
 import logging
-from typing import Optional, Dict, Any, List, Union
+from typing import Optional, Dict, Any, List, Union, Callable
+
+from migrations import apply_migrations, get_schema_version, LATEST_VERSION as LATEST_SCHEMA_VERSION
 
 # PostgreSQL поддержка для продакшена
 try:
@@ -23,6 +35,14 @@ try:
 except ImportError:
     POSTGRES_AVAILABLE = False
 
+if POSTGRES_AVAILABLE:
+    class PreparingConnection(psycopg2.extensions.connection):
+        """Соединение PostgreSQL, которое помнит подготовленные на нем запросы"""
+
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.prepared_statements = set()
+
 # Настройка логирования для этого модуля
 logger = logging.getLogger("MishuraDB")
 if not logger.handlers:
@@ -54,7 +74,6 @@ def get_database_path():
 # Имя файла БД
 DB_FILENAME = "styleai.db"
 DB_PATH = get_database_path()
-SCHEMA_FILE = "schema.sql"
 
 def get_database_config():
     """Определить тип базы данных"""
@@ -70,6 +89,1048 @@ def get_database_config():
 # Глобальная конфигурация БД
 DB_CONFIG = get_database_config()
 
+# Параметры пула соединений
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 10))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', 10))
+DB_POOL_HEALTHCHECK_INTERVAL = float(os.getenv('DB_POOL_HEALTHCHECK_INTERVAL', 30))
+# Потоки для асинхронного слоя: больше размера пула смысла нет
+DB_ASYNC_WORKERS = int(os.getenv('DB_ASYNC_WORKERS', DB_POOL_SIZE))
+# Время жизни снимка статистики (секунды)
+STATS_CACHE_TTL = float(os.getenv('STATS_CACHE_TTL', 30))
+
+# Инструментирование запросов
+DB_SLOW_QUERY_MS = float(os.getenv('DB_SLOW_QUERY_MS', 200))
+# EXPLAIN для одного и того же медленного запроса - не чаще раза в N секунд
+DB_SLOW_QUERY_EXPLAIN_INTERVAL = float(os.getenv('DB_SLOW_QUERY_EXPLAIN_INTERVAL', 60))
+DB_QUERY_STATS_ENABLED = os.getenv('DB_QUERY_STATS_ENABLED', 'true').lower() == 'true'
+
+# Профиль производительности SQLite, применяется к каждому новому соединению
+SQLITE_PROFILE = {
+    'journal_mode': os.getenv('SQLITE_JOURNAL_MODE', 'WAL'),
+    'synchronous': os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL'),
+    'mmap_size': int(os.getenv('SQLITE_MMAP_SIZE', 256 * 1024 * 1024)),
+    'cache_size': int(os.getenv('SQLITE_CACHE_SIZE', -64000)),  # < 0 - размер в KiB
+    'temp_store': os.getenv('SQLITE_TEMP_STORE', 'MEMORY'),
+    'busy_timeout_ms': int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', 10000)),
+    # Читающие запросы идут через отдельные read-only соединения
+    'read_only_readers': os.getenv('SQLITE_READ_ONLY_READERS', 'true').lower() == 'true',
+}
+
+
+class PoolTimeoutError(Exception):
+    """Не удалось получить соединение из пула за отведенное время"""
+
+
+# Границы корзин гистограммы времени запросов (мс)
+QUERY_HISTOGRAM_BUCKETS_MS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+
+_LITERAL_RE = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_WHITESPACE_RE = re.compile(r"\s+")
+_COMMENT_RE = re.compile(r"--[^\n]*")
+
+
+@functools.lru_cache(maxsize=1024)
+def normalize_query_name(query: str) -> str:
+    """Имя запроса для статистики: имя из реестра STATEMENTS или SQL без литералов"""
+    name = _STATEMENT_NAMES_BY_SQL.get(query)
+    if name:
+        return name
+    normalized = _WHITESPACE_RE.sub(' ', _LITERAL_RE.sub('?', _COMMENT_RE.sub('', query))).strip()
+    return normalized[:120]
+
+
+def describe_params_shape(params) -> str:
+    """Форма параметров без значений: типы (значения могут содержать личные данные)"""
+    if params is None:
+        return '()'
+    if isinstance(params, dict):
+        return '{' + ', '.join(f"{key}: {type(value).__name__}" for key, value in params.items()) + '}'
+    if isinstance(params, (list, tuple)):
+        return '(' + ', '.join(type(value).__name__ for value in params) + ')'
+    return type(params).__name__
+
+
+class QueryStats:
+    """
+    ⏱️ Статистика выполнения запросов: число, время, гистограмма, ошибки,
+    медленные запросы и открытые соединения
+    """
+
+    def __init__(self, slow_query_ms: float = DB_SLOW_QUERY_MS,
+                 explain_interval: float = DB_SLOW_QUERY_EXPLAIN_INTERVAL):
+        self.slow_query_ms = slow_query_ms
+        self.explain_interval = explain_interval
+        self._lock = threading.Lock()
+        self._queries: Dict[str, Dict[str, Any]] = {}
+        self._connections: Dict[str, int] = {}
+        self._last_explain: Dict[str, float] = {}
+        self.started_at = datetime.now().isoformat()
+
+    def record(self, name: str, elapsed_ms: float, error: bool = False) -> bool:
+        """Учесть выполнение запроса. Возвращает True, если запрос медленный."""
+        bucket = len(QUERY_HISTOGRAM_BUCKETS_MS)
+        for index, bound in enumerate(QUERY_HISTOGRAM_BUCKETS_MS):
+            if elapsed_ms <= bound:
+                bucket = index
+                break
+
+        slow = elapsed_ms >= self.slow_query_ms
+        with self._lock:
+            entry = self._queries.get(name)
+            if entry is None:
+                entry = self._queries[name] = {
+                    'count': 0, 'errors': 0, 'slow': 0, 'total_ms': 0.0, 'max_ms': 0.0,
+                    'histogram': [0] * (len(QUERY_HISTOGRAM_BUCKETS_MS) + 1),
+                }
+            entry['count'] += 1
+            entry['total_ms'] += elapsed_ms
+            entry['max_ms'] = max(entry['max_ms'], elapsed_ms)
+            entry['histogram'][bucket] += 1
+            if error:
+                entry['errors'] += 1
+            if slow:
+                entry['slow'] += 1
+        return slow
+
+    def should_explain(self, name: str) -> bool:
+        """Ограничение частоты EXPLAIN для одного запроса"""
+        now = time.monotonic()
+        with self._lock:
+            last = self._last_explain.get(name)
+            if last is not None and now - last < self.explain_interval:
+                return False
+            self._last_explain[name] = now
+            return True
+
+    def count_connection(self, kind: str):
+        with self._lock:
+            self._connections[kind] = self._connections.get(kind, 0) + 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Статистика, отсортированная по суммарному времени"""
+        labels = [f"<={bound}ms" for bound in QUERY_HISTOGRAM_BUCKETS_MS]
+        labels.append(f">{QUERY_HISTOGRAM_BUCKETS_MS[-1]}ms")
+        with self._lock:
+            queries = []
+            for name, entry in self._queries.items():
+                queries.append({
+                    'query': name,
+                    'count': entry['count'],
+                    'errors': entry['errors'],
+                    'slow': entry['slow'],
+                    'total_ms': round(entry['total_ms'], 2),
+                    'avg_ms': round(entry['total_ms'] / entry['count'], 3),
+                    'max_ms': round(entry['max_ms'], 2),
+                    'histogram': dict(zip(labels, entry['histogram'])),
+                })
+            connections = dict(self._connections)
+        queries.sort(key=lambda item: item['total_ms'], reverse=True)
+        return {
+            'since': self.started_at,
+            'slow_query_ms': self.slow_query_ms,
+            'connections_opened': connections,
+            'queries': queries,
+        }
+
+    def reset(self):
+        with self._lock:
+            self._queries.clear()
+            self._last_explain.clear()
+            self.started_at = datetime.now().isoformat()
+
+
+QUERY_STATS = QueryStats()
+
+
+class InstrumentedCursor:
+    """Курсор, замеряющий каждый execute и логирующий медленные запросы"""
+
+    _EXPLAINABLE = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH', 'EXECUTE')
+
+    def __init__(self, raw_cursor, raw_conn, db_type: str):
+        self._cursor = raw_cursor
+        self._conn = raw_conn
+        self._db_type = db_type
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def execute(self, query, params=None):
+        return self._timed(self._cursor.execute, query, params)
+
+    def executemany(self, query, seq_of_params):
+        return self._timed(self._cursor.executemany, query, seq_of_params, many=True)
+
+    def _timed(self, method, query, params, many=False):
+        started = time.perf_counter()
+        try:
+            if params is None:
+                result = method(query)
+            else:
+                result = method(query, params)
+        except Exception:
+            QUERY_STATS.record(normalize_query_name(query), (time.perf_counter() - started) * 1000, error=True)
+            raise
+
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        name = normalize_query_name(query)
+        if QUERY_STATS.record(name, elapsed_ms):
+            shape = f"{len(params)} x batch" if many else describe_params_shape(params)
+            logger.warning(f"🐢 Медленный запрос {elapsed_ms:.1f}мс: {name} | параметры: {shape}")
+            if not many and QUERY_STATS.should_explain(name):
+                self._log_explain(query, params)
+        # sqlite3.Cursor.execute возвращает курсор - отдаем обертку
+        return self if result is self._cursor else result
+
+    def _log_explain(self, query: str, params):
+        """План медленного запроса (отдельный курсор, результат исходного не теряется)"""
+        if query.lstrip()[:7].upper().split(' ')[0] not in self._EXPLAINABLE:
+            return
+        cursor = None
+        try:
+            cursor = self._conn.cursor()
+            if self._db_type == 'postgresql':
+                # Ошибка EXPLAIN не должна ломать транзакцию вызывающего кода
+                cursor.execute("SAVEPOINT mishura_explain")
+                try:
+                    cursor.execute("EXPLAIN " + query, params)
+                    plan = [row[0] for row in cursor.fetchall()]
+                finally:
+                    cursor.execute("ROLLBACK TO SAVEPOINT mishura_explain")
+            else:
+                cursor.execute("EXPLAIN QUERY PLAN " + query, params or ())
+                plan = [row[-1] for row in cursor.fetchall()]
+            logger.warning("🔍 План запроса:\n    " + "\n    ".join(str(line) for line in plan))
+        except Exception as e:
+            logger.debug(f"EXPLAIN не выполнен: {e}")
+        finally:
+            if cursor is not None:
+                try:
+                    cursor.close()
+                except Exception:
+                    pass
+
+
+class PooledConnection:
+    """
+    Обертка над соединением из пула.
+    close() возвращает соединение в пул вместо закрытия, остальное делегируется.
+    """
+
+    def __init__(self, pool: 'ConnectionPool', raw_conn):
+        self._pool = pool
+        self._raw = raw_conn
+        self._released = False
+
+    def __getattr__(self, name):
+        return getattr(self._raw, name)
+
+    def cursor(self, *args, **kwargs):
+        raw_cursor = self._raw.cursor(*args, **kwargs)
+        if not DB_QUERY_STATS_ENABLED:
+            return raw_cursor
+        return InstrumentedCursor(raw_cursor, self._raw, self._pool.db_type)
+
+    def __enter__(self):
+        self._raw.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        return self._raw.__exit__(exc_type, exc_value, tb)
+
+    def close(self):
+        """Вернуть соединение в пул"""
+        if not self._released:
+            self._released = True
+            self._pool.release(self._raw)
+
+    def __del__(self):
+        # Страховка: соединение, которое забыли закрыть, возвращается в пул
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+class ConnectionPool:
+    """
+    🔌 Потокобезопасный пул соединений для SQLite и PostgreSQL
+
+    - ограниченный размер (max_size)
+    - таймаут ожидания свободного соединения
+    - проверка живости простаивающих соединений перед выдачей
+    - статистика использования
+    """
+
+    def __init__(self, factory: Callable[[], Any], db_type: str,
+                 max_size: int = DB_POOL_SIZE, timeout: float = DB_POOL_TIMEOUT,
+                 healthcheck_interval: float = DB_POOL_HEALTHCHECK_INTERVAL):
+        self._factory = factory
+        self.db_type = db_type
+        self.max_size = max(1, max_size)
+        self.timeout = timeout
+        self.healthcheck_interval = healthcheck_interval
+
+        self._idle = deque()  # (raw_conn, время возврата в пул)
+        self._size = 0
+        self._cond = threading.Condition(threading.Lock())
+        self._stats = {
+            'created': 0,
+            'closed': 0,
+            'checkouts': 0,
+            'waits': 0,
+            'timeouts': 0,
+            'healthcheck_failures': 0,
+        }
+
+    def acquire(self) -> PooledConnection:
+        """Получить соединение из пула (ждет не дольше timeout секунд)"""
+        deadline = time.monotonic() + self.timeout
+
+        while True:
+            with self._cond:
+                while not self._idle and self._size >= self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._stats['timeouts'] += 1
+                        raise PoolTimeoutError(
+                            f"Нет свободных соединений в пуле (размер {self.max_size}, таймаут {self.timeout}с)"
+                        )
+                    self._stats['waits'] += 1
+                    self._cond.wait(remaining)
+
+                if self._idle:
+                    raw, released_at = self._idle.pop()
+                else:
+                    raw, released_at = None, None
+                    self._size += 1
+
+            if raw is None:
+                try:
+                    raw = self._factory()
+                except Exception:
+                    with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    raise
+                with self._cond:
+                    self._stats['created'] += 1
+            elif time.monotonic() - released_at > self.healthcheck_interval and not self._is_healthy(raw):
+                with self._cond:
+                    self._stats['healthcheck_failures'] += 1
+                self._discard(raw)
+                continue
+
+            with self._cond:
+                self._stats['checkouts'] += 1
+            return PooledConnection(self, raw)
+
+    def release(self, raw):
+        """Вернуть соединение в пул, откатив незавершенную транзакцию"""
+        try:
+            if self.db_type == 'postgresql':
+                if raw.closed:
+                    raise ConnectionError("соединение PostgreSQL закрыто")
+                raw.rollback()
+            elif raw.in_transaction:
+                raw.rollback()
+        except Exception as e:
+            logger.warning(f"⚠️ Соединение исключено из пула: {e}")
+            self._discard(raw)
+            return
+
+        with self._cond:
+            self._idle.append((raw, time.monotonic()))
+            self._cond.notify()
+
+    def _is_healthy(self, raw) -> bool:
+        """Проверка живости соединения"""
+        try:
+            if self.db_type == 'postgresql' and raw.closed:
+                return False
+            cursor = raw.cursor()
+            cursor.execute("SELECT 1")
+            cursor.fetchone()
+            cursor.close()
+            if self.db_type == 'postgresql':
+                raw.rollback()
+            return True
+        except Exception as e:
+            logger.warning(f"⚠️ Проверка соединения не пройдена: {e}")
+            return False
+
+    def _discard(self, raw):
+        """Закрыть соединение и освободить место в пуле"""
+        try:
+            raw.close()
+        except Exception:
+            pass
+        with self._cond:
+            self._size -= 1
+            self._stats['closed'] += 1
+            self._cond.notify()
+
+    def close_all(self):
+        """Закрыть все простаивающие соединения"""
+        with self._cond:
+            idle = list(self._idle)
+            self._idle.clear()
+        for raw, _ in idle:
+            self._discard(raw)
+
+    def stats(self) -> Dict[str, Any]:
+        """Статистика пула"""
+        with self._cond:
+            return {
+                'db_type': self.db_type,
+                'max_size': self.max_size,
+                'size': self._size,
+                'idle': len(self._idle),
+                'in_use': self._size - len(self._idle),
+                **self._stats,
+            }
+
+
+class UserIdCache:
+    """
+    🗂️ Ограниченный LRU-кеш telegram_id -> users.id
+    users.id не меняется после создания, поэтому кеш не требует инвалидации.
+    """
+
+    def __init__(self, max_size: int = 10000):
+        self.max_size = max(1, max_size)
+        self._data: 'OrderedDict[int, int]' = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, telegram_id: int) -> Optional[int]:
+        with self._lock:
+            user_id = self._data.get(telegram_id)
+            if user_id is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(telegram_id)
+            self.hits += 1
+            return user_id
+
+    def put(self, telegram_id: int, user_id: int):
+        with self._lock:
+            self._data[telegram_id] = user_id
+            self._data.move_to_end(telegram_id)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def discard(self, telegram_id: int):
+        with self._lock:
+            self._data.pop(telegram_id, None)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {'size': len(self._data), 'max_size': self.max_size,
+                    'hits': self.hits, 'misses': self.misses}
+
+
+USER_ID_CACHE = UserIdCache(int(os.getenv('USER_ID_CACHE_SIZE', 10000)))
+
+
+class InvalidCursorError(ValueError):
+    """Курсор пагинации поврежден или подделан"""
+
+
+def encode_page_cursor(created_at, row_id: int) -> str:
+    """Курсор страницы: base64 от 'created_at|id' последней строки"""
+    raw = f"{created_at}|{row_id}".encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_page_cursor(cursor: str) -> tuple:
+    """Обратное преобразование encode_page_cursor -> (created_at, id)"""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        created_at, row_id = base64.urlsafe_b64decode(padded.encode('ascii')).decode('utf-8').rsplit('|', 1)
+        return created_at, int(row_id)
+    except (ValueError, UnicodeError, binascii.Error) as e:
+        raise InvalidCursorError(f"Некорректный курсор: {cursor}") from e
+
+
+class SnapshotCache:
+    """
+    📸 Снимок результата дорогого запроса с ограниченным временем жизни.
+    Пересчитывает снимок только один поток: пока он работает, остальные
+    получают устаревший снимок, а если снимка еще нет - ждут его.
+    """
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._value = None
+        self._expires_at = 0.0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.refreshes = 0
+
+    def get(self, loader: Callable[[], Any]):
+        value = self._value
+        if value is not None and time.monotonic() < self._expires_at:
+            self.hits += 1
+            return value
+
+        if value is not None:
+            if not self._lock.acquire(blocking=False):
+                # Снимок уже пересчитывается другим потоком
+                self.hits += 1
+                return value
+        else:
+            self._lock.acquire()
+
+        try:
+            if self._value is not None and time.monotonic() < self._expires_at:
+                self.hits += 1
+                return self._value
+            value = loader()
+            self._value = value
+            self._expires_at = time.monotonic() + self.ttl
+            self.refreshes += 1
+            return value
+        finally:
+            self._lock.release()
+
+    def invalidate(self):
+        self._expires_at = 0.0
+
+
+# Пулы разделяются между всеми экземплярами MishuraDB с одинаковой БД
+_POOLS: Dict[str, ConnectionPool] = {}
+_POOLS_LOCK = threading.Lock()
+
+
+def _connect_postgres():
+    QUERY_STATS.count_connection('postgresql')
+    return psycopg2.connect(DB_CONFIG['url'], connection_factory=PreparingConnection)
+
+
+def connect_sqlite(db_path: str, read_only: bool = False, profile: Optional[Dict[str, Any]] = None):
+    """Открыть соединение SQLite с профилем производительности SQLITE_PROFILE"""
+    profile = profile or SQLITE_PROFILE
+    busy_timeout_ms = int(profile['busy_timeout_ms'])
+
+    if read_only:
+        uri = f"{Path(db_path).absolute().as_uri()}?mode=ro"
+        conn = sqlite3.connect(uri, uri=True, timeout=busy_timeout_ms / 1000, check_same_thread=False)
+    else:
+        conn = sqlite3.connect(db_path, timeout=busy_timeout_ms / 1000, check_same_thread=False)
+    QUERY_STATS.count_connection('sqlite_read_only' if read_only else 'sqlite')
+
+    conn.execute("PRAGMA foreign_keys = ON;")
+    conn.execute(f"PRAGMA busy_timeout = {busy_timeout_ms};")
+    if not read_only and profile.get('journal_mode'):
+        # journal_mode сохраняется в файле БД, read-only соединение его менять не может
+        conn.execute(f"PRAGMA journal_mode = {profile['journal_mode']};")
+    if profile.get('synchronous'):
+        conn.execute(f"PRAGMA synchronous = {profile['synchronous']};")
+    if profile.get('mmap_size') is not None:
+        conn.execute(f"PRAGMA mmap_size = {int(profile['mmap_size'])};")
+    if profile.get('cache_size') is not None:
+        conn.execute(f"PRAGMA cache_size = {int(profile['cache_size'])};")
+    if profile.get('temp_store'):
+        conn.execute(f"PRAGMA temp_store = {profile['temp_store']};")
+    if read_only:
+        conn.execute("PRAGMA query_only = ON;")
+    return conn
+
+
+def get_pool(db_path: str = DB_PATH, read_only: bool = False) -> ConnectionPool:
+    """
+    Получить (создать при первом обращении) пул для текущей конфигурации БД.
+    read_only=True - отдельный пул read-only соединений SQLite для читающих запросов.
+    """
+    if DB_CONFIG['type'] == 'postgresql':
+        key = 'postgresql'
+    else:
+        key = f"sqlite:{os.path.abspath(db_path)}"
+        if read_only:
+            key += ":ro"
+
+    pool = _POOLS.get(key)
+    if pool is not None:
+        return pool
+
+    with _POOLS_LOCK:
+        pool = _POOLS.get(key)
+        if pool is None:
+            if DB_CONFIG['type'] == 'postgresql':
+                factory = _connect_postgres
+            else:
+                factory = functools.partial(connect_sqlite, db_path, read_only)
+            pool = ConnectionPool(factory, DB_CONFIG['type'])
+            _POOLS[key] = pool
+            logger.info(f"🔌 Создан пул соединений {key} (размер {pool.max_size})")
+        return pool
+
+
+def close_all_pools():
+    """Закрыть простаивающие соединения всех пулов (при остановке сервера)"""
+    with _POOLS_LOCK:
+        pools = list(_POOLS.values())
+    for pool in pools:
+        pool.close_all()
+
+
+# === РЕЕСТР ЗАПРОСОВ ===
+# Запросы пишутся один раз в синтаксисе SQLite (? или :name) и переводятся
+# под PostgreSQL при импорте модуля. На PostgreSQL они выполняются как
+# серверные prepared statements (PREPARE один раз на соединение).
+
+DB_PG_PREPARED_STATEMENTS = os.getenv('DB_PG_PREPARED_STATEMENTS', 'true').lower() == 'true'
+
+STATEMENT_READ = 'read'            # SELECT, выполняется на read-соединении
+STATEMENT_WRITE = 'write'          # изменение без результата, возвращает rowcount
+STATEMENT_RETURNING = 'returning'  # изменение с RETURNING
+
+_PLACEHOLDER_RE = re.compile(r"'(?:[^']|'')*'|(?<![:\w]):([A-Za-z_]\w*)|\?")
+
+
+class Statement:
+    """Именованный запрос, переведенный под оба диалекта"""
+
+    __slots__ = ('name', 'kind', 'sqlite_sql', 'pg_sql', 'pg_prepare_sql',
+                 'pg_execute_sql', 'param_names')
+
+    def __init__(self, name: str, kind: str, sql: str, postgres_sql: Optional[str] = None):
+        self.name = name
+        self.kind = kind
+        self.sqlite_sql = sql
+        self.pg_sql, self.pg_prepare_sql, self.param_names, param_count = _translate_sql(postgres_sql or sql)
+        placeholders = ', '.join(['%s'] * param_count)
+        self.pg_execute_sql = f"EXECUTE mishura_{name}" + (f" ({placeholders})" if param_count else "")
+
+    def pg_values(self, params) -> list:
+        """Параметры в порядке $1..$n для EXECUTE"""
+        if self.param_names:
+            return [params[name] for name in self.param_names]
+        return list(params or ())
+
+
+def _translate_sql(sql: str) -> tuple:
+    """
+    ? / :name -> (SQL для psycopg2, SQL для PREPARE с $n, имена параметров, число параметров).
+    Строковые литералы не затрагиваются.
+    """
+    pg_parts, prepare_parts, names = [], [], []
+    positional = 0
+    pos = 0
+    for match in _PLACEHOLDER_RE.finditer(sql):
+        chunk = sql[pos:match.start()]
+        pg_parts.append(chunk.replace('%', '%%'))
+        prepare_parts.append(chunk)
+        token = match.group(0)
+        if token.startswith("'"):
+            pg_parts.append(token.replace('%', '%%'))
+            prepare_parts.append(token)
+        elif token == '?':
+            positional += 1
+            pg_parts.append('%s')
+            prepare_parts.append(f'${positional}')
+        else:
+            name = match.group(1)
+            if name not in names:
+                names.append(name)
+            pg_parts.append(f'%({name})s')
+            prepare_parts.append(f'${names.index(name) + 1}')
+        pos = match.end()
+    pg_parts.append(sql[pos:].replace('%', '%%'))
+    prepare_parts.append(sql[pos:])
+
+    if positional and names:
+        raise ValueError("Нельзя смешивать ? и :name в одном запросе")
+    return ''.join(pg_parts), ''.join(prepare_parts), tuple(names), positional or len(names)
+
+
+STATEMENTS: Dict[str, Statement] = {}
+# Текст запроса в любом диалекте -> имя в реестре (для статистики запросов)
+_STATEMENT_NAMES_BY_SQL: Dict[str, str] = {}
+
+
+def register_statement(name: str, kind: str, sql: str, postgres_sql: Optional[str] = None) -> Statement:
+    """Зарегистрировать именованный запрос (postgres_sql - если диалекты расходятся)"""
+    statement = Statement(name, kind, sql, postgres_sql)
+    STATEMENTS[name] = statement
+    for text in (statement.sqlite_sql, statement.pg_sql, statement.pg_execute_sql):
+        _STATEMENT_NAMES_BY_SQL[text] = name
+    _STATEMENT_NAMES_BY_SQL[f"PREPARE mishura_{name} AS {statement.pg_prepare_sql}"] = f"{name} (PREPARE)"
+    return statement
+
+
+@functools.lru_cache(maxsize=512)
+def _analyze_adhoc_query(query: str) -> tuple:
+    """Разбор произвольного запроса для _execute_query (кешируется по тексту)"""
+    stripped = query.strip()
+    head = stripped[:6].upper()
+    is_select = head == 'SELECT'
+    is_write = head in ('INSERT', 'UPDATE', 'DELETE')
+    needs_last_id = head == 'INSERT' and 'RETURNING' not in stripped.upper()
+    return query.replace('?', '%s'), is_select, is_write, needs_last_id
+
+
+# --- Пользователи ---
+
+register_statement('user_by_telegram_id', STATEMENT_READ, """
+    SELECT id, telegram_id, username, first_name, last_name, balance, created_at
+    FROM users
+    WHERE telegram_id = ?
+""")
+
+register_statement('user_id_by_telegram_id', STATEMENT_READ,
+                   "SELECT id FROM users WHERE telegram_id = ?")
+
+register_statement('user_balance', STATEMENT_READ,
+                   "SELECT balance FROM users WHERE telegram_id = ?")
+
+register_statement('user_id_balance', STATEMENT_READ,
+                   "SELECT id, balance FROM users WHERE telegram_id = ?")
+
+register_statement('user_upsert', STATEMENT_RETURNING, """
+    INSERT INTO users (telegram_id, username, first_name, last_name, balance, created_at, updated_at)
+    VALUES (:telegram_id, :new_username, :new_first_name, :new_last_name,
+            :balance, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
+    ON CONFLICT (telegram_id) DO UPDATE
+    SET username = COALESCE(:username, username),
+        first_name = COALESCE(:first_name, first_name),
+        last_name = COALESCE(:last_name, last_name),
+        updated_at = CURRENT_TIMESTAMP
+    WHERE COALESCE(:username, username) IS NOT username
+       OR COALESCE(:first_name, first_name) IS NOT first_name
+       OR COALESCE(:last_name, last_name) IS NOT last_name
+    RETURNING id, balance
+""", postgres_sql="""
+    WITH upserted AS (
+        INSERT INTO users (telegram_id, username, first_name, last_name, balance, created_at, updated_at)
+        VALUES (:telegram_id, :new_username, :new_first_name, :new_last_name,
+                :balance, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
+        ON CONFLICT (telegram_id) DO UPDATE
+        SET username = COALESCE(CAST(:username AS TEXT), users.username),
+            first_name = COALESCE(CAST(:first_name AS TEXT), users.first_name),
+            last_name = COALESCE(CAST(:last_name AS TEXT), users.last_name),
+            updated_at = CURRENT_TIMESTAMP
+        WHERE (users.username, users.first_name, users.last_name) IS DISTINCT FROM
+              (COALESCE(CAST(:username AS TEXT), users.username),
+               COALESCE(CAST(:first_name AS TEXT), users.first_name),
+               COALESCE(CAST(:last_name AS TEXT), users.last_name))
+        RETURNING id, balance
+    )
+    SELECT id, balance FROM upserted
+    UNION ALL
+    SELECT id, balance FROM users
+    WHERE telegram_id = :telegram_id AND NOT EXISTS (SELECT 1 FROM upserted)
+""")
+
+# SQLite: вызывается только после промаха user_balance
+register_statement('user_balance_or_create', STATEMENT_RETURNING, """
+    INSERT INTO users (telegram_id, username, first_name, last_name, balance, created_at, updated_at)
+    VALUES (:telegram_id, 'webapp_user', 'WebApp', 'User', :balance, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
+    ON CONFLICT (telegram_id) DO NOTHING
+    RETURNING balance, 1
+""", postgres_sql="""
+    WITH existing AS (
+        SELECT balance FROM users WHERE telegram_id = :telegram_id
+    ), created AS (
+        INSERT INTO users (telegram_id, username, first_name, last_name, balance, created_at, updated_at)
+        SELECT CAST(:telegram_id AS BIGINT), 'webapp_user', 'WebApp', 'User', CAST(:balance AS INTEGER),
+               CURRENT_TIMESTAMP, CURRENT_TIMESTAMP
+        WHERE NOT EXISTS (SELECT 1 FROM existing)
+        ON CONFLICT (telegram_id) DO NOTHING
+        RETURNING balance
+    )
+    SELECT balance, FALSE FROM existing
+    UNION ALL
+    SELECT balance, TRUE FROM created
+""")
+
+register_statement('user_set_balance', STATEMENT_WRITE, """
+    UPDATE users
+    SET balance = ?, updated_at = CURRENT_TIMESTAMP
+    WHERE telegram_id = ?
+""")
+
+# --- Консультации ---
+
+register_statement('consultation_insert', STATEMENT_RETURNING, """
+    INSERT INTO consultations (user_id, occasion, preferences, image_path, advice, created_at)
+    VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+    RETURNING id, user_id
+""")
+
+register_statement('consultation_insert_by_telegram_id', STATEMENT_RETURNING, """
+    INSERT INTO consultations (user_id, occasion, preferences, image_path, advice, created_at)
+    SELECT id, CAST(? AS TEXT), CAST(? AS TEXT), CAST(? AS TEXT), CAST(? AS TEXT), CURRENT_TIMESTAMP
+    FROM users WHERE telegram_id = ?
+    RETURNING id, user_id
+""")
+
+register_statement('consultation_by_id', STATEMENT_READ, """
+    SELECT id, user_id, occasion, preferences, image_path, advice, created_at
+    FROM consultations WHERE id = ?
+""")
+
+register_statement('consultation_by_id_and_user', STATEMENT_READ, """
+    SELECT id, user_id, occasion, preferences, image_path, advice, created_at
+    FROM consultations WHERE id = ? AND user_id = ?
+""")
+
+register_statement('consultations_by_user', STATEMENT_READ, """
+    SELECT id, user_id, occasion, preferences, image_path, advice, created_at
+    FROM consultations
+    WHERE user_id = ?
+    ORDER BY created_at DESC
+    LIMIT ?
+""")
+
+# История консультаций: keyset-пагинация по idx_consultations_user_created, без текста advice
+register_statement('consultations_page_first', STATEMENT_READ, """
+    SELECT id, occasion, preferences, image_path, created_at
+    FROM consultations
+    WHERE user_id = ?
+    ORDER BY created_at DESC, id DESC
+    LIMIT ?
+""")
+
+register_statement('consultations_page_after', STATEMENT_READ, """
+    SELECT id, occasion, preferences, image_path, created_at
+    FROM consultations
+    WHERE user_id = ? AND (created_at, id) < (?, ?)
+    ORDER BY created_at DESC, id DESC
+    LIMIT ?
+""")
+
+# --- Платежи ---
+
+register_statement('payment_insert', STATEMENT_WRITE, """
+    INSERT INTO payments (
+        payment_id, user_id, telegram_id, plan_id,
+        amount, stcoins_amount, status, created_at, updated_at
+    ) VALUES (?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
+""")
+
+register_statement('payment_set_yookassa_id', STATEMENT_WRITE, """
+    UPDATE payments
+    SET yookassa_payment_id = ?, updated_at = CURRENT_TIMESTAMP
+    WHERE payment_id = ?
+""")
+
+register_statement('payment_set_status', STATEMENT_WRITE, """
+    UPDATE payments
+    SET status = ?, updated_at = CURRENT_TIMESTAMP
+    WHERE payment_id = ?
+""")
+
+register_statement('payment_set_status_with_error', STATEMENT_WRITE, """
+    UPDATE payments
+    SET status = ?, error_message = ?, updated_at = CURRENT_TIMESTAMP
+    WHERE payment_id = ?
+""")
+
+register_statement('payment_by_yookassa_id', STATEMENT_READ, """
+    SELECT payment_id, user_id, telegram_id, plan_id, amount,
+           stcoins_amount, status, yookassa_payment_id,
+           created_at, updated_at, processed_at
+    FROM payments
+    WHERE yookassa_payment_id = ?
+""")
+
+register_statement('payment_status', STATEMENT_READ, """
+    SELECT payment_id, yookassa_payment_id, status, amount,
+           stcoins_amount, created_at, processed_at, error_message
+    FROM payments
+    WHERE payment_id = ?
+""")
+
+register_statement('payment_status_for_user', STATEMENT_READ, """
+    SELECT payment_id, yookassa_payment_id, status, amount,
+           stcoins_amount, created_at, processed_at, error_message
+    FROM payments
+    WHERE payment_id = ? AND telegram_id = ?
+""")
+
+register_statement('payment_mark_processed', STATEMENT_WRITE, """
+    UPDATE payments
+    SET status = 'succeeded', processed_at = CURRENT_TIMESTAMP, updated_at = CURRENT_TIMESTAMP
+    WHERE payment_id = ?
+""")
+
+register_statement('payments_user_has_succeeded', STATEMENT_READ, """
+    SELECT 1 FROM payments
+    WHERE telegram_id = ? AND status = 'succeeded'
+    LIMIT 1
+""")
+
+register_statement('payments_pending', STATEMENT_READ, """
+    SELECT payment_id, yookassa_payment_id, telegram_id, stcoins_amount, created_at
+    FROM payments
+    WHERE status = 'pending'
+    AND yookassa_payment_id IS NOT NULL
+    ORDER BY created_at DESC
+    LIMIT ?
+""")
+
+# --- Отзывы ---
+
+register_statement('feedback_insert', STATEMENT_RETURNING, """
+    INSERT INTO feedback_submissions
+    (telegram_id, feedback_text, feedback_rating, character_count,
+     consultation_id, ip_address, user_agent)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+    RETURNING id
+""")
+
+register_statement('feedback_last_prompt', STATEMENT_READ, """
+    SELECT prompt_shown_at
+    FROM feedback_prompts
+    WHERE telegram_id = ?
+    ORDER BY prompt_shown_at DESC
+    LIMIT 1
+""")
+
+register_statement('feedback_prompt_insert', STATEMENT_WRITE, """
+    INSERT INTO feedback_prompts
+    (telegram_id, consultation_id, user_action, dismissal_reason)
+    VALUES (?, ?, ?, ?)
+""")
+
+register_statement('feedback_pending_sync', STATEMENT_READ, """
+    SELECT id, telegram_id, feedback_text, feedback_rating,
+           character_count, created_at, consultation_id
+    FROM feedback_submissions
+    WHERE google_sheets_synced = FALSE
+    ORDER BY created_at ASC
+    LIMIT ?
+""")
+
+register_statement('feedback_mark_synced', STATEMENT_WRITE, """
+    UPDATE feedback_submissions
+    SET google_sheets_synced = TRUE, google_sheets_row_id = ?
+    WHERE id = ?
+""")
+
+register_statement('feedback_mark_bonus_awarded', STATEMENT_WRITE,
+                   "UPDATE feedback_submissions SET bonus_awarded = TRUE WHERE id = ?")
+
+# --- Кеш анализов ---
+
+register_statement('analysis_cache_get', STATEMENT_READ, """
+    SELECT advice FROM analysis_cache
+    WHERE cache_key = ? AND expires_at > ?
+""")
+
+register_statement('analysis_cache_put', STATEMENT_WRITE, """
+    INSERT INTO analysis_cache (cache_key, kind, advice, created_at, expires_at)
+    VALUES (?, ?, ?, CURRENT_TIMESTAMP, ?)
+    ON CONFLICT (cache_key) DO UPDATE
+    SET advice = excluded.advice,
+        created_at = CURRENT_TIMESTAMP,
+        expires_at = excluded.expires_at
+""")
+
+register_statement('analysis_cache_purge', STATEMENT_WRITE,
+                   "DELETE FROM analysis_cache WHERE expires_at <= ?")
+
+# --- Учет токенов и стоимости Gemini ---
+
+register_statement('usage_insert', STATEMENT_WRITE, """
+    INSERT INTO consultation_usage
+    (consultation_id, telegram_id, endpoint, source, model, images,
+     prompt_tokens, image_tokens, output_tokens, total_tokens, tokens_estimated,
+     attempts, abandoned_calls, gemini_latency_ms, total_latency_ms, cost_usd)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+""")
+
+# Сводка по дням, пользователям и endpoint'ам; задержка Gemini - только по реальным вызовам
+_USAGE_ROLLUP_COLUMNS = """
+    SELECT date(created_at) AS day, telegram_id, endpoint,
+           COUNT(*),
+           COALESCE(SUM(CASE WHEN source = 'gemini' THEN 1 ELSE 0 END), 0),
+           COALESCE(SUM(prompt_tokens), 0),
+           COALESCE(SUM(image_tokens), 0),
+           COALESCE(SUM(output_tokens), 0),
+           COALESCE(SUM(total_tokens), 0),
+           COALESCE(SUM(cost_usd), 0),
+           AVG(CASE WHEN source = 'gemini' THEN gemini_latency_ms END),
+           MAX(gemini_latency_ms),
+           AVG(total_latency_ms),
+           COALESCE(SUM(abandoned_calls), 0)
+    FROM consultation_usage
+"""
+_USAGE_ROLLUP_ORDER = """
+    GROUP BY date(created_at), telegram_id, endpoint
+    ORDER BY day DESC, SUM(cost_usd) DESC
+    LIMIT ?
+"""
+
+register_statement('usage_rollup', STATEMENT_READ,
+                   _USAGE_ROLLUP_COLUMNS + "WHERE created_at >= ?" + _USAGE_ROLLUP_ORDER)
+
+register_statement('usage_rollup_for_user', STATEMENT_READ,
+                   _USAGE_ROLLUP_COLUMNS + "WHERE created_at >= ? AND telegram_id = ?" + _USAGE_ROLLUP_ORDER)
+
+# Итоги за период отдельным запросом: сводка выше обрезана LIMIT
+_USAGE_TOTALS_COLUMNS = """
+    SELECT COUNT(*),
+           COALESCE(SUM(CASE WHEN source = 'gemini' THEN 1 ELSE 0 END), 0),
+           COALESCE(SUM(total_tokens), 0),
+           COALESCE(SUM(cost_usd), 0),
+           COALESCE(SUM(abandoned_calls), 0)
+    FROM consultation_usage
+"""
+
+register_statement('usage_totals', STATEMENT_READ,
+                   _USAGE_TOTALS_COLUMNS + "WHERE created_at >= ?")
+
+register_statement('usage_totals_for_user', STATEMENT_READ,
+                   _USAGE_TOTALS_COLUMNS + "WHERE created_at >= ? AND telegram_id = ?")
+
+# --- Статистика ---
+
+register_statement('service_stats', STATEMENT_READ, """
+    SELECT (SELECT COUNT(*) FROM users),
+           c.total,
+           c.daily,
+           (SELECT COUNT(*) FROM payments WHERE status = 'succeeded')
+    FROM (
+        SELECT COUNT(*) AS total,
+               COALESCE(SUM(CASE WHEN created_at >= datetime('now', '-1 day') THEN 1 ELSE 0 END), 0) AS daily
+        FROM consultations
+    ) c
+""", postgres_sql="""
+    SELECT (SELECT COUNT(*) FROM users),
+           c.total,
+           c.daily,
+           (SELECT COUNT(*) FROM payments WHERE status = 'succeeded')
+    FROM (
+        SELECT COUNT(*) AS total,
+               COUNT(*) FILTER (WHERE created_at >= NOW() - INTERVAL '1 day') AS daily
+        FROM consultations
+    ) c
+""")
+
+register_statement('feedback_stats', STATEMENT_READ, """
+    SELECT COUNT(*),
+           COALESCE(SUM(CASE WHEN created_at >= date('now') THEN 1 ELSE 0 END), 0),
+           AVG(character_count),
+           COALESCE(SUM(CASE WHEN feedback_rating = 'positive' THEN 1 ELSE 0 END), 0),
+           COALESCE(SUM(CASE WHEN bonus_awarded = TRUE THEN 1 ELSE 0 END), 0)
+    FROM feedback_submissions
+""", postgres_sql="""
+    SELECT COUNT(*),
+           COUNT(*) FILTER (WHERE created_at >= CURRENT_DATE),
+           AVG(character_count),
+           COUNT(*) FILTER (WHERE feedback_rating = 'positive'),
+           COUNT(*) FILTER (WHERE bonus_awarded = TRUE)
+    FROM feedback_submissions
+""")
+
+
 class MishuraDB:
     """
     🎭 МИШУРА Database Class
@@ -81,153 +1142,102 @@ class MishuraDB:
         self.db_path = db_path
         self.logger = logger
         self.DB_CONFIG = DB_CONFIG
+        self._stats_snapshot = SnapshotCache(STATS_CACHE_TTL)
+        self._feedback_stats_snapshot = SnapshotCache(STATS_CACHE_TTL)
         
-        # Инициализация БД
-        if DB_CONFIG['type'] == 'postgresql':
-            self.logger.info(f"🐘 Инициализация PostgreSQL...")
-            self.init_db()
-        else:
-            if not os.path.exists(self.db_path):
-                self.logger.info(f"🆕 SQLite БД не существует, создаем: {self.db_path}")
-                self.init_db()
-            else:
-                self.logger.info(f"✅ SQLite БД существует: {self.db_path}")
-        
-        # 🆕 СОЗДАНИЕ ТАБЛИЦ ОТЗЫВОВ
-        self.create_feedback_tables()
-        
-        self.logger.info(f"✅ MishuraDB инициализирована")
+        # Схему создает/обновляет init_db() (миграции) один раз при старте,
+        # поэтому создание экземпляра не выполняет DDL
+        self.logger.debug(f"MishuraDB создана: {self.db_path}")
     
     def get_connection(self):
-        """Подключение к базе данных (SQLite или PostgreSQL)"""
-        if DB_CONFIG['type'] == 'postgresql':
-            # PostgreSQL подключение
-            try:
-                conn = psycopg2.connect(DB_CONFIG['url'])
-                return conn
-            except Exception as e:
+        """
+        Подключение к базе данных (SQLite или PostgreSQL) из пула.
+        conn.close() возвращает соединение в пул.
+        """
+        try:
+            return get_pool(self.db_path).acquire()
+        except PoolTimeoutError as e:
+            self.logger.error(f"❌ {e}")
+            raise
+        except Exception as e:
+            if DB_CONFIG['type'] == 'postgresql':
                 self.logger.error(f"❌ Ошибка подключения к PostgreSQL: {e}")
-                raise
-        else:
-            # SQLite подключение (локальная разработка)
-            try:
-                conn = sqlite3.connect(self.db_path, timeout=10)
-                conn.execute("PRAGMA foreign_keys = ON;")
-                return conn
-            except sqlite3.Error as e:
+            else:
                 self.logger.critical(f"❌ Ошибка подключения к SQLite: {e}")
-                raise
-    
-    def create_postgres_schema(self, conn):
-        """Создать схему для PostgreSQL"""
-        cursor = conn.cursor()
-        
-        # Создаем таблицы для PostgreSQL
-        schema_sql = """
-        -- Таблица пользователей
-        CREATE TABLE IF NOT EXISTS users (
-            id SERIAL PRIMARY KEY,
-            telegram_id BIGINT UNIQUE NOT NULL,
-            username TEXT,
-            first_name TEXT,
-            last_name TEXT,
-            balance INTEGER DEFAULT 200,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        );
-
-        -- Таблица консультаций
-        CREATE TABLE IF NOT EXISTS consultations (
-            id SERIAL PRIMARY KEY,
-            user_id INTEGER NOT NULL,
-            occasion TEXT,
-            preferences TEXT,
-            image_path TEXT,
-            advice TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users(id)
-        );
-
-        -- Таблица платежей
-        CREATE TABLE IF NOT EXISTS payments (
-            id SERIAL PRIMARY KEY,
-            payment_id TEXT UNIQUE NOT NULL,
-            yookassa_payment_id TEXT,
-            user_id INTEGER NOT NULL,
-            telegram_id BIGINT NOT NULL,
-            plan_id TEXT NOT NULL,
-            amount DECIMAL(10,2) NOT NULL,
-            currency TEXT DEFAULT 'RUB',
-            status TEXT DEFAULT 'pending',
-            stcoins_amount INTEGER NOT NULL,
-            error_message TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            processed_at TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users(id)
-        );
-
-        -- Таблица гардероба
-        CREATE TABLE IF NOT EXISTS wardrobe (
-            id SERIAL PRIMARY KEY,
-            user_id INTEGER NOT NULL,
-            telegram_file_id TEXT NOT NULL,
-            item_name TEXT,
-            item_tag TEXT,
-            category TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users(id)
-        );
-
-        -- Создаем индексы
-        CREATE INDEX IF NOT EXISTS idx_users_telegram_id ON users(telegram_id);
-        CREATE INDEX IF NOT EXISTS idx_consultations_user_id ON consultations(user_id);
-        CREATE INDEX IF NOT EXISTS idx_payments_telegram_id ON payments(telegram_id);
-        CREATE INDEX IF NOT EXISTS idx_payments_payment_id ON payments(payment_id);
-        CREATE INDEX IF NOT EXISTS idx_payments_yookassa_id ON payments(yookassa_payment_id);
-        CREATE INDEX IF NOT EXISTS idx_wardrobe_user_id ON wardrobe(user_id);
+            raise
+
+    def get_read_connection(self):
         """
-        
-        cursor.execute(schema_sql)
-        conn.commit()
-        self.logger.info("✅ PostgreSQL схема создана")
-    
-    def init_db(self, schema_file_path: str = SCHEMA_FILE) -> bool:
-        """Инициализация базы данных"""
-        
+        Соединение для читающих запросов.
+        SQLite: отдельное read-only соединение (в режиме WAL не мешает записи).
+        PostgreSQL: обычное соединение из пула.
+        """
+        if DB_CONFIG['type'] == 'postgresql' or not SQLITE_PROFILE['read_only_readers']:
+            return self.get_connection()
+        try:
+            return get_pool(self.db_path, read_only=True).acquire()
+        except PoolTimeoutError as e:
+            self.logger.error(f"❌ {e}")
+            raise
+        except sqlite3.Error as e:
+            self.logger.critical(f"❌ Ошибка read-only подключения к SQLite: {e}")
+            raise
+
+    def get_query_stats(self) -> Dict[str, Any]:
+        """Статистика запросов, соединений и пулов для диагностики"""
+        return {
+            **QUERY_STATS.snapshot(),
+            'pools': self.get_pool_stats(),
+            'user_id_cache': USER_ID_CACHE.stats(),
+        }
+
+    def get_pool_stats(self) -> Dict[str, Any]:
+        """Статистика пула соединений"""
+        stats = get_pool(self.db_path).stats()
+        if DB_CONFIG['type'] == 'sqlite' and SQLITE_PROFILE['read_only_readers']:
+            stats['read_pool'] = get_pool(self.db_path, read_only=True).stats()
+        return stats
+
+    def init_db(self) -> bool:
+        """Применить недостающие миграции схемы (migrations.py)"""
+        conn = None
         try:
             conn = self.get_connection()
-            
-            if DB_CONFIG['type'] == 'postgresql':
-                # PostgreSQL
-                self.create_postgres_schema(conn)
+            applied = apply_migrations(conn, DB_CONFIG['type'])
+            if applied:
+                self.logger.info(f"✅ База данных обновлена до версии {applied[-1]} (миграции: {applied})")
             else:
-                # SQLite (существующий код)
-                cursor = conn.cursor()
-                with open(schema_file_path, 'r', encoding='utf-8') as f:
-                    sql_script = f.read()
-                cursor.executescript(sql_script)
-            
-            conn.commit()
-            conn.close()
-            self.logger.info("✅ База данных инициализирована")
+                self.logger.info(f"✅ Схема базы данных актуальна (версия {LATEST_SCHEMA_VERSION})")
             return True
             
         except Exception as e:
             self.logger.error(f"❌ Ошибка инициализации БД: {e}")
             return False
+        finally:
+            if conn:
+                conn.close()
+
+    def get_schema_version(self) -> int:
+        """Версия схемы из таблицы schema_version"""
+        conn = self.get_read_connection()
+        try:
+            return get_schema_version(conn.cursor())
+        finally:
+            conn.close()
 
     def _execute_query(self, query: str, params=None, fetch_one=False, fetch_all=False):
-        """Универсальный метод выполнения запросов"""
+        """Универсальный метод выполнения произвольных запросов (для именованных - _execute_statement)"""
+        pg_query, is_select, is_write, needs_last_id = _analyze_adhoc_query(query)
+        is_postgres = DB_CONFIG['type'] == 'postgresql'
+        if is_postgres and params:
+            # PostgreSQL использует %s вместо ?
+            query = pg_query
+
+        conn = None
         try:
-            conn = self.get_connection()
+            conn = self.get_read_connection() if is_select else self.get_connection()
             cursor = conn.cursor()
             
-            # Адаптируем параметры для PostgreSQL
-            if DB_CONFIG['type'] == 'postgresql' and params:
-                # PostgreSQL использует %s вместо ?
-                query = query.replace('?', '%s')
-            
             if params:
                 cursor.execute(query, params)
             else:
@@ -239,11 +1249,11 @@ class MishuraDB:
             elif fetch_all:
                 result = cursor.fetchall()
             
-            if query.strip().upper().startswith(('INSERT', 'UPDATE', 'DELETE')):
+            if is_write:
                 conn.commit()
-                if query.strip().upper().startswith('INSERT') and 'RETURNING' not in query.upper():
+                if needs_last_id:
                     # Получаем ID последней вставленной записи
-                    if DB_CONFIG['type'] == 'postgresql':
+                    if is_postgres:
                         try:
                             cursor.execute("SELECT LASTVAL()")
                             result = cursor.fetchone()[0]
@@ -253,36 +1263,107 @@ class MishuraDB:
                     else:
                         result = cursor.lastrowid
             
-            conn.close()
             return result
             
         except Exception as e:
             self.logger.error(f"❌ Ошибка выполнения запроса: {e}")
-            if 'conn' in locals():
+            if conn:
                 conn.rollback()
+            raise
+        finally:
+            if conn:
                 conn.close()
+
+    def _execute_returning(self, query: str, params=None):
+        """Выполнить изменяющий запрос с RETURNING и вернуть первую строку результата"""
+        conn = None
+        try:
+            conn = self.get_connection()
+            cursor = conn.cursor()
+            cursor.execute(query, params or ())
+            row = cursor.fetchone()
+            conn.commit()
+            return row
+        except Exception as e:
+            self.logger.error(f"❌ Ошибка выполнения запроса: {e}")
+            if conn:
+                conn.rollback()
+            raise
+        finally:
+            if conn:
+                conn.close()
+
+    def _run_statement(self, cursor, statement: Statement, params):
+        """Выполнить именованный запрос на курсоре с учетом диалекта"""
+        if DB_CONFIG['type'] != 'postgresql':
+            cursor.execute(statement.sqlite_sql, params or ())
+            return
+
+        if not DB_PG_PREPARED_STATEMENTS:
+            cursor.execute(statement.pg_sql, params or None)
+            return
+
+        # PREPARE не откатывается вместе с транзакцией, поэтому имя помечается
+        # подготовленным только после успешного выполнения
+        prepared = getattr(cursor.connection, 'prepared_statements', None)
+        if prepared is not None and statement.name not in prepared:
+            cursor.execute(f"PREPARE mishura_{statement.name} AS {statement.pg_prepare_sql}")
+            prepared.add(statement.name)
+        if prepared is None:
+            cursor.execute(statement.pg_sql, params or None)
+        else:
+            cursor.execute(statement.pg_execute_sql, statement.pg_values(params))
+
+    def _execute_statement(self, name: str, params=(), fetch_one=False, fetch_all=False):
+        """
+        Выполнить именованный запрос из реестра STATEMENTS.
+        read - на read-соединении; write - возвращает rowcount; returning - строку/строки результата.
+        """
+        statement = STATEMENTS[name]
+        is_read = statement.kind == STATEMENT_READ
+
+        conn = None
+        try:
+            conn = self.get_read_connection() if is_read else self.get_connection()
+            cursor = conn.cursor()
+            self._run_statement(cursor, statement, params)
+
+            if fetch_all:
+                result = cursor.fetchall()
+            elif fetch_one or statement.kind == STATEMENT_RETURNING:
+                result = cursor.fetchone()
+            else:
+                result = cursor.rowcount
+
+            if not is_read:
+                conn.commit()
+            return result
+
+        except Exception as e:
+            self.logger.error(f"❌ Ошибка выполнения запроса {name}: {e}")
+            if conn:
+                conn.rollback()
             raise
+        finally:
+            if conn:
+                conn.close()
 
     # --- ФУНКЦИИ ДЛЯ РАБОТЫ С ПОЛЬЗОВАТЕЛЯМИ ---
     
     def get_user_by_telegram_id(self, telegram_id):
         """Получить пользователя по telegram_id"""
         try:
-            query = """
-                SELECT id, telegram_id, username, first_name, last_name, created_at
-                FROM users 
-                WHERE telegram_id = ?
-            """
-            user = self._execute_query(query, (telegram_id,), fetch_one=True)
+            user = self._execute_statement('user_by_telegram_id', (telegram_id,), fetch_one=True)
             
             if user:
+                USER_ID_CACHE.put(telegram_id, user[0])
                 return {
                     'id': user[0],
                     'telegram_id': user[1], 
                     'username': user[2],
                     'first_name': user[3],
                     'last_name': user[4],
-                    'created_at': user[5]
+                    'created_at': user[6]
                 }
             return None
             
@@ -290,69 +1371,74 @@ class MishuraDB:
             self.logger.error(f"Ошибка получения пользователя {telegram_id}: {str(e)}")
             return None
 
+    def get_internal_user_id(self, telegram_id: int) -> Optional[int]:
+        """Внутренний users.id по telegram_id (через кеш USER_ID_CACHE)"""
+        user_id = USER_ID_CACHE.get(telegram_id)
+        if user_id is not None:
+            return user_id
+        row = self._execute_statement('user_id_by_telegram_id', (telegram_id,), fetch_one=True)
+        if not row:
+            return None
+        USER_ID_CACHE.put(telegram_id, row[0])
+        return row[0]
+
     def save_user(self, telegram_id, username=None, first_name=None, last_name=None, initial_balance=200):
         """Сохранить пользователя, возвращает user_id"""
+        user_id, balance = self.upsert_user(telegram_id, username, first_name, last_name, initial_balance)
+        self.logger.info(f"Пользователь сохранен: ID={user_id}, telegram_id={telegram_id}, баланс={balance}")
+        return user_id
+
+    def upsert_user(self, telegram_id, username=None, first_name=None, last_name=None,
+                    initial_balance=200) -> tuple:
+        """
+        Создать или обновить пользователя одним запросом INSERT ... ON CONFLICT DO UPDATE.
+        Профиль перезаписывается (и меняется updated_at) только если данные действительно изменились.
+        Возвращает (user_id, balance).
+        """
+        params = {
+            'telegram_id': telegram_id,
+            'username': username,
+            'first_name': first_name,
+            'last_name': last_name,
+            'new_username': username or 'webapp_user',
+            'new_first_name': first_name or 'WebApp',
+            'new_last_name': last_name or 'User',
+            'balance': initial_balance,
+        }
+
+        conn = None
         try:
-            # Проверяем, существует ли пользователь
-            existing_query = "SELECT id, balance FROM users WHERE telegram_id = ?"
-            existing_user = self._execute_query(existing_query, (telegram_id,), fetch_one=True)
-            
-            if existing_user:
-                # Пользователь существует, обновляем только основную информацию
-                user_id, current_balance = existing_user
-                update_query = """
-                    UPDATE users 
-                    SET username = COALESCE(?, username),
-                        first_name = COALESCE(?, first_name),
-                        last_name = COALESCE(?, last_name),
-                        updated_at = CURRENT_TIMESTAMP
-                    WHERE telegram_id = ?
-                """
-                self._execute_query(update_query, (username, first_name, last_name, telegram_id))
-                self.logger.info(f"Пользователь обновлен: ID={user_id}, telegram_id={telegram_id}, баланс={current_balance}")
-                return user_id
-            else:
-                # Создаем нового пользователя с начальным балансом
-                if DB_CONFIG['type'] == 'postgresql':
-                    insert_query = """
-                    INSERT INTO users (telegram_id, username, first_name, last_name, balance, created_at, updated_at)
-                        VALUES (%s, %s, %s, %s, %s, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
-                        RETURNING id
-                    """
-                    conn = self.get_connection()
-                    cursor = conn.cursor()
-                    cursor.execute(insert_query, (
-                        telegram_id, username or 'webapp_user', first_name or 'WebApp', 
-                        last_name or 'User', initial_balance
-                    ))
-                    user_id = cursor.fetchone()[0]
-                    conn.commit()
-                    conn.close()
-                else:
-                    insert_query = """
-                    INSERT INTO users (telegram_id, username, first_name, last_name, balance, created_at, updated_at)
-                    VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
-                    """
-                    user_id = self._execute_query(insert_query, (
-                        telegram_id, username or 'webapp_user', first_name or 'WebApp', 
-                        last_name or 'User', initial_balance
-                    ))
-                self.logger.info(f"Пользователь создан: ID={user_id}, telegram_id={telegram_id}, баланс={initial_balance}")
-                return user_id
-                
+            conn = self.get_connection()
+            cursor = conn.cursor()
+            # На PostgreSQL пустой RETURNING уже закрыт UNION ALL внутри запроса
+            self._run_statement(cursor, STATEMENTS['user_upsert'], params)
+            row = cursor.fetchone()
+            if row is None:
+                # SQLite: профиль не изменился, строка уже есть (соединение то же)
+                self._run_statement(cursor, STATEMENTS['user_id_balance'], (telegram_id,))
+                row = cursor.fetchone()
+            conn.commit()
+            USER_ID_CACHE.put(telegram_id, row[0])
+            return row[0], row[1]
+
         except Exception as e:
             self.logger.error(f"Ошибка сохранения пользователя telegram_id={telegram_id}: {e}")
+            if conn:
+                conn.rollback()
             raise
+        finally:
+            if conn:
+                conn.close()
 
     def get_user(self, telegram_id: int) -> Optional[Dict[str, Any]]:
         """Получает информацию о пользователе по его telegram_id"""
         self.logger.debug(f"Запрос информации о пользователе: telegram_id={telegram_id}")
         
         try:
-            query = 'SELECT id, telegram_id, username, first_name, last_name, balance, created_at FROM users WHERE telegram_id = ?'
-            user_row = self._execute_query(query, (telegram_id,), fetch_one=True)
+            user_row = self._execute_statement('user_by_telegram_id', (telegram_id,), fetch_one=True)
             
             if user_row:
+                USER_ID_CACHE.put(telegram_id, user_row[0])
                 user_dict = {
                     'id': user_row[0],
                     'telegram_id': user_row[1],
@@ -371,43 +1457,44 @@ class MishuraDB:
         except Exception as e:
             self.logger.error(f"Ошибка при получении пользователя telegram_id={telegram_id}: {e}", exc_info=True)
         return None
-        
+
     def get_user_balance(self, telegram_id: int) -> int:
-        """Получает текущий баланс консультаций пользователя"""
+        """
+        Получает текущий баланс консультаций пользователя.
+        Незнакомый пользователь создается с начальным балансом в том же запросе.
+        """
         self.logger.debug(f"Запрос баланса для пользователя: telegram_id={telegram_id}")
         
+        initial_balance = 200
+        params = {'telegram_id': telegram_id, 'balance': initial_balance}
         try:
-            query = 'SELECT balance FROM users WHERE telegram_id = ?'
-            result = self._execute_query(query, (telegram_id,), fetch_one=True)
-            
-            if result:
-                balance = result[0]
-                self.logger.info(f"Баланс для пользователя telegram_id={telegram_id} составляет: {balance}")
-                return balance
+            if DB_CONFIG['type'] == 'postgresql':
+                result = self._execute_statement('user_balance_or_create', params)
             else:
-                # Пользователь не найден, создаем с начальным балансом
-                self.logger.warning(f"Пользователь telegram_id={telegram_id} не найден при запросе баланса")
-                
-                # Создаем пользователя с начальным балансом 200 STCoins
-                initial_balance = 200
-                user_id = self.save_user(
-                    telegram_id=telegram_id,
-                    username='webapp_user',
-                    first_name='WebApp',
-                    last_name='User',
-                    initial_balance=initial_balance
-                )
-                
-                if user_id:
-                    self.logger.info(f"Создан новый пользователь telegram_id={telegram_id} с начальным балансом {initial_balance}")
-                    return initial_balance
+                result = self._execute_statement('user_balance', (telegram_id,), fetch_one=True)
+                if result:
+                    result = (result[0], False)
                 else:
-                    return 0
+                    result = self._execute_statement('user_balance_or_create', params)
+
+            if not result:
+                # Пользователя создал параллельный запрос - читаем заново
+                result = self._execute_statement('user_balance', (telegram_id,), fetch_one=True)
+                result = (result[0], False) if result else None
+            if not result:
+                return 0
+
+            balance, created = result
+            if created:
+                self.logger.info(f"Создан новый пользователь telegram_id={telegram_id} с начальным балансом {balance}")
+            else:
+                self.logger.info(f"Баланс для пользователя telegram_id={telegram_id} составляет: {balance}")
+            return balance
                     
         except Exception as e:
             self.logger.error(f"Ошибка при получении баланса пользователя telegram_id={telegram_id}: {e}", exc_info=True)
         return 0
-        
+
     def update_user_balance(self, telegram_id: int, amount_change: int, operation_type="manual") -> int:
         """Обновляет баланс пользователя на указанную величину"""
         try:
@@ -416,13 +1503,7 @@ class MishuraDB:
             new_balance = current_balance + amount_change
             
             # Обновляем баланс
-            update_query = """
-                UPDATE users 
-                SET balance = ?, updated_at = CURRENT_TIMESTAMP
-                WHERE telegram_id = ?
-            """
-            
-            result = self._execute_query(update_query, (new_balance, telegram_id))
+            self._execute_statement('user_set_balance', (new_balance, telegram_id))
             
             self.logger.info(f"Баланс пользователя {telegram_id} обновлен: {current_balance} {'+' if amount_change >= 0 else ''}{amount_change} = {new_balance} ({operation_type})")
             
@@ -435,40 +1516,39 @@ class MishuraDB:
     # --- ФУНКЦИИ ДЛЯ РАБОТЫ С КОНСУЛЬТАЦИЯМИ ---
     
     def save_consultation(self, user_id: int, occasion: Optional[str], preferences: Optional[str], image_path: Optional[str], advice: Optional[str]) -> Optional[int]:
-        """Сохраняет новую консультацию в базу данных"""
+        """
+        Сохраняет новую консультацию в базу данных одним запросом.
+        user_id - это telegram_id: внутренний users.id берется из кеша,
+        а при промахе определяется внутри самого INSERT ... SELECT.
+        """
         self.logger.info(f"Сохранение консультации для user_id={user_id}, повод: {occasion}")
         
+        telegram_id = user_id
         try:
-            # ИСПРАВЛЕНИЕ: user_id теперь это telegram_id, получаем правильный internal ID
-            user_query = "SELECT id FROM users WHERE telegram_id = ?"
-            user_row = self._execute_query(user_query, (user_id,), fetch_one=True)
-            
-            if not user_row:
-                self.logger.error(f"Пользователь с telegram_id={user_id} не найден")
+            internal_user_id = USER_ID_CACHE.get(telegram_id)
+            row = None
+            
+            if internal_user_id is not None:
+                try:
+                    row = self._execute_statement('consultation_insert',
+                                                  (internal_user_id, occasion, preferences, image_path, advice))
+                except Exception as e:
+                    # Устаревшая запись кеша (например, БД пересоздана) - повторяем через users
+                    self.logger.warning(f"Кеш users.id для telegram_id={telegram_id} устарел: {e}")
+                    USER_ID_CACHE.discard(telegram_id)
+            
+            if row is None:
+                row = self._execute_statement('consultation_insert_by_telegram_id',
+                                              (occasion, preferences, image_path, advice, telegram_id))
+            
+            if not row:
+                self.logger.error(f"Пользователь с telegram_id={telegram_id} не найден")
                 return None
             
-            internal_user_id = user_row[0]
+            consultation_id, internal_user_id = row
+            USER_ID_CACHE.put(telegram_id, internal_user_id)
             
-            if DB_CONFIG['type'] == 'postgresql':
-                consultation_query = '''
-                INSERT INTO consultations (user_id, occasion, preferences, image_path, advice, created_at)
-                VALUES (%s, %s, %s, %s, %s, CURRENT_TIMESTAMP)
-                RETURNING id
-                '''
-                conn = self.get_connection()
-                cursor = conn.cursor()
-                cursor.execute(consultation_query, (internal_user_id, occasion, preferences, image_path, advice))
-                consultation_id = cursor.fetchone()[0]
-                conn.commit()
-                conn.close()
-            else:
-                consultation_query = '''
-                INSERT INTO consultations (user_id, occasion, preferences, image_path, advice, created_at)
-                VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
-                '''
-                consultation_id = self._execute_query(consultation_query, (internal_user_id, occasion, preferences, image_path, advice))
-            
-            self.logger.info(f"Консультация для telegram_id={user_id} (internal_id={internal_user_id}) успешно сохранена с ID={consultation_id}.")
+            self.logger.info(f"Консультация для telegram_id={telegram_id} (internal_id={internal_user_id}) успешно сохранена с ID={consultation_id}.")
             return consultation_id
         except Exception as e:
             self.logger.error(f"Ошибка при сохранении консультации для user_id={user_id}: {e}", exc_info=True)
@@ -480,13 +1560,10 @@ class MishuraDB:
         
         try:
             if user_id:
-                query = 'SELECT * FROM consultations WHERE id = ? AND user_id = ?'
-                params = (consultation_id, user_id)
+                consultation_row = self._execute_statement('consultation_by_id_and_user',
+                                                           (consultation_id, user_id), fetch_one=True)
             else:
-                query = 'SELECT * FROM consultations WHERE id = ?'
-                params = (consultation_id,)
-            
-            consultation_row = self._execute_query(query, params, fetch_one=True)
+                consultation_row = self._execute_statement('consultation_by_id', (consultation_id,), fetch_one=True)
             
             if consultation_row:
                 consultation_dict = {
@@ -510,15 +1587,7 @@ class MishuraDB:
     def get_user_consultations(self, user_id: int, limit: int = 20):
         """Получить консультации пользователя"""
         try:
-            query = """
-                SELECT id, user_id, occasion, preferences, image_path, advice, created_at
-                FROM consultations 
-                WHERE user_id = ? 
-                ORDER BY created_at DESC 
-                LIMIT ?
-            """
-            
-            consultations = self._execute_query(query, (user_id, limit), fetch_all=True)
+            consultations = self._execute_statement('consultations_by_user', (user_id, limit), fetch_all=True)
             
             self.logger.info(f"📚 Получено {len(consultations)} консультаций для пользователя {user_id}")
             return consultations
@@ -527,6 +1596,35 @@ class MishuraDB:
             self.logger.error(f"❌ Ошибка получения консультаций для пользователя {user_id}: {e}")
             return []
 
+    def get_user_consultations_page(self, user_id: int, limit: int = 20,
+                                    cursor: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Страница истории консультаций (новые сначала) без текста advice.
+        user_id - внутренний users.id; cursor - next_cursor предыдущей страницы.
+        Время выборки не зависит от номера страницы (keyset вместо OFFSET).
+        """
+        limit = max(1, min(limit, 100))
+        if cursor:
+            created_at, last_id = decode_page_cursor(cursor)
+            rows = self._execute_statement('consultations_page_after',
+                                           (user_id, created_at, last_id, limit + 1), fetch_all=True)
+        else:
+            rows = self._execute_statement('consultations_page_first', (user_id, limit + 1), fetch_all=True)
+
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        items = [{
+            'id': row[0],
+            'occasion': row[1],
+            'preferences': row[2],
+            'image_path': row[3],
+            'created_at': row[4]
+        } for row in rows]
+
+        next_cursor = encode_page_cursor(rows[-1][4], rows[-1][0]) if has_more else None
+        self.logger.info(f"📚 Страница истории: {len(items)} консультаций для пользователя {user_id}")
+        return {'items': items, 'next_cursor': next_cursor}
+
     # === ФУНКЦИИ ДЛЯ РАБОТЫ С ПЛАТЕЖАМИ ===
 
     def save_payment(self, payment_id: str, user_id: int, telegram_id: int, 
@@ -534,14 +1632,7 @@ class MishuraDB:
                     status: str = 'pending') -> bool:
         """Сохранить платеж в базу данных"""
         try:
-            query = """
-                INSERT INTO payments (
-                    payment_id, user_id, telegram_id, plan_id, 
-                    amount, stcoins_amount, status, created_at, updated_at
-                ) VALUES (?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
-            """
-            
-            self._execute_query(query, (
+            self._execute_statement('payment_insert', (
                 payment_id, user_id, telegram_id, plan_id,
                 amount, stcoins_amount, status
             ))
@@ -556,13 +1647,7 @@ class MishuraDB:
     def update_payment_yookassa_id(self, payment_id: str, yookassa_payment_id: str) -> bool:
         """Обновить ID платежа от ЮKassa"""
         try:
-            query = """
-                UPDATE payments 
-                SET yookassa_payment_id = ?, updated_at = CURRENT_TIMESTAMP
-                WHERE payment_id = ?
-            """
-            
-            self._execute_query(query, (yookassa_payment_id, payment_id))
+            self._execute_statement('payment_set_yookassa_id', (yookassa_payment_id, payment_id))
             
             self.logger.info(f"🔄 Обновлен YooKassa ID: {payment_id} -> {yookassa_payment_id}")
             return True
@@ -576,21 +1661,9 @@ class MishuraDB:
         """Обновить статус платежа"""
         try:
             if error_message:
-                query = """
-                    UPDATE payments 
-                    SET status = ?, error_message = ?, updated_at = CURRENT_TIMESTAMP
-                    WHERE payment_id = ?
-                """
-                params = (status, error_message, payment_id)
+                self._execute_statement('payment_set_status_with_error', (status, error_message, payment_id))
             else:
-                query = """
-                    UPDATE payments 
-                    SET status = ?, updated_at = CURRENT_TIMESTAMP
-                    WHERE payment_id = ?
-                """
-                params = (status, payment_id)
-            
-            self._execute_query(query, params)
+                self._execute_statement('payment_set_status', (status, payment_id))
             
             if error_message:
                 self.logger.error(f"💳 Статус платежа {payment_id}: {status} - {error_message}")
@@ -606,15 +1679,7 @@ class MishuraDB:
     def get_payment_by_yookassa_id(self, yookassa_payment_id: str) -> Optional[Dict[str, Any]]:
         """Получить платеж по ID ЮKassa"""
         try:
-            query = """
-                SELECT payment_id, user_id, telegram_id, plan_id, amount, 
-                       stcoins_amount, status, yookassa_payment_id, 
-                       created_at, updated_at, processed_at
-                FROM payments 
-                WHERE yookassa_payment_id = ?
-            """
-            
-            payment_row = self._execute_query(query, (yookassa_payment_id,), fetch_one=True)
+            payment_row = self._execute_statement('payment_by_yookassa_id', (yookassa_payment_id,), fetch_one=True)
             
             if payment_row:
                 return {
@@ -640,23 +1705,9 @@ class MishuraDB:
         """Получить статус платежа"""
         try:
             if telegram_id:
-                query = """
-                    SELECT payment_id, yookassa_payment_id, status, amount, 
-                           stcoins_amount, created_at, processed_at, error_message
-                    FROM payments 
-                    WHERE payment_id = ? AND telegram_id = ?
-                """
-                params = (payment_id, telegram_id)
+                payment_row = self._execute_statement('payment_status_for_user', (payment_id, telegram_id), fetch_one=True)
             else:
-                query = """
-                    SELECT payment_id, yookassa_payment_id, status, amount, 
-                           stcoins_amount, created_at, processed_at, error_message
-                    FROM payments 
-                    WHERE payment_id = ?
-                """
-                params = (payment_id,)
-            
-            payment_row = self._execute_query(query, params, fetch_one=True)
+                payment_row = self._execute_statement('payment_status', (payment_id,), fetch_one=True)
             
             if payment_row:
                 return {
@@ -678,13 +1729,7 @@ class MishuraDB:
     def mark_payment_processed(self, payment_id: str) -> bool:
         """Отметить платеж как обработанный"""
         try:
-            query = """
-                UPDATE payments 
-                SET status = 'succeeded', processed_at = CURRENT_TIMESTAMP, updated_at = CURRENT_TIMESTAMP
-                WHERE payment_id = ?
-            """
-            
-            self._execute_query(query, (payment_id,))
+            self._execute_statement('payment_mark_processed', (payment_id,))
             
             self.logger.info(f"✅ Платеж отмечен как обработанный: {payment_id}")
             return True
@@ -693,19 +1738,18 @@ class MishuraDB:
             self.logger.error(f"❌ Ошибка отметки платежа как обработанного {payment_id}: {e}")
             return False
 
+    def is_paying_user(self, telegram_id: int) -> bool:
+        """Есть ли у пользователя успешная оплата (приоритет в очереди Gemini)"""
+        try:
+            return self._execute_statement('payments_user_has_succeeded', (telegram_id,), fetch_one=True) is not None
+        except Exception as e:
+            self.logger.error(f"❌ Ошибка проверки оплат пользователя {telegram_id}: {e}")
+            return False
+
     def get_pending_payments(self, limit: int = 50) -> List[Dict[str, Any]]:
         """Получить ожидающие платежи для recovery"""
         try:
-            query = """
-                SELECT payment_id, yookassa_payment_id, telegram_id, stcoins_amount, created_at
-                FROM payments 
-                WHERE status = 'pending' 
-                AND yookassa_payment_id IS NOT NULL
-                ORDER BY created_at DESC 
-                LIMIT ?
-            """
-            
-            payments = self._execute_query(query, (limit,), fetch_all=True)
+            payments = self._execute_statement('payments_pending', (limit,), fetch_all=True)
             
             result = []
             for payment in payments:
@@ -724,8 +1768,86 @@ class MishuraDB:
             self.logger.error(f"❌ Ошибка получения ожидающих платежей: {e}")
             return []
 
+    # --- КЕШ АНАЛИЗОВ GEMINI ---
+
+    def get_cached_analysis(self, cache_key: str) -> Optional[str]:
+        """Непросроченный результат анализа по ключу кеша"""
+        row = self._execute_statement('analysis_cache_get', (cache_key, int(time.time())), fetch_one=True)
+        return row[0] if row else None
+
+    def save_cached_analysis(self, cache_key: str, kind: str, advice: str, ttl_seconds: int) -> bool:
+        """Сохранить результат анализа на ttl_seconds секунд"""
+        self._execute_statement('analysis_cache_put', (cache_key, kind, advice, int(time.time()) + int(ttl_seconds)))
+        return True
+
+    def purge_analysis_cache(self) -> int:
+        """Удалить просроченные записи кеша анализов, возвращает их число"""
+        deleted = self._execute_statement('analysis_cache_purge', (int(time.time()),))
+        if deleted:
+            self.logger.info(f"🧹 Удалено просроченных записей кеша анализов: {deleted}")
+        return deleted
+
+    # --- УЧЕТ ТОКЕНОВ И СТОИМОСТИ GEMINI ---
+
+    def save_consultation_usage(self, consultation_id: Optional[int], telegram_id: int,
+                                endpoint: str, usage: Dict[str, Any]) -> bool:
+        """Сохранить учет токенов, задержки и стоимости консультации (usage из gemini_ai)"""
+        try:
+            self._execute_statement('usage_insert', (
+                consultation_id, telegram_id, endpoint, usage.get('source', 'gemini'), usage.get('model'),
+                usage.get('images', 0), usage.get('prompt_tokens', 0), usage.get('image_tokens', 0),
+                usage.get('output_tokens', 0), usage.get('total_tokens', 0),
+                bool(usage.get('tokens_estimated')), usage.get('attempts', 0), usage.get('abandoned_calls', 0),
+                usage.get('gemini_latency_ms'), usage.get('total_latency_ms'), usage.get('cost_usd', 0.0)
+            ))
+            return True
+        except Exception as e:
+            self.logger.error(f"❌ Ошибка сохранения учета токенов консультации {consultation_id}: {e}")
+            return False
+
+    def get_usage_rollup(self, days: int = 7, telegram_id: Optional[int] = None,
+                         limit: int = 500) -> List[Dict[str, Any]]:
+        """Токены, стоимость и задержки по дням, пользователям и endpoint'ам за последние days дней"""
+        since = (datetime.utcnow() - timedelta(days=days)).strftime('%Y-%m-%d %H:%M:%S')
+        if telegram_id is None:
+            rows = self._execute_statement('usage_rollup', (since, limit), fetch_all=True)
+        else:
+            rows = self._execute_statement('usage_rollup_for_user', (since, telegram_id, limit), fetch_all=True)
+        return [{
+            'day': str(row[0]),
+            'telegram_id': row[1],
+            'endpoint': row[2],
+            'consultations': row[3],
+            'gemini_calls': row[4],
+            'prompt_tokens': row[5],
+            'image_tokens': row[6],
+            'output_tokens': row[7],
+            'total_tokens': row[8],
+            'cost_usd': round(float(row[9]), 6),
+            'avg_gemini_latency_ms': round(float(row[10])) if row[10] is not None else None,
+            'max_gemini_latency_ms': row[11],
+            'avg_total_latency_ms': round(float(row[12])) if row[12] is not None else None,
+            'abandoned_calls': row[13],
+        } for row in rows]
+
+    def get_usage_totals(self, days: int = 7, telegram_id: Optional[int] = None) -> Dict[str, Any]:
+        """Итоги токенов и стоимости Gemini за последние days дней (без ограничения числа групп)"""
+        since = (datetime.utcnow() - timedelta(days=days)).strftime('%Y-%m-%d %H:%M:%S')
+        if telegram_id is None:
+            row = self._execute_statement('usage_totals', (since,), fetch_one=True)
+        else:
+            row = self._execute_statement('usage_totals_for_user', (since, telegram_id), fetch_one=True)
+        row = row or (0, 0, 0, 0, 0)
+        return {
+            'consultations': row[0],
+            'gemini_calls': row[1],
+            'total_tokens': row[2],
+            'cost_usd': round(float(row[3]), 6),
+            'abandoned_calls': row[4],
+        }
+
     def get_stats(self) -> Dict[str, int]:
-        """Получает общую статистику сервиса МИШУРА"""
+        """Получает общую статистику сервиса МИШУРА (снимок обновляется раз в STATS_CACHE_TTL)"""
         self.logger.debug("Запрос общей статистики сервиса.")
         stats = {
             'total_users': 0,
@@ -734,126 +1856,22 @@ class MishuraDB:
             'total_payments_completed': 0
         }
         try:
-            stats['total_users'] = self._execute_query('SELECT COUNT(*) FROM users', fetch_one=True)[0]
-            stats['total_consultations'] = self._execute_query('SELECT COUNT(*) FROM consultations', fetch_one=True)[0]
-            
-            if DB_CONFIG['type'] == 'postgresql':
-                daily_query = "SELECT COUNT(*) FROM consultations WHERE created_at >= NOW() - INTERVAL '1 day'"
-            else:
-                daily_query = "SELECT COUNT(*) FROM consultations WHERE created_at >= datetime('now', '-1 day')"
-            
-            stats['daily_consultations'] = self._execute_query(daily_query, fetch_one=True)[0]
-            
-            # Добавляем статистику платежей
-            try:
-                stats['total_payments_completed'] = self._execute_query(
-                    "SELECT COUNT(*) FROM payments WHERE status = 'succeeded'", fetch_one=True
-                )[0]
-            except:
-                stats['total_payments_completed'] = 0
-                
-            self.logger.info(f"Статистика сервиса МИШУРА получена: {stats}")
+            stats = self._stats_snapshot.get(self._load_stats)
         except Exception as e:
             self.logger.error(f"Ошибка при получении статистики: {e}", exc_info=True)
-        return stats
+        return dict(stats)
 
-    def create_feedback_tables(self):
-        """Создание таблиц для системы отзывов"""
-        try:
-            conn = self.get_connection()
-            cursor = conn.cursor()
-            
-            if self.DB_CONFIG['type'] == 'postgresql':
-                # PostgreSQL схема
-                feedback_schema = """
-                -- Таблица отзывов пользователей
-                CREATE TABLE IF NOT EXISTS feedback_submissions (
-                    id SERIAL PRIMARY KEY,
-                    telegram_id BIGINT NOT NULL,
-                    feedback_text TEXT NOT NULL,
-                    feedback_rating VARCHAR(10) DEFAULT 'positive',
-                    character_count INTEGER NOT NULL,
-                    consultation_id INTEGER,
-                    ip_address VARCHAR(45),
-                    user_agent TEXT,
-                    google_sheets_synced BOOLEAN DEFAULT FALSE,
-                    google_sheets_row_id VARCHAR(50),
-                    bonus_awarded BOOLEAN DEFAULT FALSE,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (consultation_id) REFERENCES consultations(id)
-                );
-
-                -- Таблица отслеживания показов форм
-                CREATE TABLE IF NOT EXISTS feedback_prompts (
-                    id SERIAL PRIMARY KEY,
-                    telegram_id BIGINT NOT NULL,
-                    consultation_id INTEGER NOT NULL,
-                    prompt_shown_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    user_action VARCHAR(20) DEFAULT 'shown',
-                    dismissal_reason VARCHAR(50),
-                    FOREIGN KEY (consultation_id) REFERENCES consultations(id)
-                );
-
-                -- Индексы
-                CREATE INDEX IF NOT EXISTS idx_feedback_telegram_id ON feedback_submissions(telegram_id);
-                CREATE INDEX IF NOT EXISTS idx_feedback_created_at ON feedback_submissions(created_at);
-                CREATE INDEX IF NOT EXISTS idx_prompts_telegram_user_time ON feedback_prompts(telegram_id, prompt_shown_at);
-                """
-            else:
-                # SQLite схема
-                feedback_schema = """
-                -- Таблица отзывов пользователей
-                CREATE TABLE IF NOT EXISTS feedback_submissions (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    telegram_id INTEGER NOT NULL,
-                    feedback_text TEXT NOT NULL,
-                    feedback_rating TEXT DEFAULT 'positive',
-                    character_count INTEGER NOT NULL,
-                    consultation_id INTEGER,
-                    ip_address TEXT,
-                    user_agent TEXT,
-                    google_sheets_synced INTEGER DEFAULT 0,
-                    google_sheets_row_id TEXT,
-                    bonus_awarded INTEGER DEFAULT 0,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (consultation_id) REFERENCES consultations(id)
-                );
-
-                -- Таблица отслеживания показов форм
-                CREATE TABLE IF NOT EXISTS feedback_prompts (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    telegram_id INTEGER NOT NULL,
-                    consultation_id INTEGER NOT NULL,
-                    prompt_shown_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    user_action TEXT DEFAULT 'shown',
-                    dismissal_reason TEXT,
-                    FOREIGN KEY (consultation_id) REFERENCES consultations(id)
-                );
-
-                -- Индексы
-                CREATE INDEX IF NOT EXISTS idx_feedback_telegram_id ON feedback_submissions(telegram_id);
-                CREATE INDEX IF NOT EXISTS idx_feedback_created_at ON feedback_submissions(created_at);
-                CREATE INDEX IF NOT EXISTS idx_prompts_telegram_user_time ON feedback_prompts(telegram_id, prompt_shown_at);
-                """
-            
-            # Выполняем создание таблиц
-            for statement in feedback_schema.split(';'):
-                statement = statement.strip()
-                if statement:
-                    cursor.execute(statement)
-            
-            conn.commit()
-            conn.close()
-            
-            self.logger.info("✅ Таблицы системы отзывов созданы успешно")
-            return True
-            
-        except Exception as e:
-            self.logger.error(f"❌ Ошибка создания таблиц отзывов: {e}")
-            if 'conn' in locals():
-                conn.rollback()
-                conn.close()
-            return False
+    def _load_stats(self) -> Dict[str, int]:
+        """Общая статистика одним агрегирующим запросом"""
+        row = self._execute_statement('service_stats', fetch_one=True)
+        stats = {
+            'total_users': row[0],
+            'total_consultations': row[1],
+            'daily_consultations': row[2],
+            'total_payments_completed': row[3]
+        }
+        self.logger.info(f"Статистика сервиса МИШУРА получена: {stats}")
+        return stats
 
     def save_feedback_submission(self, telegram_id: int, feedback_text: str, 
                                feedback_rating: str, consultation_id: int = None,
@@ -862,36 +1880,11 @@ class MishuraDB:
         try:
             char_count = len(feedback_text.strip())
             
-            if self.DB_CONFIG['type'] == 'postgresql':
-                query = """
-                    INSERT INTO feedback_submissions 
-                    (telegram_id, feedback_text, feedback_rating, character_count, 
-                     consultation_id, ip_address, user_agent)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s)
-                    RETURNING id
-                """
-                conn = self.get_connection()
-                cursor = conn.cursor()
-                cursor.execute(query, (telegram_id, feedback_text, feedback_rating, 
-                                     char_count, consultation_id, ip_address, user_agent))
-                feedback_id = cursor.fetchone()[0]
-                conn.commit()
-                conn.close()
-            else:
-                # ✅ ИСПРАВЛЕНО: Используем _execute_query() правильно
-                query = """
-                    INSERT INTO feedback_submissions 
-                    (telegram_id, feedback_text, feedback_rating, character_count, 
-                     consultation_id, ip_address, user_agent)
-                    VALUES (?, ?, ?, ?, ?, ?, ?)
-                """
-                
-                # _execute_query для INSERT возвращает lastrowid автоматически
-                feedback_id = self._execute_query(
-                    query, 
-                    (telegram_id, feedback_text, feedback_rating, char_count, 
-                     consultation_id, ip_address, user_agent)
-                )
+            row = self._execute_statement('feedback_insert', (
+                telegram_id, feedback_text, feedback_rating,
+                char_count, consultation_id, ip_address, user_agent
+            ))
+            feedback_id = row[0] if row else None
             
             self.logger.info(f"✅ Отзыв сохранен: ID={feedback_id}, user={telegram_id}, rating={feedback_rating}, chars={char_count}")
             return feedback_id
@@ -905,26 +1898,7 @@ class MishuraDB:
     def can_show_feedback_prompt(self, telegram_id: int) -> bool:
         """Проверить можно ли показать форму отзыва (не чаще раза в 10 дней)"""
         try:
-            if self.DB_CONFIG['type'] == 'postgresql':
-                query = """
-                    SELECT prompt_shown_at 
-                    FROM feedback_prompts 
-                    WHERE telegram_id = %s 
-                    ORDER BY prompt_shown_at DESC 
-                    LIMIT 1
-                """
-                params = (telegram_id,)
-            else:
-                query = """
-                    SELECT prompt_shown_at 
-                    FROM feedback_prompts 
-                    WHERE telegram_id = ? 
-                    ORDER BY prompt_shown_at DESC 
-                    LIMIT 1
-                """
-                params = (telegram_id,)
-            
-            result = self._execute_query(query, params, fetch_one=True)
+            result = self._execute_statement('feedback_last_prompt', (telegram_id,), fetch_one=True)
             
             if not result:
                 return True  # Первый раз показываем
@@ -950,22 +1924,7 @@ class MishuraDB:
                            action: str = 'shown', dismissal_reason: str = None) -> bool:
         """Записать факт показа/действия с формой отзыва"""
         try:
-            if self.DB_CONFIG['type'] == 'postgresql':
-                query = """
-                    INSERT INTO feedback_prompts 
-                    (telegram_id, consultation_id, user_action, dismissal_reason)
-                    VALUES (%s, %s, %s, %s)
-                """
-                params = (telegram_id, consultation_id, action, dismissal_reason)
-            else:
-                query = """
-                    INSERT INTO feedback_prompts 
-                    (telegram_id, consultation_id, user_action, dismissal_reason)
-                    VALUES (?, ?, ?, ?)
-                """
-                params = (telegram_id, consultation_id, action, dismissal_reason)
-            
-            self._execute_query(query, params)
+            self._execute_statement('feedback_prompt_insert', (telegram_id, consultation_id, action, dismissal_reason))
             
             self.logger.info(f"📝 Зафиксировано действие с формой отзыва: user={telegram_id}, action={action}")
             return True
@@ -977,26 +1936,7 @@ class MishuraDB:
     def get_pending_feedback_sync(self, limit: int = 50) -> List[Dict]:
         """Получить отзывы для синхронизации с Google Sheets"""
         try:
-            if self.DB_CONFIG['type'] == 'postgresql':
-                query = """
-                    SELECT id, telegram_id, feedback_text, feedback_rating, 
-                           character_count, created_at, consultation_id
-                    FROM feedback_submissions 
-                    WHERE google_sheets_synced = FALSE 
-                    ORDER BY created_at ASC 
-                    LIMIT %s
-                """
-            else:
-                query = """
-                    SELECT id, telegram_id, feedback_text, feedback_rating, 
-                           character_count, created_at, consultation_id
-                    FROM feedback_submissions 
-                    WHERE google_sheets_synced = 0 
-                    ORDER BY created_at ASC 
-                    LIMIT ?
-                """
-            
-            results = self._execute_query(query, (limit,), fetch_all=True)
+            results = self._execute_statement('feedback_pending_sync', (limit,), fetch_all=True)
             
             feedback_list = []
             for row in results:
@@ -1020,22 +1960,7 @@ class MishuraDB:
     def mark_feedback_synced(self, feedback_id: int, sheets_row_id: str = None) -> bool:
         """Отметить отзыв как синхронизированный с Google Sheets"""
         try:
-            if self.DB_CONFIG['type'] == 'postgresql':
-                query = """
-                    UPDATE feedback_submissions 
-                    SET google_sheets_synced = TRUE, google_sheets_row_id = %s
-                    WHERE id = %s
-                """
-                params = (sheets_row_id, feedback_id)
-            else:
-                query = """
-                    UPDATE feedback_submissions 
-                    SET google_sheets_synced = 1, google_sheets_row_id = ?
-                    WHERE id = ?
-                """
-                params = (sheets_row_id, feedback_id)
-            
-            self._execute_query(query, params)
+            self._execute_statement('feedback_mark_synced', (sheets_row_id, feedback_id))
             
             self.logger.info(f"✅ Отзыв ID={feedback_id} отмечен как синхронизированный")
             return True
@@ -1047,12 +1972,7 @@ class MishuraDB:
     def mark_feedback_bonus_awarded(self, feedback_id: int) -> bool:
         """Отметить что бонус за отзыв начислен"""
         try:
-            if self.DB_CONFIG['type'] == 'postgresql':
-                query = "UPDATE feedback_submissions SET bonus_awarded = TRUE WHERE id = %s"
-            else:
-                query = "UPDATE feedback_submissions SET bonus_awarded = 1 WHERE id = ?"
-            
-            self._execute_query(query, (feedback_id,))
+            self._execute_statement('feedback_mark_bonus_awarded', (feedback_id,))
             
             self.logger.info(f"💰 Бонус за отзыв ID={feedback_id} отмечен как начисленный")
             return True
@@ -1062,66 +1982,84 @@ class MishuraDB:
             return False
 
     def get_feedback_stats(self) -> Dict[str, Any]:
-        """Получить статистику по отзывам"""
+        """Получить статистику по отзывам (снимок обновляется раз в STATS_CACHE_TTL)"""
         try:
-            stats = {}
-            
-            # Общее количество отзывов
-            total_query = "SELECT COUNT(*) FROM feedback_submissions"
-            stats['total_feedback'] = self._execute_query(total_query, fetch_one=True)[0]
-            
-            # Отзывы за сегодня
-            if self.DB_CONFIG['type'] == 'postgresql':
-                today_query = "SELECT COUNT(*) FROM feedback_submissions WHERE created_at >= CURRENT_DATE"
-            else:
-                today_query = "SELECT COUNT(*) FROM feedback_submissions WHERE created_at >= date('now')"
-            
-            stats['feedback_today'] = self._execute_query(today_query, fetch_one=True)[0]
-            
-            # Средняя длина отзывов
-            avg_query = "SELECT AVG(character_count) FROM feedback_submissions"
-            avg_result = self._execute_query(avg_query, fetch_one=True)[0]
-            stats['avg_feedback_length'] = round(avg_result, 1) if avg_result else 0
-            
-            # Процент положительных отзывов
-            if stats['total_feedback'] > 0:
-                positive_query = "SELECT COUNT(*) FROM feedback_submissions WHERE feedback_rating = 'positive'"
-                positive_count = self._execute_query(positive_query, fetch_one=True)[0]
-                stats['positive_feedback_percent'] = round((positive_count / stats['total_feedback']) * 100, 1)
-            else:
-                stats['positive_feedback_percent'] = 0
-            
-            # Количество начисленных бонусов
-            if self.DB_CONFIG['type'] == 'postgresql':
-                bonus_query = "SELECT COUNT(*) FROM feedback_submissions WHERE bonus_awarded = TRUE"
-            else:
-                bonus_query = "SELECT COUNT(*) FROM feedback_submissions WHERE bonus_awarded = 1"
-            
-            stats['bonuses_awarded'] = self._execute_query(bonus_query, fetch_one=True)[0]
-            
-            return stats
+            return dict(self._feedback_stats_snapshot.get(self._load_feedback_stats))
             
         except Exception as e:
             self.logger.error(f"❌ Ошибка получения статистики отзывов: {e}")
             return {}
 
+    def _load_feedback_stats(self) -> Dict[str, Any]:
+        """Статистика отзывов одним запросом с условной агрегацией"""
+        total, today, avg_length, positive, bonuses = self._execute_statement('feedback_stats', fetch_one=True)
+        return {
+            'total_feedback': total,
+            'feedback_today': today,
+            'avg_feedback_length': round(float(avg_length), 1) if avg_length else 0,
+            'positive_feedback_percent': round((positive / total) * 100, 1) if total > 0 else 0,
+            'bonuses_awarded': bonuses,
+        }
+
+class AsyncMishuraDB:
+    """
+    ⚡ Асинхронный слой базы данных для FastAPI
+
+    Повторяет интерфейс MishuraDB: любой метод вызывается через await,
+    а сам запрос выполняется в отдельном ограниченном пуле потоков поверх
+    пула соединений. Event loop не блокируется на время запроса.
+
+        adb = AsyncMishuraDB(db)
+        balance = await adb.get_user_balance(telegram_id)
+    """
+
+    def __init__(self, db: Optional[MishuraDB] = None, max_workers: int = DB_ASYNC_WORKERS):
+        self.db = db if db is not None else MishuraDB()
+        self._executor = ThreadPoolExecutor(
+            max_workers=max(1, max_workers),
+            thread_name_prefix="mishura-db"
+        )
+        logger.info(f"⚡ AsyncMishuraDB инициализирована ({max_workers} потоков)")
+
+    def __getattr__(self, name):
+        # Метод берется у MishuraDB в момент вызова, чтобы учитывать
+        # подмены (например, update_user_balance из FinancialService)
+        attr = getattr(self.db, name)
+        if not callable(attr):
+            return attr
+
+        async def method(*args, **kwargs):
+            return await self.run_sync(getattr(self.db, name), *args, **kwargs)
+
+        method.__name__ = name
+        method.__doc__ = attr.__doc__
+        return method
+
+    async def run_sync(self, func: Callable, *args, **kwargs):
+        """Выполнить синхронную функцию работы с БД без блокировки event loop"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+
+    def shutdown(self):
+        """Остановить пул потоков"""
+        self._executor.shutdown(wait=False)
+
 
 # === ФУНКЦИИ СОВМЕСТИМОСТИ ===
 
 def get_connection():
-    """Функция совместимости"""
-    db_instance = MishuraDB()
-    return db_instance.get_connection()
+    """Функция совместимости: соединение из общего пула"""
+    return get_pool(DB_PATH).acquire()
 
-def init_db(schema_file_path: str = SCHEMA_FILE) -> bool:
+def init_db() -> bool:
     """Функция совместимости"""
     db_instance = MishuraDB()
-    return db_instance.init_db(schema_file_path)
+    return db_instance.init_db()
 
 if __name__ == "__main__":
     logger.info("Запуск database.py как основного скрипта (для тестов или инициализации).")
     db_instance = MishuraDB()
-    if db_instance:
+    if db_instance.init_db():
         logger.info("База данных успешно инициализирована из __main__.")
     else:
         logger.error("Не удалось инициализировать базу данных из __main__.")
\ No newline at end of file
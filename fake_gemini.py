@@ -0,0 +1,490 @@
+"""
+==========================================================================================
+ПРОЕКТ: МИШУРА - Ваш персональный ИИ-Стилист
+КОМПОНЕНТ: Локальная имитация Gemini (fake_gemini.py)
+
+Заменяет Gemini API для нагрузочного тестирования без расхода квоты:
+принимает те же parts, что и GenerativeModel.generate_content, и возвращает
+правдоподобные советы на русском в структуре промпта. Задержки (логнормальное
+распределение), доля сбоев и ошибок квоты настраиваются через окружение,
+при заданном FAKE_GEMINI_SEED прогон воспроизводим.
+
+Режимы (GEMINI_BACKEND в gemini_ai.py):
+- fake       - имитация в процессе сервера
+- fake_http  - HTTP-клиент к отдельному процессу: python fake_gemini.py [--port 8765]
+==========================================================================================
+"""
+import os
+import re
+import json
+import time
+import math
+import base64
+import random
+import hashlib
+import logging
+import argparse
+import threading
+import urllib.error
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+try:
+    from google.api_core import exceptions as google_exceptions
+except ImportError:
+    google_exceptions = None
+
+logger = logging.getLogger(__name__)
+
+# Задержка ответа: медиана и разброс логнормального распределения, секунды
+FAKE_GEMINI_LATENCY_MEDIAN = float(os.getenv("FAKE_GEMINI_LATENCY_MEDIAN", 2.5))
+FAKE_GEMINI_LATENCY_SIGMA = float(os.getenv("FAKE_GEMINI_LATENCY_SIGMA", 0.5))
+FAKE_GEMINI_LATENCY_MAX = float(os.getenv("FAKE_GEMINI_LATENCY_MAX", 60.0))
+# Медиана для отдельных моделей: "gemini-1.5-flash=1.5,gemini-1.5-pro=4"
+FAKE_GEMINI_MODEL_LATENCY = os.getenv("FAKE_GEMINI_MODEL_LATENCY", "")
+# Доля временных сбоев (503) и ошибок квоты (429)
+FAKE_GEMINI_ERROR_RATE = float(os.getenv("FAKE_GEMINI_ERROR_RATE", 0.0))
+FAKE_GEMINI_QUOTA_RATE = float(os.getenv("FAKE_GEMINI_QUOTA_RATE", 0.0))
+# Подсказка сервера для ошибки квоты ("retry in Ns"), секунды
+FAKE_GEMINI_QUOTA_RETRY_AFTER = float(os.getenv("FAKE_GEMINI_QUOTA_RETRY_AFTER", 0))
+FAKE_GEMINI_SEED = os.getenv("FAKE_GEMINI_SEED")
+
+# Адрес HTTP-режима
+FAKE_GEMINI_URL = os.getenv("FAKE_GEMINI_URL", "http://127.0.0.1:8765")
+FAKE_GEMINI_HTTP_TIMEOUT = float(os.getenv("FAKE_GEMINI_HTTP_TIMEOUT", 120.0))
+
+# Столько токенов Gemini считает за одно изображение
+IMAGE_TOKENS = 258
+STREAM_CHUNK_CHARS = 120
+
+OCCASION_PATTERN = re.compile(r"для повода:\s*(.+?)\.(?:\s|$)")
+
+COLORS = ["графитовый", "молочный", "песочный", "темно-синий", "оливковый", "бордовый",
+          "пудровый", "кэмел", "серый меланж", "черный", "белый", "терракотовый"]
+ITEMS = ["жакет прямого кроя", "льняная рубашка", "трикотажный джемпер", "брюки с защипами",
+         "юбка-миди", "джинсы прямого кроя", "платье-рубашка", "тренч", "кардиган", "водолазка"]
+SHOES = ["лоферы", "белые кеды", "ботильоны на устойчивом каблуке", "мюли", "челси", "балетки"]
+ACCESSORIES = ["кожаный ремень", "минималистичные серьги", "шелковый платок", "сумка-тоут",
+               "часы на тонком ремешке", "структурированная сумка", "тонкая цепочка"]
+VERDICTS = ["отлично подходит", "уместен с небольшими доработками", "подходит, но выглядит слишком просто",
+            "выглядит уверенно и гармонично", "скорее повседневный, чем нарядный"]
+HARMONY = ["пропорции сбалансированы", "верх визуально перевешивает низ",
+           "силуэт цельный и аккуратный", "не хватает акцента на талии", "фактуры хорошо сочетаются"]
+PRACTICAL = ["удобно носить весь день", "ткань может мяться к вечеру",
+             "комфортно в движении", "подойдет для смены погоды", "стоит продумать верхний слой"]
+TIPS = ["Собирайте образ вокруг одной базовой вещи и добавляйте к ней не больше двух акцентов.",
+        "Повторяйте цвет аксессуара в одной из деталей одежды - образ выглядит продуманным.",
+        "Проверяйте посадку в движении: сядьте, поднимите руки, пройдитесь.",
+        "Нейтральная база плюс один яркий предмет - самый надежный рецепт.",
+        "Обувь задает настроение образа - меняйте ее, чтобы перевести образ из делового в повседневный."]
+
+
+class FakeGeminiError(Exception):
+    """Ошибка имитации, если google.api_core недоступен (классифицируется по тексту)"""
+
+    def __init__(self, code: int, message: str):
+        super().__init__(f"{code} {message}")
+        self.code = code
+        self.message = message
+
+
+def make_error(status: int, message: str, retry_after: Optional[float] = None) -> Exception:
+    """Исключение того же типа, что выбросил бы SDK для этого HTTP-статуса"""
+    if retry_after:
+        # Как в ответах Gemini: подсказка о повторе - в тексте ошибки
+        message = f"{message} Please retry in {retry_after:g}s."
+    if google_exceptions is not None:
+        return google_exceptions.from_http_status(status, message)
+    return FakeGeminiError(status, message)
+
+
+def _parse_model_latency(spec: str) -> Dict[str, float]:
+    latencies = {}
+    for item in spec.split(","):
+        name, _, value = item.partition("=")
+        if name.strip() and value.strip():
+            latencies[name.strip()] = float(value)
+    return latencies
+
+
+class FakeGeminiBackend:
+    """
+    🎭 Общая логика имитации: задержка и исход запроса (план), текст совета
+    и оценка токенов. Используется и в процессе, и HTTP-сервером.
+    """
+
+    def __init__(self, latency_median: float = FAKE_GEMINI_LATENCY_MEDIAN,
+                 latency_sigma: float = FAKE_GEMINI_LATENCY_SIGMA,
+                 latency_max: float = FAKE_GEMINI_LATENCY_MAX,
+                 model_latency: Optional[Dict[str, float]] = None,
+                 error_rate: float = FAKE_GEMINI_ERROR_RATE,
+                 quota_rate: float = FAKE_GEMINI_QUOTA_RATE,
+                 quota_retry_after: float = FAKE_GEMINI_QUOTA_RETRY_AFTER,
+                 seed: Optional[str] = FAKE_GEMINI_SEED):
+        self.latency_median = latency_median
+        self.latency_sigma = latency_sigma
+        self.latency_max = latency_max
+        self.model_latency = model_latency if model_latency is not None else _parse_model_latency(FAKE_GEMINI_MODEL_LATENCY)
+        self.error_rate = error_rate
+        self.quota_rate = quota_rate
+        self.quota_retry_after = quota_retry_after
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.stats = {'requests': 0, 'errors': 0, 'quota_errors': 0}
+
+    def plan(self, model_name: str) -> Tuple[float, Optional[Exception]]:
+        """Задержка запроса и ошибка, которой он закончится (None - успех)"""
+        median = self.model_latency.get(model_name, self.latency_median)
+        with self._lock:
+            self.stats['requests'] += 1
+            roll = self._random.random()
+            latency = median * math.exp(self._random.gauss(0, self.latency_sigma)) if median > 0 else 0.0
+            if roll < self.quota_rate:
+                self.stats['quota_errors'] += 1
+                # Квота проверяется до генерации - отказ быстрый
+                return min(latency, 0.05), make_error(
+                    429, "Resource has been exhausted (e.g. check quota).", self.quota_retry_after
+                )
+            if roll < self.quota_rate + self.error_rate:
+                self.stats['errors'] += 1
+                return min(latency, self.latency_max), make_error(503, "The service is currently unavailable.")
+        return min(latency, self.latency_max), None
+
+    def generate(self, parts: List[Any]) -> str:
+        """Совет в структуре промпта анализа или сравнения"""
+        prompt = "\n".join(part for part in parts if isinstance(part, str))
+        num_images = max(1, sum(1 for part in parts if not isinstance(part, str)))
+        match = OCCASION_PATTERN.search(prompt)
+        occasion = match.group(1).strip() if match else "повседневный выход"
+
+        # Один и тот же запрос - один и тот же ответ
+        digest = hashlib.sha256(prompt.encode("utf-8"))
+        for part in parts:
+            if isinstance(part, dict) and isinstance(part.get("data"), (bytes, bytearray)):
+                digest.update(part["data"])
+        rng = random.Random(digest.hexdigest())
+
+        if "ОБРАЗ 1" in prompt or num_images > 1:
+            return self._comparison(rng, occasion, num_images)
+        return self._analysis(rng, occasion)
+
+    @staticmethod
+    def _analysis(rng: random.Random, occasion: str) -> str:
+        colors = rng.sample(COLORS, 2)
+        return f"""🎽 **АНАЛИЗ ОБРАЗА**
+
+**🎯 Общая оценка**
+✅ Для повода «{occasion}» образ {rng.choice(VERDICTS)}
+
+**🎨 Цветовая гамма**
+✅ {colors[0].capitalize()} и {colors[1]} спокойно сочетаются и не спорят друг с другом
+
+**⚖️ Гармония образа**
+✅ {rng.choice(HARMONY).capitalize()}
+
+**👟 Практичность**
+✅ {rng.choice(PRACTICAL).capitalize()}
+
+⸻
+
+**📌 РЕКОМЕНДАЦИИ**
+
+**Дополнить образ:**
+• {rng.choice(ITEMS).capitalize()} в оттенке «{rng.choice(COLORS)}»
+• {rng.choice(SHOES).capitalize()} и {rng.choice(ACCESSORIES)}
+
+**Общие советы:**
+• {rng.choice(TIPS)}
+
+⸻
+
+💡 **Совет от МИШУРЫ:** {rng.choice(TIPS)}"""
+
+    @staticmethod
+    def _comparison(rng: random.Random, occasion: str, num_images: int) -> str:
+        image_emojis = ["🎽", "👖", "👔", "👗", "🧥", "👕"]
+        blocks = []
+        for i in range(1, num_images + 1):
+            emoji = image_emojis[(i - 1) % len(image_emojis)]
+            blocks.append(f"""{emoji} **ОБРАЗ {i}:** {rng.choice(ITEMS)} и {rng.choice(SHOES)}
+
+**Уместность для {occasion}**
+✅ Образ {rng.choice(VERDICTS)}
+
+**Цветовая гамма образа {i}**
+✅ {rng.choice(COLORS).capitalize()} в сочетании с оттенком «{rng.choice(COLORS)}»
+
+**Гармония образа {i}**
+✅ {rng.choice(HARMONY).capitalize()}
+
+**Практичность образа {i}**
+✅ {rng.choice(PRACTICAL).capitalize()}
+
+⸻
+""")
+        order = list(range(1, num_images + 1))
+        rng.shuffle(order)
+        improvements = "\n".join(
+            f"• ОБРАЗ {i}: {rng.choice(ACCESSORIES)} и {rng.choice(SHOES)} сделают образ завершенным"
+            for i in range(1, num_images + 1)
+        )
+        return "\n".join(blocks) + f"""
+🏆 **СРАВНЕНИЕ ВСЕХ {num_images} ОБРАЗОВ**
+
+**Лучший образ из {num_images}:** Образ {order[0]} - лучше всего подходит для повода «{occasion}»
+
+**Худший образ из {num_images}:** Образ {order[-1]} - {rng.choice(HARMONY)}
+
+**Рекомендации по улучшению:**
+{improvements}
+
+⸻
+
+💡 **Совет от МИШУРЫ:** {rng.choice(TIPS)}"""
+
+    @staticmethod
+    def usage(parts: List[Any], text: str) -> Dict[str, int]:
+        """Оценка токенов: ~4 символа на токен текста, фиксированная цена изображения"""
+        prompt_tokens = sum(len(part) // 4 if isinstance(part, str) else IMAGE_TOKENS for part in parts)
+        candidates_tokens = len(text) // 4
+        return {
+            'prompt_token_count': prompt_tokens,
+            'candidates_token_count': candidates_tokens,
+            'total_token_count': prompt_tokens + candidates_tokens,
+        }
+
+    @staticmethod
+    def split_chunks(text: str) -> List[str]:
+        return [text[i:i + STREAM_CHUNK_CHARS] for i in range(0, len(text), STREAM_CHUNK_CHARS)]
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return dict(self.stats)
+
+
+backend = FakeGeminiBackend()
+
+
+def _as_list(contents) -> List[Any]:
+    return list(contents) if isinstance(contents, (list, tuple)) else [contents]
+
+
+def _make_response(text: str, usage: Optional[Dict[str, int]]):
+    return SimpleNamespace(
+        text=text,
+        prompt_feedback=None,
+        usage_metadata=SimpleNamespace(**usage) if usage else None,
+    )
+
+
+class FakeGenerativeModel:
+    """Имитация GenerativeModel в процессе: тот же generate_content(parts, stream=...)"""
+
+    def __init__(self, model_name: str, generation_config=None, fake_backend: Optional[FakeGeminiBackend] = None, **kwargs):
+        self.model_name = model_name
+        self.generation_config = generation_config
+        self.backend = fake_backend or backend
+
+    def generate_content(self, contents, *, stream: bool = False, **kwargs):
+        parts = _as_list(contents)
+        latency, error = self.backend.plan(self.model_name)
+        if stream and error is None:
+            return self._stream(parts, latency)
+        time.sleep(latency)
+        if error is not None:
+            raise error
+        text = self.backend.generate(parts)
+        return _make_response(text, self.backend.usage(parts, text))
+
+    def _stream(self, parts: List[Any], latency: float) -> Iterator[Any]:
+        text = self.backend.generate(parts)
+        chunks = self.backend.split_chunks(text)
+        # Первый фрагмент - примерно через треть времени ответа, остальные равномерно
+        time.sleep(latency * 0.3)
+        interval = latency * 0.7 / max(1, len(chunks))
+        for index, chunk in enumerate(chunks):
+            if index:
+                time.sleep(interval)
+            yield _make_response(chunk, None)
+
+
+class FakeHttpModel:
+    """Клиент к HTTP-имитации (python fake_gemini.py) с интерфейсом GenerativeModel"""
+
+    def __init__(self, model_name: str, generation_config=None, base_url: str = FAKE_GEMINI_URL, **kwargs):
+        self.model_name = model_name
+        self.generation_config = generation_config
+        self.base_url = base_url.rstrip("/")
+
+    @staticmethod
+    def _encode_part(part) -> Dict[str, Any]:
+        if isinstance(part, str):
+            return {"text": part}
+        if isinstance(part, dict) and "data" in part:
+            return {"inline_data": {"mime_type": part.get("mime_type", "image/jpeg"),
+                                    "data": base64.b64encode(part["data"]).decode("ascii")}}
+        return {"text": str(part)}
+
+    def _post(self, method: str, parts: List[Any], timeout: Optional[float]):
+        body = json.dumps({"contents": [{"role": "user", "parts": [self._encode_part(p) for p in parts]}]})
+        suffix = "?alt=sse" if method == "streamGenerateContent" else ""
+        request = urllib.request.Request(
+            f"{self.base_url}/v1beta/models/{self.model_name}:{method}{suffix}",
+            data=body.encode("utf-8"), headers={"Content-Type": "application/json"}, method="POST"
+        )
+        try:
+            return urllib.request.urlopen(request, timeout=timeout or FAKE_GEMINI_HTTP_TIMEOUT)
+        except urllib.error.HTTPError as e:
+            try:
+                message = json.loads(e.read()).get("error", {}).get("message", e.reason)
+            except ValueError:
+                message = e.reason
+            raise make_error(e.code, message) from None
+
+    @staticmethod
+    def _decode(payload: Dict[str, Any]):
+        candidates = payload.get("candidates") or [{}]
+        text = "".join(p.get("text", "") for p in candidates[0].get("content", {}).get("parts", []))
+        usage = payload.get("usageMetadata")
+        return _make_response(text, {
+            'prompt_token_count': usage.get("promptTokenCount", 0),
+            'candidates_token_count': usage.get("candidatesTokenCount", 0),
+            'total_token_count': usage.get("totalTokenCount", 0),
+        } if usage else None)
+
+    def generate_content(self, contents, *, stream: bool = False, request_options=None, **kwargs):
+        parts = _as_list(contents)
+        timeout = (request_options or {}).get("timeout")
+        if stream:
+            return self._stream(self._post("streamGenerateContent", parts, timeout))
+        with self._post("generateContent", parts, timeout) as response:
+            return self._decode(json.loads(response.read()))
+
+    def _stream(self, response) -> Iterator[Any]:
+        with response:
+            for line in response:
+                line = line.decode("utf-8").strip()
+                if line.startswith("data:"):
+                    yield self._decode(json.loads(line[5:]))
+
+
+def create_model(model_name: str, mode: str = "fake", generation_config=None):
+    """Объект модели для GEMINI_BACKEND=fake / fake_http"""
+    if mode == "fake_http":
+        return FakeHttpModel(model_name, generation_config=generation_config)
+    return FakeGenerativeModel(model_name, generation_config=generation_config)
+
+
+# === HTTP-СЕРВЕР ===
+
+class FakeGeminiHandler(BaseHTTPRequestHandler):
+    """POST /v1beta/models/<model>:generateContent и :streamGenerateContent?alt=sse"""
+
+    protocol_version = "HTTP/1.1"
+    ROUTE = re.compile(r"^/v1beta/models/([^/:]+):(generateContent|streamGenerateContent)")
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    def _send_json(self, status: int, payload: Dict[str, Any], headers: Optional[Dict[str, str]] = None):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    @staticmethod
+    def _payload(text: str, usage: Optional[Dict[str, int]] = None) -> Dict[str, Any]:
+        payload = {"candidates": [{"content": {"role": "model", "parts": [{"text": text}]}}]}
+        if usage:
+            payload["usageMetadata"] = {
+                "promptTokenCount": usage['prompt_token_count'],
+                "candidatesTokenCount": usage['candidates_token_count'],
+                "totalTokenCount": usage['total_token_count'],
+            }
+        return payload
+
+    def do_POST(self):
+        route = self.ROUTE.match(self.path)
+        length = int(self.headers.get("Content-Length", 0))
+        raw = self.rfile.read(length)
+        if not route:
+            self._send_json(404, {"error": {"code": 404, "message": "Not found", "status": "NOT_FOUND"}})
+            return
+        model_name, method = route.groups()
+        try:
+            request = json.loads(raw)
+            parts = []
+            for content in request.get("contents", []):
+                for part in content.get("parts", []):
+                    if "text" in part:
+                        parts.append(part["text"])
+                    elif "inline_data" in part:
+                        inline = part["inline_data"]
+                        parts.append({"mime_type": inline.get("mime_type"), "data": base64.b64decode(inline.get("data", ""))})
+        except (ValueError, AttributeError) as e:
+            self._send_json(400, {"error": {"code": 400, "message": f"Invalid JSON payload: {e}", "status": "INVALID_ARGUMENT"}})
+            return
+
+        latency, error = backend.plan(model_name)
+        if error is not None:
+            time.sleep(latency)
+            status = int(error.code)
+            headers = {"Retry-After": f"{backend.quota_retry_after:g}"} if status == 429 and backend.quota_retry_after else None
+            self._send_json(status, {"error": {"code": status, "message": error.message,
+                                               "status": "RESOURCE_EXHAUSTED" if status == 429 else "UNAVAILABLE"}}, headers)
+            return
+
+        text = backend.generate(parts)
+        usage = backend.usage(parts, text)
+        if method == "generateContent":
+            time.sleep(latency)
+            self._send_json(200, self._payload(text, usage))
+            return
+
+        chunks = backend.split_chunks(text)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        time.sleep(latency * 0.3)
+        interval = latency * 0.7 / max(1, len(chunks))
+        try:
+            for index, chunk in enumerate(chunks):
+                if index:
+                    time.sleep(interval)
+                last = index == len(chunks) - 1
+                data = json.dumps(self._payload(chunk, usage if last else None), ensure_ascii=False)
+                self.wfile.write(f"data: {data}\n\n".encode("utf-8"))
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        self.close_connection = True
+
+
+def serve(host: str = "127.0.0.1", port: int = 8765):
+    server = ThreadingHTTPServer((host, port), FakeGeminiHandler)
+    server.daemon_threads = True
+    logger.info(f"🎭 Имитация Gemini слушает http://{host}:{port} "
+                f"(медиана {backend.latency_median}с, сбои {backend.error_rate:.0%}, квота {backend.quota_rate:.0%})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        logger.info(f"🎭 Остановлено, статистика: {backend.get_stats()}")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Локальная имитация Gemini API для нагрузочных тестов")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+    serve(args.host, args.port)
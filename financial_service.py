@@ -36,114 +36,9 @@ class FinancialService:
         self.retry_delay = 0.1  # 100ms
         self.lock_timeout = 30  # секунд
         
+        # Таблицы transaction_log и balance_locks создаются миграциями (migrations.py)
         logger.info("🔐 FinancialService инициализирован")
         
-        # Инициализируем таблицы если нужно
-        self._init_financial_tables()
-        
-    def _init_financial_tables(self):
-        """Создание таблиц transaction_log и balance_locks"""
-        try:
-            conn = self.db.get_connection()
-            cursor = conn.cursor()
-            
-            db_type = getattr(self.db, 'DB_CONFIG', {'type': 'sqlite'}).get('type', 'sqlite')
-            
-            if db_type == 'postgresql':
-                # PostgreSQL схема
-                schema_sql = """
-                -- Таблица для аудита транзакций
-                CREATE TABLE IF NOT EXISTS transaction_log (
-                    id BIGSERIAL PRIMARY KEY,
-                    telegram_id BIGINT NOT NULL,
-                    operation_type VARCHAR(50) NOT NULL,
-                    transaction_type VARCHAR(20) NOT NULL,
-                    amount INTEGER NOT NULL,
-                    balance_before INTEGER NOT NULL,
-                    balance_after INTEGER NOT NULL,
-                    operation_id VARCHAR(255) UNIQUE NOT NULL,
-                    correlation_id VARCHAR(255),
-                    metadata JSONB DEFAULT '{}',
-                    status VARCHAR(20) DEFAULT 'completed',
-                    error_message TEXT,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    created_by VARCHAR(100) DEFAULT 'system'
-                );
-
-                -- Таблица для optimistic locking
-                CREATE TABLE IF NOT EXISTS balance_locks (
-                    telegram_id BIGINT PRIMARY KEY,
-                    version_number INTEGER DEFAULT 1,
-                    last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    locked_by VARCHAR(255),
-                    lock_expires_at TIMESTAMP
-                );
-
-                -- Индексы
-                CREATE INDEX IF NOT EXISTS idx_tlog_user_time 
-                    ON transaction_log (telegram_id, created_at DESC);
-                CREATE INDEX IF NOT EXISTS idx_tlog_operation_id 
-                    ON transaction_log (operation_id);
-                CREATE INDEX IF NOT EXISTS idx_tlog_correlation 
-                    ON transaction_log (correlation_id);
-                """
-            else:
-                # SQLite схема
-                schema_sql = """
-                -- Таблица для аудита транзакций
-                CREATE TABLE IF NOT EXISTS transaction_log (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    telegram_id INTEGER NOT NULL,
-                    operation_type TEXT NOT NULL,
-                    transaction_type TEXT NOT NULL,
-                    amount INTEGER NOT NULL,
-                    balance_before INTEGER NOT NULL,
-                    balance_after INTEGER NOT NULL,
-                    operation_id TEXT UNIQUE NOT NULL,
-                    correlation_id TEXT,
-                    metadata TEXT DEFAULT '{}',
-                    status TEXT DEFAULT 'completed',
-                    error_message TEXT,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    created_by TEXT DEFAULT 'system'
-                );
-
-                -- Таблица для optimistic locking
-                CREATE TABLE IF NOT EXISTS balance_locks (
-                    telegram_id INTEGER PRIMARY KEY,
-                    version_number INTEGER DEFAULT 1,
-                    last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    locked_by TEXT,
-                    lock_expires_at TIMESTAMP
-                );
-
-                -- Индексы
-                CREATE INDEX IF NOT EXISTS idx_tlog_user_time 
-                    ON transaction_log (telegram_id, created_at DESC);
-                CREATE INDEX IF NOT EXISTS idx_tlog_operation_id 
-                    ON transaction_log (operation_id);
-                CREATE INDEX IF NOT EXISTS idx_tlog_correlation 
-                    ON transaction_log (correlation_id);
-                """
-            
-            # Выполняем создание таблиц
-            for statement in schema_sql.split(';'):
-                statement = statement.strip()
-                if statement:
-                    cursor.execute(statement)
-            
-            conn.commit()
-            conn.close()
-            
-            logger.info("✅ Финансовые таблицы инициализированы")
-            
-        except Exception as e:
-            logger.error(f"❌ Ошибка инициализации финансовых таблиц: {e}")
-            if 'conn' in locals():
-                conn.rollback()
-                conn.close()
-            raise
-        
     def generate_operation_id(self, operation_type: str, user_id: int, 
                             extra_context: str = None) -> str:
         """Генерация детерминированного operation_id для idempotency"""
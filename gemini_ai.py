@@ -17,13 +17,45 @@ import os
 import logging
 import time
 import asyncio
-import google.generativeai as genai
+import hashlib
+import re
+import random
+import inspect
+import functools
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+# SDK не нужен, если запросы идут в локальную имитацию (GEMINI_BACKEND=fake)
+try:
+    import google.generativeai as genai
+    GENAI_AVAILABLE = True
+except ImportError:
+    genai = None
+    GENAI_AVAILABLE = False
+try:
+    from google.api_core import exceptions as google_exceptions
+except ImportError:
+    google_exceptions = None
+# Низкоуровневый клиент нужен для отдельного клиента на каждый ключ из пула
+try:
+    from google.ai import generativelanguage as glm
+    GLM_AVAILABLE = True
+except ImportError:
+    GLM_AVAILABLE = False
 from dotenv import load_dotenv
 from PIL import Image, ImageOps, ImageDraw
 from io import BytesIO
-from typing import Optional, List, Tuple, Union, Dict, Any
+from typing import Optional, List, Tuple, Union, Dict, Any, AsyncIterator
 import traceback
 
+from image_processing import (
+    NUMPY_AVAILABLE, optimize_image, compute_dhash, preprocess_image,
+)
+from fake_gemini import create_model as create_fake_model
+
+if NUMPY_AVAILABLE:
+    import numpy as np
+
 # Настройка логирования
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
@@ -33,69 +65,903 @@ logger.info("🎭 Инициализация модуля Gemini AI для МИ
 # Загрузка переменных окружения
 load_dotenv()
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
+# Пул ключей через запятую; без него - единственный GEMINI_API_KEY
+GEMINI_API_KEYS = [key.strip() for key in os.getenv("GEMINI_API_KEYS", "").split(",") if key.strip()]
+if not GEMINI_API_KEYS and GEMINI_API_KEY:
+    GEMINI_API_KEYS = [GEMINI_API_KEY]
 
-# Простой заглушка кеш-менеджера
-class DummyCacheManager:
-    def __init__(self):
-        logger.info("DummyCacheManager инициализирован")
-    
-    def get_from_cache(self, *args, **kwargs):
+# Куда отправлять запросы: google - Gemini API; fake / fake_http - локальная
+# имитация (fake_gemini.py) для нагрузочных тестов без ключа и квоты
+GEMINI_BACKEND = os.getenv("GEMINI_BACKEND", "google").strip().lower()
+FAKE_BACKENDS = ("fake", "fake_http")
+
+# Версия текстов промптов: входит в ключ кеша, при изменении промптов
+# старые результаты перестают совпадать
+PROMPT_VERSION = "0.6.0"
+# Собранные части промптов для (повод, число фото)
+PROMPT_CACHE_SIZE = int(os.getenv("PROMPT_CACHE_SIZE", 256))
+
+# Параметры кеша результатов анализа
+ANALYSIS_CACHE_SIZE = int(os.getenv("ANALYSIS_CACHE_SIZE", 512))
+ANALYSIS_CACHE_MEMORY_TTL = int(os.getenv("ANALYSIS_CACHE_MEMORY_TTL", 3600))
+ANALYSIS_CACHE_TTL = int(os.getenv("ANALYSIS_CACHE_TTL", 7 * 24 * 3600))
+# Просроченные записи в БД удаляются примерно раз в N сохранений
+ANALYSIS_CACHE_PURGE_EVERY = 500
+
+
+def make_analysis_cache_key(kind: str, images: List[bytes], occasion: str,
+                            preferences: Optional[str]) -> str:
+    """sha256 от оптимизированных изображений, повода, пожеланий и версии промптов"""
+    digest = hashlib.sha256()
+    for part in (kind, PROMPT_VERSION, occasion or "", preferences or "", str(len(images))):
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\x00")
+    for image_bytes in images:
+        digest.update(hashlib.sha256(image_bytes).digest())
+    return digest.hexdigest()
+
+
+class AnalysisCacheManager:
+    """
+    🗃️ Двухуровневый кеш результатов анализа:
+    LRU в памяти (размер + TTL) и таблица analysis_cache в БД.
+    Постоянный уровень подключается через attach_store (AsyncMishuraDB);
+    его ошибки только логируются - анализ из-за кеша не падает.
+    """
+
+    def __init__(self, max_size: int = ANALYSIS_CACHE_SIZE, memory_ttl: int = ANALYSIS_CACHE_MEMORY_TTL,
+                 ttl: int = ANALYSIS_CACHE_TTL):
+        self.max_size = max(1, max_size)
+        self.memory_ttl = memory_ttl
+        self.ttl = ttl
+        self.store = None
+        self._data: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {'memory_hits': 0, 'store_hits': 0, 'misses': 0, 'saves': 0, 'store_errors': 0}
+        logger.info(f"AnalysisCacheManager инициализирован (память: {self.max_size} записей, TTL {self.memory_ttl}с)")
+
+    def attach_store(self, store):
+        """Подключить постоянный уровень (объект с async get/save/purge_cached_analysis)"""
+        self.store = store
+
+    def _memory_get(self, key: str) -> Optional[str]:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if time.monotonic() >= expires_at:
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def _memory_put(self, key: str, value: str):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + self.memory_ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    async def get_from_cache(self, key: str) -> Optional[str]:
+        value = self._memory_get(key)
+        if value is not None:
+            self.stats['memory_hits'] += 1
+            return value
+
+        if self.store is not None:
+            try:
+                value = await self.store.get_cached_analysis(key)
+            except Exception as e:
+                self.stats['store_errors'] += 1
+                logger.warning(f"⚠️ Кеш анализов в БД недоступен: {e}")
+            if value is not None:
+                self.stats['store_hits'] += 1
+                self._memory_put(key, value)
+                return value
+
+        self.stats['misses'] += 1
         return None
-    
-    def save_to_cache(self, *args, **kwargs):
-        pass
 
-# Конфигурация Gemini API
+    async def save_to_cache(self, key: str, value: str, kind: str = "analysis"):
+        self._memory_put(key, value)
+        self.stats['saves'] += 1
+        if self.store is None:
+            return
+        try:
+            await self.store.save_cached_analysis(key, kind, value, self.ttl)
+            if random.randrange(ANALYSIS_CACHE_PURGE_EVERY) == 0:
+                await self.store.purge_analysis_cache()
+        except Exception as e:
+            self.stats['store_errors'] += 1
+            logger.warning(f"⚠️ Не удалось сохранить анализ в кеш БД: {e}")
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            size = len(self._data)
+        return {**self.stats, 'memory_size': size, 'max_size': self.max_size,
+                'persistent': self.store is not None}
+
+# Конфигурация Gemini API выполняется лениво - при первом запросе или в warm_up():
+# импорт модуля не требует ключа и сети
 API_CONFIGURED_SUCCESSFULLY = False
+VISION_MODEL: Optional[str] = None
 
-if not GEMINI_API_KEY:
-    logger.error("❌ GEMINI_API_KEY не найден в переменных окружения")
-    raise ValueError("GEMINI_API_KEY не найден в .env файле или переменных окружения")
+# Модели в порядке предпочтения: первая доступная - основная, остальные -
+# запасные для hedged-запросов и переключения при сбоях (GEMINI_MODELS через запятую)
+MODELS_TO_TRY = [
+    "gemini-1.5-flash-latest",
+    "gemini-1.5-flash",
+    "gemini-pro-vision",
+    "gemini-pro"
+]
+if os.getenv("GEMINI_MODELS"):
+    MODELS_TO_TRY = [name.strip() for name in os.getenv("GEMINI_MODELS").split(",") if name.strip()]
+
+# Параметры генерации (задаются только явно, иначе - значения модели по умолчанию)
+GENERATION_CONFIG: Dict[str, Any] = {}
+if os.getenv("GEMINI_TEMPERATURE"):
+    GENERATION_CONFIG["temperature"] = float(os.getenv("GEMINI_TEMPERATURE"))
+if os.getenv("GEMINI_MAX_OUTPUT_TOKENS"):
+    GENERATION_CONFIG["max_output_tokens"] = int(os.getenv("GEMINI_MAX_OUTPUT_TOKENS"))
+
+_configure_lock = threading.Lock()
+# GenerativeModel создается один раз на (модель, ключ, системная инструкция)
+# и переиспользуется всеми запросами
+_models: Dict[Tuple[str, int, Optional[str]], Any] = {}
+# Клиенты для ключей пула, кроме первого (первый - клиент по умолчанию из genai.configure)
+_key_clients: Dict[int, Any] = {}
+
+
+def _client_for_key(key_index: int):
+    client = _key_clients.get(key_index)
+    if client is None:
+        client = glm.GenerativeServiceClient(client_options={"api_key": key_pool.keys[key_index]})
+        _key_clients[key_index] = client
+    return client
+
+
+def get_model(model_name: str, key_index: int = 0, system_instruction: Optional[str] = None):
+    """Объект GenerativeModel для модели и ключа пула (создается при первом обращении)"""
+    cache_key = (model_name, key_index, system_instruction)
+    model = _models.get(cache_key)
+    if model is None:
+        with _configure_lock:
+            model = _models.get(cache_key)
+            if model is None:
+                if GEMINI_BACKEND in FAKE_BACKENDS:
+                    model = create_fake_model(model_name, GEMINI_BACKEND, GENERATION_CONFIG or None)
+                else:
+                    extra = {"system_instruction": system_instruction} if system_instruction else {}
+                    model = genai.GenerativeModel(model_name, generation_config=GENERATION_CONFIG or None, **extra)
+                    if key_index:
+                        model._client = _client_for_key(key_index)
+                _models[cache_key] = model
+    return model
+
+
+def configure_api_keys(api_keys: List[str]):
+    """Заменить пул ключей (объекты моделей и клиенты пересоздаются)"""
+    global API_CONFIGURED_SUCCESSFULLY
+    with _configure_lock:
+        key_pool.set_keys(api_keys)
+        _models.clear()
+        _key_clients.clear()
+        API_CONFIGURED_SUCCESSFULLY = False
+
+
+def _ensure_configured():
+    """Сконфигурировать Gemini API и выбрать модель (один раз за процесс)"""
+    global API_CONFIGURED_SUCCESSFULLY, VISION_MODEL
+    if API_CONFIGURED_SUCCESSFULLY:
+        return
+
+    with _configure_lock:
+        if API_CONFIGURED_SUCCESSFULLY:
+            return
+
+        if GEMINI_BACKEND in FAKE_BACKENDS:
+            if not key_pool.keys:
+                key_pool.set_keys(["fake"])
+            _models.clear()
+            VISION_MODEL = MODELS_TO_TRY[0]
+            model_router.set_models(list(MODELS_TO_TRY))
+            API_CONFIGURED_SUCCESSFULLY = True
+            logger.warning(f"🎭 Gemini API заменен локальной имитацией ({GEMINI_BACKEND}), "
+                           f"модели: {', '.join(MODELS_TO_TRY)}")
+            return
+
+        if not GENAI_AVAILABLE:
+            logger.error("❌ Пакет google-generativeai не установлен")
+            raise RuntimeError("Пакет google-generativeai не установлен (или задайте GEMINI_BACKEND=fake)")
+
+        if not key_pool.keys:
+            logger.error("❌ GEMINI_API_KEY не найден в переменных окружения")
+            raise RuntimeError("GEMINI_API_KEY не найден в .env файле или переменных окружения")
+
+        if len(key_pool.keys) > 1 and not GLM_AVAILABLE:
+            logger.warning("⚠️ google.ai.generativelanguage недоступен - используется только первый ключ пула")
+            key_pool.set_keys(key_pool.keys[:1])
 
-try:
-    # Конфигурируем API
-    genai.configure(api_key=GEMINI_API_KEY)
-    
-    # Проверяем доступные модели
-    logger.info("🔍 Проверка доступных моделей Gemini...")
-    
-    # Список моделей для тестирования
-    models_to_try = [
-        "gemini-1.5-flash-latest",
-        "gemini-1.5-flash", 
-        "gemini-pro-vision",
-        "gemini-pro"
-    ]
-    
-    VISION_MODEL = None
-    
-    for model_name in models_to_try:
         try:
-            # Создаем модель для проверки
-            test_model = genai.GenerativeModel(model_name)
-            VISION_MODEL = model_name
-            logger.info(f"✅ Модель {model_name} доступна")
-            break
-        except Exception as model_error:
-            logger.warning(f"⚠️ Модель {model_name} недоступна: {str(model_error)}")
-            continue
-    
-    if VISION_MODEL:
+            genai.configure(api_key=key_pool.keys[0])
+            logger.info("🔍 Проверка доступных моделей Gemini...")
+
+            available = []
+            for model_name in MODELS_TO_TRY:
+                try:
+                    _models[(model_name, 0, None)] = genai.GenerativeModel(
+                        model_name, generation_config=GENERATION_CONFIG or None
+                    )
+                    available.append(model_name)
+                    logger.info(f"✅ Модель {model_name} доступна")
+                except Exception as model_error:
+                    logger.warning(f"⚠️ Модель {model_name} недоступна: {str(model_error)}")
+                    continue
+
+            if not available:
+                raise RuntimeError("Ни одна из моделей Gemini не доступна")
+            VISION_MODEL = available[0]
+            model_router.set_models(available)
+
+        except Exception as e:
+            logger.error(f"❌ КРИТИЧЕСКАЯ ОШИБКА при конфигурации Gemini API: {str(e)}")
+            raise RuntimeError(f"Не удалось сконфигурировать Gemini API: {str(e)}")
+
         API_CONFIGURED_SUCCESSFULLY = True
-        logger.info(f"✅ Gemini API успешно сконфигурирован с моделью: {VISION_MODEL}")
-    else:
-        raise RuntimeError("Ни одна из моделей Gemini не доступна")
-        
-except Exception as e:
-    logger.error(f"❌ КРИТИЧЕСКАЯ ОШИБКА при конфигурации Gemini API: {str(e)}")
-    raise RuntimeError(f"Не удалось сконфигурировать Gemini API: {str(e)}")
+        logger.info(f"✅ Gemini API успешно сконфигурирован с моделью: {VISION_MODEL}, "
+                    f"ключей в пуле: {len(key_pool.keys)}")
+
+
+def warm_up():
+    """Явная инициализация Gemini API (при старте сервера, вместо первого запроса)"""
+    _ensure_configured()
+    return VISION_MODEL
 
 # Параметры повторных запросов
-MAX_RETRIES = 3
-RETRY_DELAY = 2
+MAX_RETRIES = int(os.getenv("GEMINI_MAX_RETRIES", 3))
+# Экспоненциальная задержка с jitter: случайная в [0, min(MAX, BASE * 2^попытка)]
+RETRY_BASE_DELAY = float(os.getenv("GEMINI_RETRY_BASE_DELAY", 1.0))
+RETRY_MAX_DELAY = float(os.getenv("GEMINI_RETRY_MAX_DELAY", 16.0))
+# Дедлайн одной попытки и общий бюджет запроса со всеми повторами:
+# зависшая попытка не съедает весь таймаут endpoint'а
+GEMINI_ATTEMPT_TIMEOUT = float(os.getenv("GEMINI_ATTEMPT_TIMEOUT", 25.0))
+GEMINI_REQUEST_BUDGET = float(os.getenv("GEMINI_REQUEST_BUDGET", 55.0))
+
+# Классы ошибок Gemini
+ERROR_RETRYABLE = "retryable"   # временный сбой: повторяем
+ERROR_QUOTA = "quota"           # превышена квота: повторяем не раньше подсказки сервера
+ERROR_PERMANENT = "permanent"   # ошибка запроса/ключа/фильтров: повтор не поможет
+
+_RETRY_AFTER_RE = re.compile(r"retry(?:_delay| in| after)[^0-9]*([0-9]+(?:\.[0-9]+)?)", re.IGNORECASE)
+
+
+class GeminiUnavailableError(RuntimeError):
+    """Gemini недоступен (открыт circuit breaker) - запрос не отправлялся"""
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def classify_gemini_error(error: BaseException) -> str:
+    """Отнести ошибку к retryable / quota / permanent"""
+    if isinstance(error, asyncio.TimeoutError):
+        return ERROR_RETRYABLE
+
+    if google_exceptions is not None:
+        if isinstance(error, (google_exceptions.ResourceExhausted, google_exceptions.TooManyRequests)):
+            return ERROR_QUOTA
+        if isinstance(error, (google_exceptions.ServiceUnavailable, google_exceptions.InternalServerError,
+                              google_exceptions.DeadlineExceeded, google_exceptions.GatewayTimeout,
+                              google_exceptions.Aborted, google_exceptions.BadGateway)):
+            return ERROR_RETRYABLE
+        if isinstance(error, google_exceptions.ClientError):
+            return ERROR_PERMANENT
+
+    error_str = str(error).lower()
+    if "429" in error_str or "quota" in error_str or "resource exhausted" in error_str or "rate limit" in error_str:
+        return ERROR_QUOTA
+    if any(marker in error_str for marker in ("api key", "authentication", "permission", "invalid argument",
+                                              "400", "403", "404", "safety", "block_reason", "blocked")):
+        return ERROR_PERMANENT
+    # Пустой ответ без причины блокировки, сетевые сбои, 5xx и неизвестное - временные
+    return ERROR_RETRYABLE
+
+
+def _server_retry_after(error: BaseException) -> Optional[float]:
+    """Подсказка сервера, через сколько секунд повторять (для ошибок квоты)"""
+    match = _RETRY_AFTER_RE.search(str(error))
+    return float(match.group(1)) if match else None
+
+
+def _backoff_delay(attempt: int) -> float:
+    """Экспоненциальная задержка с полным jitter"""
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * (2 ** attempt)))
+
+
+class CircuitBreaker:
+    """
+    🔌 Circuit breaker для Gemini: после FAILURE_THRESHOLD подряд временных
+    сбоев (ошибки 5xx, таймауты, квота) размыкается на RECOVERY_TIMEOUT секунд -
+    запросы отклоняются сразу, до списания средств. Затем пропускает одну
+    пробную попытку: успех замыкает цепь, сбой размыкает снова. В half_open
+    admit() допускает к списанию только один запрос, остальные получают 503.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int = 5, recovery_timeout: float = 30.0):
+        self.failure_threshold = max(1, failure_threshold)
+        self.recovery_timeout = recovery_timeout
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        # Номер допуска пробного запроса в half_open (0 - не выдан)
+        self._admission = 0
+        self._admissions_issued = 0
+        self._lock = threading.Lock()
+        self.stats = {'opened': 0, 'rejected': 0, 'failures': 0, 'successes': 0}
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._state == self.OPEN and time.monotonic() - self._opened_at >= self.recovery_timeout:
+                self._state = self.HALF_OPEN
+                self._probe_in_flight = False
+                self._admission = 0
+            return self._state
+
+    def retry_after(self) -> int:
+        """Сколько секунд осталось до пробной попытки"""
+        remaining = self.recovery_timeout - (time.monotonic() - self._opened_at)
+        return max(1, int(remaining + 0.999))
+
+    def is_available(self) -> bool:
+        """Можно ли принимать запросы (проверка до списания средств)"""
+        state = self.state
+        return state == self.CLOSED or (
+            state == self.HALF_OPEN and not self._probe_in_flight and not self._admission)
+
+    def admit(self) -> int:
+        """
+        Допуск запроса до списания средств. В closed пропускает всех (0),
+        в half_open - только один запрос: возвращает номер допуска, который
+        нужно вернуть через release_admission(). Остальным - GeminiUnavailableError.
+        """
+        state = self.state
+        with self._lock:
+            if state == self.CLOSED:
+                return 0
+            if state == self.HALF_OPEN and not self._probe_in_flight and not self._admission:
+                self._admissions_issued += 1
+                self._admission = self._admissions_issued
+                return self._admission
+            self.stats['rejected'] += 1
+        raise GeminiUnavailableError("Сервис анализа временно недоступен", self.retry_after())
+
+    def release_admission(self, admission: int):
+        """Запрос, допущенный в half_open, завершился (с пробой или без нее)"""
+        with self._lock:
+            if admission and self._admission == admission:
+                self._admission = 0
+
+    def before_attempt(self) -> bool:
+        """
+        Разрешение на попытку; в half_open пропускается одна пробная.
+        Возвращает True, если эта попытка - пробная (ее нужно release_probe()).
+        """
+        state = self.state
+        with self._lock:
+            if state == self.CLOSED:
+                return False
+            if state == self.HALF_OPEN and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return True
+            self.stats['rejected'] += 1
+        raise GeminiUnavailableError("Сервис анализа временно недоступен", self.retry_after())
+
+    def record_success(self):
+        with self._lock:
+            self.stats['successes'] += 1
+            self._failures = 0
+            if self._state != self.CLOSED:
+                logger.info("🔌 Circuit breaker Gemini замкнут: сервис восстановился")
+            self._state = self.CLOSED
+            self._probe_in_flight = False
+            self._admission = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.stats['failures'] += 1
+            self._failures += 1
+            if self._state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                if self._state != self.OPEN:
+                    self.stats['opened'] += 1
+                    logger.error(f"🔌 Circuit breaker Gemini разомкнут на {self.recovery_timeout:.0f}с "
+                                 f"после {self._failures} сбоев подряд")
+                self._state = self.OPEN
+                self._opened_at = time.monotonic()
+                self._probe_in_flight = False
+                self._admission = 0
+
+    def release_probe(self):
+        """Пробная попытка завершилась без вердикта (ошибка запроса, отмена клиентом)"""
+        with self._lock:
+            self._probe_in_flight = False
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {**self.stats, 'state': self.state, 'consecutive_failures': self._failures,
+                'failure_threshold': self.failure_threshold, 'recovery_timeout': self.recovery_timeout}
+
+
+circuit_breaker = CircuitBreaker(
+    failure_threshold=int(os.getenv("GEMINI_BREAKER_THRESHOLD", 5)),
+    recovery_timeout=float(os.getenv("GEMINI_BREAKER_RECOVERY", 30.0)),
+)
+
+
+# Пул ключей: ключ, упершийся в квоту, отстраняется на время
+GEMINI_KEY_BENCH_SECONDS = float(os.getenv("GEMINI_KEY_BENCH_SECONDS", 60.0))
+GEMINI_KEY_BENCH_MAX_SECONDS = float(os.getenv("GEMINI_KEY_BENCH_MAX_SECONDS", 900.0))
+# Недействительный ключ (ошибка аутентификации) отстраняется надолго
+GEMINI_KEY_INVALID_BENCH_SECONDS = float(os.getenv("GEMINI_KEY_INVALID_BENCH_SECONDS", 3600.0))
+KEY_RATE_WINDOW = 60.0
+
+
+class ApiKeyPool:
+    """
+    🔑 Пул ключей Gemini API: запросы распределяются по кругу между
+    доступными ключами, по каждому ключу считаются запросы и токены за минуту
+    и ошибки квоты. Ключ, упершийся в квоту, отстраняется (по подсказке
+    сервера или с экспоненциально растущим сроком), недействительный - надолго.
+    """
+
+    def __init__(self, keys: Optional[List[str]] = None):
+        self._lock = threading.Lock()
+        self.set_keys(keys or [])
+
+    def set_keys(self, keys: List[str]):
+        with self._lock:
+            self.keys = list(keys)
+            self._next = 0
+            self._state = [{
+                'requests': deque(), 'tokens': deque(), 'total_requests': 0, 'total_tokens': 0,
+                'quota_errors': 0, 'errors': 0, 'consecutive_quota': 0, 'benched_until': 0.0,
+            } for _ in self.keys]
+
+    @property
+    def size(self) -> int:
+        return len(self.keys)
+
+    def _is_available(self, index: int, now: float) -> bool:
+        return self._state[index]['benched_until'] <= now
+
+    @staticmethod
+    def _prune(state: Dict[str, Any], now: float):
+        """Убрать из окна запросы и токены старше KEY_RATE_WINDOW"""
+        while state['requests'] and state['requests'][0] < now - KEY_RATE_WINDOW:
+            state['requests'].popleft()
+        while state['tokens'] and state['tokens'][0][0] < now - KEY_RATE_WINDOW:
+            state['tokens'].popleft()
+
+    def has_available(self) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            return any(self._is_available(i, now) for i in range(len(self.keys)))
+
+    def acquire(self) -> int:
+        """Следующий доступный ключ по кругу; если отстранены все - тот, что вернется раньше"""
+        now = time.monotonic()
+        with self._lock:
+            count = len(self.keys)
+            for offset in range(count):
+                index = (self._next + offset) % count
+                if self._is_available(index, now):
+                    self._next = (index + 1) % count
+                    break
+            else:
+                index = min(range(count), key=lambda i: self._state[i]['benched_until'])
+            state = self._state[index]
+            self._prune(state, now)
+            state['requests'].append(now)
+            state['total_requests'] += 1
+            return index
+
+    def record_success(self, index: int, tokens: int = 0):
+        now = time.monotonic()
+        with self._lock:
+            state = self._state[index]
+            state['consecutive_quota'] = 0
+            self._prune(state, now)
+            if tokens:
+                state['tokens'].append((now, tokens))
+                state['total_tokens'] += tokens
+
+    def record_error(self, index: int, error: BaseException, error_class: str):
+        now = time.monotonic()
+        with self._lock:
+            state = self._state[index]
+            state['errors'] += 1
+            if error_class == ERROR_QUOTA:
+                state['quota_errors'] += 1
+                state['consecutive_quota'] += 1
+                bench = _server_retry_after(error) or min(
+                    GEMINI_KEY_BENCH_MAX_SECONDS,
+                    GEMINI_KEY_BENCH_SECONDS * (2 ** (state['consecutive_quota'] - 1))
+                )
+            elif error_class == ERROR_PERMANENT and "api key" in str(error).lower():
+                bench = GEMINI_KEY_INVALID_BENCH_SECONDS
+            else:
+                return
+            state['benched_until'] = max(state['benched_until'], now + bench)
+        logger.warning(f"🔑 Ключ {self._label(index)} отстранен на {bench:.0f}с: {error}")
+
+    def _label(self, index: int) -> str:
+        """Имя ключа для логов и метрик (сам ключ не показывается)"""
+        return f"#{index + 1}…{self.keys[index][-4:]}"
+
+    def get_stats(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        keys = []
+        with self._lock:
+            for index, state in enumerate(self._state):
+                self._prune(state, now)
+                keys.append({
+                    'key': self._label(index),
+                    'requests_per_min': len(state['requests']),
+                    'tokens_per_min': sum(tokens for _, tokens in state['tokens']),
+                    'total_requests': state['total_requests'],
+                    'total_tokens': state['total_tokens'],
+                    'quota_errors': state['quota_errors'],
+                    'errors': state['errors'],
+                    'benched_for_s': max(0, round(state['benched_until'] - now)),
+                })
+        return {'size': len(keys), 'keys': keys}
+
+
+key_pool = ApiKeyPool(GEMINI_API_KEYS)
+
+
+# Маршрутизация между моделями
+GEMINI_HEDGE_ENABLED = os.getenv("GEMINI_HEDGE_ENABLED", "true").lower() == "true"
+# Задержка hedged-запроса, пока у модели мало замеров для p95
+GEMINI_HEDGE_DEFAULT_DELAY = float(os.getenv("GEMINI_HEDGE_DEFAULT_DELAY", 12.0))
+GEMINI_HEDGE_MIN_DELAY = float(os.getenv("GEMINI_HEDGE_MIN_DELAY", 2.0))
+# Модель считается сбойной при такой доле ошибок среди последних исходов
+GEMINI_FAILOVER_ERROR_RATE = float(os.getenv("GEMINI_FAILOVER_ERROR_RATE", 0.5))
+ROUTER_WINDOW = 200
+ROUTER_MIN_LATENCY_SAMPLES = 20
+ROUTER_MIN_OUTCOMES = 5
+# Доля ошибок считается по последним N исходам - быстро реагирует на деградацию
+ROUTER_ERROR_WINDOW = 20
+# Исходы старше этого не учитываются в доле ошибок
+ROUTER_OUTCOME_TTL = 300.0
+
+
+class ModelRouter:
+    """
+    🧭 Маршрутизация запросов между моделями Gemini по скользящей статистике:
+    задержки успешных ответов (p50/p95) и доля ошибок по каждой модели.
+    Сбойная модель уходит в конец списка (failover); если основная модель
+    отвечает дольше своего p95, параллельно отправляется hedged-запрос
+    в следующую, побеждает первый ответ.
+    """
+
+    def __init__(self, models: Optional[List[str]] = None):
+        self._lock = threading.Lock()
+        self.models: List[str] = []
+        self._latencies: Dict[str, deque] = {}
+        self._outcomes: Dict[str, deque] = {}
+        self.stats = {'hedges': 0, 'hedge_wins': 0, 'failovers': 0,
+                      'abandoned_calls': 0, 'abandoned_tokens': 0, 'abandoned_cost_usd': 0.0}
+        if models:
+            self.set_models(models)
+
+    def set_models(self, models: List[str]):
+        with self._lock:
+            self.models = list(models)
+            for model_name in self.models:
+                self._latencies.setdefault(model_name, deque(maxlen=ROUTER_WINDOW))
+                self._outcomes.setdefault(model_name, deque(maxlen=ROUTER_WINDOW))
+
+    def record(self, model_name: str, latency: Optional[float], ok: Optional[bool]):
+        """
+        Записать результат вызова: latency - длительность (или нижняя граница
+        для отмененного проигравшего), ok - исход (None - исход неизвестен).
+        """
+        with self._lock:
+            if latency is not None and model_name in self._latencies:
+                self._latencies[model_name].append(latency)
+            if ok is not None and model_name in self._outcomes:
+                self._outcomes[model_name].append((time.monotonic(), ok))
+
+    def record_abandoned(self, usage: Dict[str, Any]):
+        """Учесть токены вызова, ответ которого уже не ждали (Gemini его тарифицирует)"""
+        with self._lock:
+            self.stats['abandoned_calls'] += 1
+            self.stats['abandoned_tokens'] += usage['total_tokens']
+            self.stats['abandoned_cost_usd'] = round(self.stats['abandoned_cost_usd'] + usage['cost_usd'], 8)
+
+    def error_rate(self, model_name: str) -> Optional[float]:
+        """Доля ошибок среди последних исходов не старше ROUTER_OUTCOME_TTL (None - мало данных)"""
+        cutoff = time.monotonic() - ROUTER_OUTCOME_TTL
+        with self._lock:
+            recent = [ok for ts, ok in list(self._outcomes.get(model_name, ()))[-ROUTER_ERROR_WINDOW:] if ts >= cutoff]
+        if len(recent) < ROUTER_MIN_OUTCOMES:
+            return None
+        return 1 - sum(recent) / len(recent)
+
+    def percentile(self, model_name: str, q: float) -> Optional[float]:
+        with self._lock:
+            samples = sorted(self._latencies.get(model_name, ()))
+        if len(samples) < ROUTER_MIN_LATENCY_SAMPLES:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * q))]
+
+    def is_failing(self, model_name: str) -> bool:
+        rate = self.error_rate(model_name)
+        return rate is not None and rate >= GEMINI_FAILOVER_ERROR_RATE
+
+    def order(self) -> List[str]:
+        """Модели в порядке попыток: исправные по приоритету, затем сбойные"""
+        healthy = [m for m in self.models if not self.is_failing(m)]
+        failing = [m for m in self.models if m not in healthy]
+        return healthy + failing
+
+    def hedge_delay(self, model_name: str) -> float:
+        """Через сколько секунд без ответа отправлять hedged-запрос"""
+        p95 = self.percentile(model_name, 0.95)
+        if p95 is None:
+            return GEMINI_HEDGE_DEFAULT_DELAY
+        return max(GEMINI_HEDGE_MIN_DELAY, p95)
+
+    def get_stats(self) -> Dict[str, Any]:
+        models = {}
+        for model_name in self.models:
+            p50 = self.percentile(model_name, 0.5)
+            p95 = self.percentile(model_name, 0.95)
+            rate = self.error_rate(model_name)
+            models[model_name] = {
+                'samples': len(self._latencies.get(model_name, ())),
+                'p50_ms': round(p50 * 1000) if p50 is not None else None,
+                'p95_ms': round(p95 * 1000) if p95 is not None else None,
+                'error_rate': round(rate, 3) if rate is not None else None,
+                'failing': self.is_failing(model_name),
+            }
+        return {**self.stats, 'order': self.order(), 'hedging': GEMINI_HEDGE_ENABLED, 'models': models}
+
+
+model_router = ModelRouter()
+
+
+def is_gemini_available() -> bool:
+    """Проверка circuit breaker до списания средств"""
+    return circuit_breaker.is_available()
+
+# Вызовы SDK синхронные: выполняем их в отдельном ограниченном пуле потоков,
+# чтобы 10-40 секундный ответ Gemini не останавливал event loop FastAPI.
+# Запросы сверх лимита ждут свободного потока в очереди пула.
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", 8))
+_gemini_executor = ThreadPoolExecutor(max_workers=GEMINI_MAX_CONCURRENCY, thread_name_prefix="gemini")
+
+
+async def _run_in_gemini_executor(func, *args):
+    """Выполнить блокирующий вызов SDK в пуле Gemini"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_gemini_executor, func, *args)
+
+
+# Новые версии SDK принимают таймаут запроса; в 0.3.0 его нет - там попытку
+# ограничивает asyncio.wait_for, а поток дорабатывает в фоне
+# (имитация принимает его всегда)
+_SDK_SUPPORTS_REQUEST_OPTIONS = GEMINI_BACKEND in FAKE_BACKENDS or (
+    GENAI_AVAILABLE and "request_options" in inspect.signature(genai.GenerativeModel.generate_content).parameters
+)
+
+
+def _request_kwargs(timeout: Optional[float]) -> Dict[str, Any]:
+    if timeout and _SDK_SUPPORTS_REQUEST_OPTIONS:
+        return {"request_options": {"timeout": timeout}}
+    return {}
+
+
+# Системная инструкция появилась в SDK после 0.3.0. Explicit context caching
+# (CachedContent) для статической части не используется: его нет в закрепленном
+# SDK, а инструкции стилиста на порядки меньше минимального размера кеша.
+# Статическая часть всегда идет первой - одинаковым префиксом запросов
+_SDK_SUPPORTS_SYSTEM_INSTRUCTION = GEMINI_BACKEND not in FAKE_BACKENDS and GENAI_AVAILABLE and (
+    "system_instruction" in inspect.signature(genai.GenerativeModel.__init__).parameters
+)
+
+
+def _model_for_parts(model_name: str, parts, key_index: int):
+    """Модель и части запроса: статическая часть промпта - системной инструкцией, если SDK умеет"""
+    if _SDK_SUPPORTS_SYSTEM_INSTRUCTION and parts and isinstance(parts[0], SystemPrompt):
+        return get_model(model_name, key_index, parts[0]), parts[1:]
+    return get_model(model_name, key_index), parts
+
+
+def _generate_content_blocking(model_name: str, parts, timeout: Optional[float] = None,
+                               key_index: int = 0) -> Any:
+    """Синхронный запрос к модели (выполняется в потоке пула)"""
+    model, parts = _model_for_parts(model_name, parts, key_index)
+    return model.generate_content(parts, **_request_kwargs(timeout))
+
+
+def _stream_content_blocking(model_name: str, parts, emit, cancelled: threading.Event,
+                             timeout: Optional[float] = None, key_index: int = 0):
+    """
+    Потоковый запрос к модели (выполняется в потоке пула): каждый фрагмент
+    текста передается в emit. cancelled - клиент ушел, дочитывать ответ не нужно.
+    Возвращает usage_metadata (приходит с последним фрагментом), если он есть.
+    """
+    model, parts = _model_for_parts(model_name, parts, key_index)
+    response = model.generate_content(parts, stream=True, **_request_kwargs(timeout))
+    usage_metadata = None
+    for chunk in response:
+        if cancelled.is_set():
+            break
+        usage_metadata = getattr(chunk, "usage_metadata", None) or usage_metadata
+        text = chunk.text
+        if text:
+            emit(text)
+    return usage_metadata
+
+
+def shutdown_gemini_executor():
+    """Остановить пул потоков Gemini (при остановке сервера)"""
+    _gemini_executor.shutdown(wait=False)
+
+# Параметры поиска почти одинаковых фото (dHash, 64 бита)
+PHASH_MAX_DISTANCE = int(os.getenv("PHASH_MAX_DISTANCE", 6))
+PHASH_INDEX_MAX_ENTRIES = int(os.getenv("PHASH_INDEX_MAX_ENTRIES", 300000))
+PHASH_BUCKET_MAX_ENTRIES = int(os.getenv("PHASH_BUCKET_MAX_ENTRIES", 512))
+
+# Число единичных бит для каждого 16-битного слова - popcount через таблицу
+# (если в NumPy нет bitwise_count, он появился в 2.0)
+_POPCOUNT_LUT = None
+if NUMPY_AVAILABLE and not hasattr(np, "bitwise_count"):
+    _POPCOUNT_LUT = np.unpackbits(np.arange(65536, dtype=">u2").view(np.uint8)).reshape(-1, 16).sum(axis=1).astype(np.uint8)
+
+
+def hamming_distances(hashes: "np.ndarray", dhash: int) -> "np.ndarray":
+    """Расстояния Хэмминга от dhash до каждого хеша массива uint64 (векторно)"""
+    xor = np.bitwise_xor(hashes, np.uint64(dhash))
+    if _POPCOUNT_LUT is None:
+        return np.bitwise_count(xor)
+    return _POPCOUNT_LUT[xor.view(np.uint16)].reshape(-1, 4).sum(axis=1, dtype=np.uint16)
+
+
+class PerceptualHashIndex:
+    """
+    🔎 Индекс перцептивных хешей: (пользователь, повод, пожелания) -> хеши фото
+    и ключи кеша их анализов. Хеши корзины хранятся в массиве uint64, поиск -
+    один векторный проход. Старые записи корзины и давно не использованные
+    корзины вытесняются по лимитам.
+    """
+
+    def __init__(self, max_distance: int = PHASH_MAX_DISTANCE, max_entries: int = PHASH_INDEX_MAX_ENTRIES,
+                 bucket_max_entries: int = PHASH_BUCKET_MAX_ENTRIES):
+        self.max_distance = max_distance
+        self.max_entries = max(1, max_entries)
+        self.bucket_max_entries = max(1, bucket_max_entries)
+        self._buckets: "OrderedDict[tuple, Dict[str, Any]]" = OrderedDict()
+        self._total = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def bucket_key(user_id: Any, occasion: str, preferences: Optional[str]) -> tuple:
+        return (user_id, (occasion or "").strip().lower(), (preferences or "").strip().lower())
+
+    def add(self, bucket_key: tuple, dhash: int, cache_key: str):
+        if not NUMPY_AVAILABLE:
+            return
+        with self._lock:
+            bucket = self._buckets.get(bucket_key)
+            if bucket is None:
+                bucket = self._buckets[bucket_key] = {"hashes": np.empty(8, dtype=np.uint64), "keys": [], "size": 0}
+            self._buckets.move_to_end(bucket_key)
+
+            hashes, size = bucket["hashes"], bucket["size"]
+            if size >= self.bucket_max_entries:
+                # Сдвигаем корзину, забывая самое старое фото
+                hashes[:size - 1] = hashes[1:size]
+                bucket["keys"].pop(0)
+                size -= 1
+                self._total -= 1
+            if size == len(hashes):
+                grown = np.empty(min(len(hashes) * 2, self.bucket_max_entries), dtype=np.uint64)
+                grown[:size] = hashes[:size]
+                hashes = bucket["hashes"] = grown
+
+            hashes[size] = np.uint64(dhash)
+            bucket["keys"].append(cache_key)
+            bucket["size"] = size + 1
+            self._total += 1
+
+            while self._total > self.max_entries and len(self._buckets) > 1:
+                _, evicted = self._buckets.popitem(last=False)
+                self._total -= evicted["size"]
+
+    def find(self, bucket_key: tuple, dhash: int) -> Optional[Tuple[str, int]]:
+        """Ближайшее фото корзины на расстоянии <= max_distance: (ключ кеша, расстояние)"""
+        if not NUMPY_AVAILABLE:
+            return None
+        with self._lock:
+            bucket = self._buckets.get(bucket_key)
+            if bucket is None or bucket["size"] == 0:
+                self.misses += 1
+                return None
+            self._buckets.move_to_end(bucket_key)
+            distances = hamming_distances(bucket["hashes"][:bucket["size"]], dhash)
+            best = int(np.argmin(distances))
+            distance = int(distances[best])
+            if distance > self.max_distance:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return bucket["keys"][best], distance
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"available": NUMPY_AVAILABLE, "buckets": len(self._buckets), "entries": self._total,
+                    "max_distance": self.max_distance, "hits": self.hits, "misses": self.misses}
+
+
+class SingleFlight:
+    """
+    🛫 Объединение одинаковых запросов в полете: пока запрос к Gemini по ключу
+    кеша выполняется, повторные запросы с тем же ключом (двойная отправка из
+    webapp, то же фото через секунду) ждут его результата вместо своего вызова.
+    Вызов выполняется отдельной задачей: отмена одного ожидающего (таймаут
+    клиента) не прерывает его для остальных, а результат все равно попадет в кеш.
+    """
+
+    def __init__(self):
+        self._calls: Dict[str, asyncio.Future] = {}
+        self.stats = {'leaders': 0, 'coalesced': 0}
+
+    def join(self, key: str) -> Optional[asyncio.Future]:
+        """Присоединиться к запросу по ключу, который сейчас выполняется (None - такого нет)"""
+        call = self._calls.get(key)
+        if call is not None:
+            self.stats['coalesced'] += 1
+            logger.info("🛫 Запрос объединен с уже выполняющимся (тот же ключ кеша)")
+        return call
+
+    async def do(self, key: str, func) -> Any:
+        """Выполнить func() или присоединиться к уже выполняющемуся вызову с тем же ключом"""
+        call = self.join(key)
+        if call is not None:
+            return await asyncio.shield(call)
+
+        call = asyncio.ensure_future(func())
+        self._calls[key] = call
+        self.stats['leaders'] += 1
+        call.add_done_callback(lambda done: self._finish(key, done))
+        return await asyncio.shield(call)
+
+    def _finish(self, key: str, call: asyncio.Future):
+        if self._calls.get(key) is call:
+            del self._calls[key]
+        # Ошибку могли уже не ждать (все клиенты ушли) - помечаем ее полученной
+        if not call.cancelled():
+            call.exception()
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {**self.stats, 'in_flight': len(self._calls)}
+
 
 # Инициализация кэша
-cache_manager = DummyCacheManager()
+cache_manager = AnalysisCacheManager()
+phash_index = PerceptualHashIndex()
+inflight = SingleFlight()
 
 async def test_gemini_connection() -> bool:
     """
@@ -106,15 +972,17 @@ async def test_gemini_connection() -> bool:
     """
     logger.info("🧪 Тестирование соединения с Gemini API...")
     
-    if not API_CONFIGURED_SUCCESSFULLY:
+    try:
+        _ensure_configured()
+    except RuntimeError:
         logger.error("❌ Gemini API не сконфигурирован")
         return False
     
     try:
-        model = genai.GenerativeModel(VISION_MODEL)
-        
         # Используем простой текстовый запрос
-        response = model.generate_content("Привет! Ответь одним словом: работает")
+        response = await _run_in_gemini_executor(
+            _generate_content_blocking, VISION_MODEL, "Привет! Ответь одним словом: работает"
+        )
         
         if response and response.text:
             logger.info(f"✅ Gemini API работает! Ответ: {response.text.strip()}")
@@ -132,7 +1000,9 @@ def handle_gemini_error(error: Exception, context: str = "Gemini AI") -> str:
     error_str = str(error).lower()
     logger.error(f"❌ Ошибка {context}: {type(error).__name__} - {error_str}")
     
-    if "api key" in error_str or "authentication" in error_str:
+    if isinstance(error, asyncio.TimeoutError):
+        return "Превышено время ожидания. Попробуйте еще раз."
+    elif "api key" in error_str or "authentication" in error_str:
         return "Ошибка аутентификации API. Проверьте API ключ."
     elif "content filtered" in error_str or "safety" in error_str:
         return "Изображение не может быть обработано из-за ограничений безопасности."
@@ -143,59 +1013,17 @@ def handle_gemini_error(error: Exception, context: str = "Gemini AI") -> str:
     else:
         return f"Произошла ошибка при обработке запроса: {type(error).__name__}"
 
-def optimize_image(img_pil: Image.Image, max_size: int = 1024, quality: int = 85) -> bytes:
+class SystemPrompt(str):
     """
-    Оптимизирует изображение для отправки в API.
-    
-    Args:
-        img_pil: Объект PIL.Image
-        max_size: Максимальный размер стороны
-        quality: Качество JPEG
-        
-    Returns:
-        bytes: Оптимизированные данные изображения
+    Статическая часть промпта (инструкции стилиста и структура ответа).
+    Если SDK поддерживает system_instruction, она передается модели отдельно,
+    иначе уходит первой текстовой частью запроса - одинаковым префиксом.
     """
-    logger.info(f"📷 Оптимизация изображения: исходный размер {img_pil.size}")
-    
-    try:
-        # Изменение размера если нужно
-        width, height = img_pil.size
-        if width > max_size or height > max_size:
-            if width > height:
-                new_width = max_size
-                new_height = int(height * (max_size / width))
-            else:
-                new_height = max_size
-                new_width = int(width * (max_size / height))
-            
-            img_pil = img_pil.resize((new_width, new_height), Image.Resampling.LANCZOS)
-            logger.info(f"📏 Размер изменен на {new_width}x{new_height}")
-        
-        # Конвертация в RGB если нужно
-        if img_pil.mode in ('RGBA', 'LA') or (img_pil.mode == 'P' and 'transparency' in img_pil.info):
-            background = Image.new("RGB", img_pil.size, (255, 255, 255))
-            if img_pil.mode == 'P':
-                img_pil = img_pil.convert('RGBA')
-            background.paste(img_pil, mask=img_pil.split()[-1] if img_pil.mode == 'RGBA' else None)
-            img_pil = background
-        elif img_pil.mode != 'RGB':
-            img_pil = img_pil.convert('RGB')
-        
-        # Сохранение в JPEG
-        img_byte_arr = BytesIO()
-        img_pil.save(img_byte_arr, format='JPEG', quality=quality, optimize=True)
-        optimized_bytes = img_byte_arr.getvalue()
-        
-        logger.info(f"✅ Изображение оптимизировано: {len(optimized_bytes)} байт")
-        return optimized_bytes
-        
-    except Exception as e:
-        logger.error(f"❌ Ошибка оптимизации изображения: {str(e)}")
-        raise ValueError(f"Ошибка оптимизации изображения: {str(e)}")
 
-def create_analysis_prompt(occasion: str, preferences: Optional[str] = None) -> str:
-    """Создает промпт для анализа одежды с улучшенным форматированием."""
-    base_prompt = f"""Ты - профессиональный стилист МИШУРА. Проанализируй одежду на изображении для повода: {occasion}.
+
+# Статические части не зависят от запроса и собираются один раз;
+# при изменении текста нужно поднять PROMPT_VERSION (старый кеш перестанет совпадать)
+ANALYSIS_SYSTEM_PROMPT = SystemPrompt("""Ты - профессиональный стилист МИШУРА. Анализируешь одежду на изображении для повода, указанного в запросе.
 
 ВАЖНО! Используй точно такую структуру ответа:
 
@@ -228,110 +1056,473 @@ def create_analysis_prompt(occasion: str, preferences: Optional[str] = None) ->
 
 💡 **Совет от МИШУРЫ:** [практический совет для будущих консультаций]
 
-Отвечай на русском языке, дружелюбно и профессионально. НЕ используй цифры в конце предложений."""
-    
-    if preferences:
-        base_prompt += f"\n\nУчитывай дополнительный вопрос: {preferences}"
-    
-    return base_prompt
+Отвечай на русском языке, дружелюбно и профессионально. НЕ используй цифры в конце предложений.""")
 
-def create_comparison_prompt(occasion: str, num_images: int, preferences: Optional[str] = None) -> str:
-    """Создает ПРИНУДИТЕЛЬНЫЙ промпт для анализа ВСЕХ образов."""
-    image_emojis = ["🎽", "👖", "👔", "👗", "🧥", "👕"]
+COMPARISON_SYSTEM_PROMPT = SystemPrompt("""Ты - профессиональный стилист МИШУРА. Сравниваешь образы на изображениях для повода, указанного в запросе.
 
-    base_prompt = f"""Ты - профессиональный стилист МИШУРА.
+⚠️ КРИТИЧЕСКИ ВАЖНО: число изображений указано в запросе. Ты ОБЯЗАН проанализировать КАЖДОЕ изображение. НЕ пропускай ни одного!
 
-⚠️ КРИТИЧЕСКИ ВАЖНО: Я отправляю тебе ТОЧНО {num_images} изображений. Ты ОБЯЗАН проанализировать КАЖДОЕ из {num_images} изображений. НЕ пропускай ни одного!
+СТРУКТУРА ОБЯЗАТЕЛЬНОГО ОТВЕТА - такой блок для КАЖДОГО образа по порядку, где N - номер образа, а эмодзи по очереди 🎽 👖 👔 👗 🧥 👕:
 
-Сравни ВСЕ {num_images} представленных образов для повода: {occasion}.
+[эмодзи] **ОБРАЗ N:** [опиши что видишь на N-м изображении]
 
-СТРУКТУРА ОБЯЗАТЕЛЬНОГО ОТВЕТА (АНАЛИЗИРУЙ КАЖДЫЙ ОБРАЗ, НЕ ПРОПУСКАЙ!):
+**Уместность для [повод]**
+✅ Подходит ли этот образ для повода
 
-"""
+**Цветовая гамма образа N**
+✅ Какие цвета в N-м образе
 
-    for i in range(num_images):
-        emoji = image_emojis[i % len(image_emojis)]
-        base_prompt += f"""{emoji} **ОБРАЗ {i+1} (ОБЯЗАТЕЛЬНО АНАЛИЗИРУЙ):** [опиши что видишь на {i+1}-м изображении]
+**Гармония образа N**
+✅ Насколько сбалансирован N-й образ
 
-**Уместность для {occasion}**
-✅ Подходит ли этот образ для {occasion}
+**Практичность образа N**
+✅ Удобство N-го образа для повода
 
-**Цветовая гамма образа {i+1}**
-✅ Какие цвета в {i+1}-м образе
+⸻
 
-**Гармония образа {i+1}**
-✅ Насколько сбалансирован {i+1}-й образ
+После блоков ВСЕХ образов:
 
-**Практичность образа {i+1}**
-✅ Удобство {i+1}-го образа для {occasion}
+🏆 **ОБЯЗАТЕЛЬНОЕ СРАВНЕНИЕ ВСЕХ ОБРАЗОВ**
 
-⸻
+**Лучший образ:** Образ [номер] - [почему именно этот]
 
-"""
+**Худший образ:** Образ [номер] - [почему именно этот]
 
-    base_prompt += f"""🏆 **ОБЯЗАТЕЛЬНОЕ СРАВНЕНИЕ ВСЕХ {num_images} ОБРАЗОВ**
+**Рекомендации по улучшению (ДЛЯ КАЖДОГО ОБРАЗА):**
+• ОБРАЗ N: [как улучшить N-й образ]
 
-⚠️ ВАЖНО: Ты ДОЛЖЕН сравнить ВСЕ {num_images} образов!
+⸻
 
-**Лучший образ из {num_images}:** Образ [номер от 1 до {num_images}] - [почему именно этот]
+💡 **Совет от МИШУРЫ:** [практический совет учитывая все образы]
 
-**Худший образ из {num_images}:** Образ [номер от 1 до {num_images}] - [почему именно этот]
+**ЧЕК-ЛИСТ для тебя:**
+- [ ] Проанализированы ВСЕ образы
+- [ ] Даны рекомендации для КАЖДОГО образа
+- [ ] Выбран лучший и худший образ
+- [ ] Дана финальная рекомендация
 
-**Рекомендации по улучшению (ДЛЯ КАЖДОГО ИЗ {num_images} ОБРАЗОВ):**"""
+Отвечай на русском языке, дружелюбно и профессионально.""")
 
-    for i in range(num_images):
-        base_prompt += f"\n• ОБРАЗ {i+1}: [как улучшить {i+1}-й образ]"
 
-    base_prompt += f"""
+@functools.lru_cache(maxsize=PROMPT_CACHE_SIZE)
+def _analysis_request_prompt(occasion: str) -> str:
+    return f"Проанализируй одежду на изображении для повода: {occasion}."
 
-⸻
 
-💡 **Совет от МИШУРЫ:** [практический совет учитывая все {num_images} образа]
+@functools.lru_cache(maxsize=PROMPT_CACHE_SIZE)
+def _comparison_request_prompt(occasion: str, num_images: int) -> str:
+    sections = ", ".join(f"ОБРАЗ {i + 1}" for i in range(num_images))
+    return f"""Я отправляю тебе ТОЧНО {num_images} изображений. Сравни ВСЕ {num_images} образов для повода: {occasion}.
 
-⚠️ ПРОВЕРЬ СЕБЯ: Ты проанализировал ВСЕ {num_images} образов? Если нет - начни заново!
+Обязательные блоки ответа: {sections}, затем сравнение всех {num_images} образов и рекомендации для каждого из {num_images}.
 
-**ЧЕК-ЛИСТ для тебя:**
-- [ ] Проанализированы ВСЕ {num_images} образов
-- [ ] Даны рекомендации для КАЖДОГО образа
-- [ ] Выбран лучший и худший образ
-- [ ] Дана финальная рекомендация
+⚠️ ПРОВЕРЬ СЕБЯ: Ты проанализировал ВСЕ {num_images} образов? Если нет - начни заново!"""
 
-Отвечай на русском языке, дружелюбно и профессионально."""
 
+def create_analysis_prompt(occasion: str, preferences: Optional[str] = None) -> List[str]:
+    """Текстовые части запроса анализа: статическая инструкция и данные запроса."""
+    request_prompt = _analysis_request_prompt(occasion)
     if preferences:
-        base_prompt += f"\n\nДополнительно учитывай: {preferences}"
+        request_prompt += f"\n\nУчитывай дополнительный вопрос: {preferences}"
+    return [ANALYSIS_SYSTEM_PROMPT, request_prompt]
+
+def create_comparison_prompt(occasion: str, num_images: int, preferences: Optional[str] = None) -> List[str]:
+    """Текстовые части запроса сравнения: статическая инструкция и данные запроса."""
+    request_prompt = _comparison_request_prompt(occasion, num_images)
+    if preferences:
+        request_prompt += f"\n\nДополнительно учитывай: {preferences}"
+    return [COMPARISON_SYSTEM_PROMPT, request_prompt]
+
+# Учет токенов и стоимости: цены в USD за 1 млн токенов (ввод, вывод),
+# GEMINI_PRICING="модель=ввод/вывод,..." переопределяет; ищется самый длинный префикс имени
+GEMINI_PRICES_PER_MILLION: Dict[str, Tuple[float, float]] = {
+    "gemini-1.5-flash": (0.075, 0.30),
+    "gemini-1.5-pro": (1.25, 5.00),
+    "gemini-pro-vision": (0.50, 1.50),
+    "gemini-pro": (0.50, 1.50),
+}
+for _item in os.getenv("GEMINI_PRICING", "").split(","):
+    _name, _, _prices = _item.partition("=")
+    if _name.strip() and "/" in _prices:
+        _input_price, _output_price = _prices.split("/", 1)
+        GEMINI_PRICES_PER_MILLION[_name.strip()] = (float(_input_price), float(_output_price))
+# Если SDK не вернул usage_metadata (0.3.0 его не отдает), токены оцениваются:
+# изображение - фиксированные 258 токенов, текст - ~4 символа на токен
+GEMINI_IMAGE_TOKENS = 258
+CHARS_PER_TOKEN = 4
+
+
+def estimate_cost(model_name: Optional[str], prompt_tokens: int, output_tokens: int) -> float:
+    """Стоимость вызова в USD по таблице цен (0, если модель неизвестна)"""
+    name = (model_name or "").split("/")[-1]
+    prefixes = [prefix for prefix in GEMINI_PRICES_PER_MILLION if name.startswith(prefix)]
+    if not prefixes:
+        return 0.0
+    input_price, output_price = GEMINI_PRICES_PER_MILLION[max(prefixes, key=len)]
+    return round((prompt_tokens * input_price + output_tokens * output_price) / 1_000_000, 8)
 
-    return base_prompt
 
-async def _send_to_gemini_with_retries(parts: List[Any], context: str) -> str:
-    """Отправляет запрос к Gemini API с повторными попытками."""
+def _measure_usage(usage_metadata, model_name: str, parts: List[Any], output_chars: int,
+                   latency: float) -> Dict[str, Any]:
+    """Токены (из usage_metadata или оценка), задержка и стоимость одного вызова"""
+    images = sum(1 for part in parts if not isinstance(part, str))
+    prompt_tokens = int(getattr(usage_metadata, "prompt_token_count", 0) or 0)
+    output_tokens = int(getattr(usage_metadata, "candidates_token_count", 0) or 0)
+    estimated = not prompt_tokens
+    if estimated:
+        prompt_tokens = sum(len(part) // CHARS_PER_TOKEN for part in parts if isinstance(part, str)) \
+            + images * GEMINI_IMAGE_TOKENS
+        output_tokens = output_chars // CHARS_PER_TOKEN
+    # Разбивка по модальностям есть только в новых версиях API
+    image_tokens = sum(
+        int(getattr(detail, "token_count", 0) or 0)
+        for detail in (getattr(usage_metadata, "prompt_tokens_details", None) or [])
+        if "IMAGE" in str(getattr(detail, "modality", ""))
+    ) or images * GEMINI_IMAGE_TOKENS
+    return {
+        "model": model_name,
+        "images": images,
+        "prompt_tokens": prompt_tokens,
+        "image_tokens": min(image_tokens, prompt_tokens),
+        "output_tokens": output_tokens,
+        "total_tokens": prompt_tokens + output_tokens,
+        "tokens_estimated": estimated,
+        "gemini_latency_ms": round(latency * 1000),
+        "cost_usd": estimate_cost(model_name, prompt_tokens, output_tokens),
+    }
+
+
+def _fill_usage(usage: Optional[Dict[str, Any]], source: str, started: float,
+                measured: Optional[Dict[str, Any]] = None):
+    """
+    Заполнить usage вызывающего: source - gemini (был вызов модели), cache
+    (ответ из кеша) или coalesced (дождались такого же запроса в полете).
+    """
+    if usage is None:
+        return
+    usage.update({
+        "model": None, "images": 0, "prompt_tokens": 0, "image_tokens": 0, "output_tokens": 0,
+        "total_tokens": 0, "tokens_estimated": False, "gemini_latency_ms": None,
+        "attempts": 0, "abandoned_calls": 0, "cost_usd": 0.0,
+    })
+    usage.update(measured or {})
+    usage["source"] = source
+    usage["total_latency_ms"] = round((time.monotonic() - started) * 1000)
+
+
+def _response_text(response) -> str:
+    """Текст ответа модели или ValueError с причиной блокировки"""
+    if response and response.text:
+        return response.text
+    error_msg = "API не вернул текстовый ответ"
+    if response and hasattr(response, 'prompt_feedback'):
+        if response.prompt_feedback and hasattr(response.prompt_feedback, 'block_reason'):
+            error_msg += f": block_reason {response.prompt_feedback.block_reason}"
+    raise ValueError(error_msg)
+
+def _account_abandoned_call(future, model_name: str, parts: List[Any], key_index: int, started: float):
+    """
+    Ответ вызова больше не ждут (проиграл hedged-гонку или вышло время попытки),
+    но поток SDK дорабатывает, и Gemini тарифицирует вызов. Когда поток
+    завершится, его токены записываются в пул ключей и в model_router.
+    """
+    def done(f):
+        if f.cancelled() or f.exception() is not None:
+            return
+        response = f.result()
+        try:
+            output_chars = len(response.text or "")
+        except Exception:
+            output_chars = 0
+        usage = _measure_usage(getattr(response, "usage_metadata", None), model_name, parts,
+                               output_chars, time.monotonic() - started)
+        key_pool.record_success(key_index, usage["total_tokens"])
+        model_router.record_abandoned(usage)
+        logger.info(f"🧭 Брошенный вызов {model_name} завершился: {usage['total_tokens']} токенов, "
+                    f"${usage['cost_usd']:.6f}")
+
+    future.add_done_callback(done)
+
+
+async def _call_model(model_name: str, parts: List[Any], timeout: float) -> Tuple[str, Dict[str, Any]]:
+    """
+    Один вызов конкретной модели -> (текст, учет токенов) с записью задержки
+    и исхода в model_router.
+    Ключ берется из пула; если ключ уперся в квоту, а другой свободен -
+    тот же запрос сразу повторяется с другим ключом.
+    """
+    started = time.monotonic()
+    deadline = started + timeout
+    for key_attempt in range(max(1, key_pool.size)):
+        key_index = key_pool.acquire()
+        remaining = deadline - time.monotonic()
+        # Future пула, а не asyncio: отмена ожидания не останавливает поток SDK
+        future = _gemini_executor.submit(_generate_content_blocking, model_name, parts, remaining, key_index)
+        try:
+            response = await asyncio.wait_for(asyncio.wrap_future(future), timeout=remaining)
+            text = _response_text(response)
+        except asyncio.CancelledError:
+            # Проиграл hedged-гонку: время ответа - не меньше прошедшего
+            model_router.record(model_name, time.monotonic() - started, None)
+            _account_abandoned_call(future, model_name, parts, key_index, started)
+            raise
+        except Exception as e:
+            if isinstance(e, asyncio.TimeoutError):
+                _account_abandoned_call(future, model_name, parts, key_index, started)
+            error_class = classify_gemini_error(e)
+            key_pool.record_error(key_index, e, error_class)
+            if (error_class == ERROR_QUOTA and key_attempt < key_pool.size - 1
+                    and key_pool.has_available() and deadline - time.monotonic() > 1.0):
+                logger.warning(f"🔑 Квота ключа исчерпана, повтор с другим ключом: {e}")
+                continue
+            # Ошибки самого запроса (ключ, фильтры) не характеризуют модель
+            if error_class != ERROR_PERMANENT:
+                model_router.record(model_name, None, False)
+            raise
+        latency = time.monotonic() - started
+        usage = _measure_usage(getattr(response, "usage_metadata", None), model_name, parts, len(text), latency)
+        key_pool.record_success(key_index, usage["total_tokens"])
+        model_router.record(model_name, latency, True)
+        return text, usage
+
+async def _routed_attempt(parts: List[Any], timeout: float,
+                          call_stats: Optional[Dict[str, int]] = None) -> Tuple[str, str, Dict[str, Any]]:
+    """
+    Одна попытка запроса через model_router -> (текст, модель, учет токенов).
+    Основная модель не ответила за свой p95 - параллельно запрашивается
+    следующая (hedge), побеждает первый успешный ответ, проигравший отменяется.
+    Основная модель упала с временной ошибкой - сразу следующая (failover).
+    В call_stats['abandoned_calls'] добавляются вызовы, ответа которых не дождались.
+    """
+    candidates = model_router.order()
+    primary = candidates[0]
+    backups = candidates[1:]
+    deadline = time.monotonic() + timeout
+    tasks: Dict[asyncio.Future, str] = {}
+
+    def launch(model_name: str):
+        tasks[asyncio.ensure_future(_call_model(model_name, parts, deadline - time.monotonic()))] = model_name
+
+    launch(primary)
+    hedge_at = None
+    if GEMINI_HEDGE_ENABLED and backups:
+        hedge_at = time.monotonic() + model_router.hedge_delay(primary)
+    hedged = False
+    last_error: Optional[BaseException] = None
+
+    try:
+        while True:
+            now = time.monotonic()
+            if now >= deadline:
+                raise asyncio.TimeoutError()
+            wait_for = deadline - now if hedge_at is None else max(0.0, min(deadline, hedge_at) - now)
+            done, _ = await asyncio.wait(list(tasks), timeout=wait_for, return_when=asyncio.FIRST_COMPLETED)
+
+            for task in done:
+                model_name = tasks.pop(task)
+                if task.exception() is None:
+                    if model_name != primary:
+                        if hedged:
+                            model_router.stats['hedge_wins'] += 1
+                        logger.info(f"🧭 Ответ получен от запасной модели {model_name}")
+                    text, usage = task.result()
+                    return text, model_name, usage
+                last_error = task.exception()
+
+            if not done and hedge_at is not None and time.monotonic() >= hedge_at:
+                # Основная модель медленнее своего p95 - hedged-запрос в следующую
+                hedge_at = None
+                hedged = True
+                model_router.stats['hedges'] += 1
+                logger.info(f"🧭 {primary} не ответила за p95 - hedged-запрос в {backups[0]}")
+                launch(backups.pop(0))
+                continue
+
+            if not tasks:
+                if backups and classify_gemini_error(last_error) != ERROR_PERMANENT:
+                    hedge_at = None
+                    model_router.stats['failovers'] += 1
+                    logger.warning(f"🧭 Переключение на модель {backups[0]} после ошибки: {last_error}")
+                    launch(backups.pop(0))
+                    continue
+                raise last_error
+    finally:
+        if call_stats is not None:
+            call_stats['abandoned_calls'] = call_stats.get('abandoned_calls', 0) + len(tasks)
+        for task in tasks:
+            task.cancel()
+
+def _next_retry_delay(error: BaseException, error_class: str, attempt: int,
+                      deadline: float) -> Optional[float]:
+    """
+    Задержка перед следующей попыткой или None, если повторять бессмысленно:
+    постоянная ошибка, попытки кончились или не укладываемся в бюджет запроса.
+    """
+    if error_class == ERROR_PERMANENT or attempt >= MAX_RETRIES - 1:
+        return None
+    delay = _backoff_delay(attempt)
+    if error_class == ERROR_QUOTA:
+        delay = max(delay, _server_retry_after(error) or RETRY_BASE_DELAY * (2 ** (attempt + 1)))
+    # Следующей попытке нужно хотя бы немного времени после паузы
+    if time.monotonic() + delay + 1.0 >= deadline:
+        return None
+    return delay
+
+def _record_attempt_failure(error_class: str):
+    # Ошибки самого запроса не говорят о здоровье сервиса
+    if error_class != ERROR_PERMANENT:
+        circuit_breaker.record_failure()
+
+async def _send_to_gemini_with_retries(parts: List[Any], context: str,
+                                       usage: Optional[Dict[str, Any]] = None) -> str:
+    """
+    Отправляет запрос к Gemini API с повторными попытками: дедлайн на попытку,
+    экспоненциальная задержка с jitter, классификация ошибок, circuit breaker.
+    В usage (если передан) записывается учет токенов успешного вызова.
+    """
     logger.info(f"📤 Отправка запроса к Gemini: {context}")
+    _ensure_configured()
+    deadline = time.monotonic() + GEMINI_REQUEST_BUDGET
+    call_stats = {'abandoned_calls': 0}
     
     for attempt in range(MAX_RETRIES):
+        is_probe = circuit_breaker.before_attempt()
+        attempt_timeout = min(GEMINI_ATTEMPT_TIMEOUT, deadline - time.monotonic())
         try:
-            model = genai.GenerativeModel(VISION_MODEL)
-            response = model.generate_content(parts)
-            
-            if response and response.text:
-                logger.info(f"✅ Получен ответ от Gemini ({len(response.text)} символов)")
-                return response.text
-            else:
-                error_msg = "API не вернул текстовый ответ"
-                if response and hasattr(response, 'prompt_feedback'):
-                    if response.prompt_feedback and hasattr(response.prompt_feedback, 'block_reason'):
-                        error_msg += f": {response.prompt_feedback.block_reason}"
-                raise ValueError(error_msg)
+            text, model_name, call_usage = await _routed_attempt(parts, attempt_timeout, call_stats)
+            circuit_breaker.record_success()
+            if usage is not None:
+                usage.update(call_usage, attempts=attempt + 1, abandoned_calls=call_stats['abandoned_calls'])
+            logger.info(f"✅ Получен ответ от Gemini {model_name} ({len(text)} символов)")
+            return text
                 
         except Exception as e:
-            logger.warning(f"⚠️ Попытка {attempt + 1}/{MAX_RETRIES} не удалась: {str(e)}")
-            if attempt < MAX_RETRIES - 1:
-                await asyncio.sleep(RETRY_DELAY)
-            else:
+            error_class = classify_gemini_error(e)
+            _record_attempt_failure(error_class)
+            logger.warning(f"⚠️ Попытка {attempt + 1}/{MAX_RETRIES} не удалась ({error_class}): {str(e) or type(e).__name__}")
+            delay = _next_retry_delay(e, error_class, attempt, deadline)
+            if delay is None:
                 error_msg = handle_gemini_error(e, context)
-                logger.error(f"❌ Все попытки исчерпаны: {error_msg}")
+                logger.error(f"❌ Повторы прекращены: {error_msg}")
                 raise RuntimeError(error_msg)
+        finally:
+            if is_probe:
+                circuit_breaker.release_probe()
+        await asyncio.sleep(delay)
 
-async def analyze_clothing_image(image_data: bytes, occasion: str, preferences: Optional[str] = None) -> str:
+async def _stream_from_gemini_with_retries(parts: List[Any], context: str,
+                                           usage: Optional[Dict[str, Any]] = None) -> AsyncIterator[str]:
+    """
+    Потоковый запрос к Gemini: фрагменты ответа отдаются по мере генерации.
+    Повторная попытка возможна, только пока клиенту не отдан ни один фрагмент.
+    Дедлайн попытки ограничивает ожидание каждого следующего фрагмента.
+    Hedged-запросов нет (фрагменты уже у клиента); повтор идет в следующую модель.
+    В usage (если передан) записывается учет токенов после завершения потока.
+    """
+    logger.info(f"📤 Потоковый запрос к Gemini: {context}")
+    _ensure_configured()
+    loop = asyncio.get_running_loop()
+    deadline = time.monotonic() + GEMINI_REQUEST_BUDGET
+    
+    for attempt in range(MAX_RETRIES):
+        is_probe = circuit_breaker.before_attempt()
+        attempt_timeout = min(GEMINI_ATTEMPT_TIMEOUT, deadline - time.monotonic())
+        candidates = model_router.order()
+        model_name = candidates[min(attempt, len(candidates) - 1)]
+        key_index = key_pool.acquire()
+        queue: asyncio.Queue = asyncio.Queue()
+        cancelled = threading.Event()
+        emit = lambda text: loop.call_soon_threadsafe(queue.put_nowait, text)
+        task = loop.run_in_executor(
+            _gemini_executor, _stream_content_blocking, model_name, parts, emit, cancelled, attempt_timeout, key_index
+        )
+        # Конец потока (или ошибка) - в ту же очередь, после всех фрагментов
+        task.add_done_callback(lambda _: loop.call_soon_threadsafe(queue.put_nowait, None))
+        
+        sent = 0
+        started = time.monotonic()
+        try:
+            while True:
+                text = await asyncio.wait_for(queue.get(), timeout=attempt_timeout)
+                if text is None:
+                    break
+                sent += len(text)
+                yield text
+            usage_metadata = await task
+            if not sent:
+                raise ValueError("API не вернул текстовый ответ")
+            call_usage = _measure_usage(usage_metadata, model_name, parts, sent, time.monotonic() - started)
+            circuit_breaker.record_success()
+            key_pool.record_success(key_index, call_usage["total_tokens"])
+            model_router.record(model_name, None, True)
+            if usage is not None:
+                usage.update(call_usage, attempts=attempt + 1)
+            logger.info(f"✅ Потоковый ответ от Gemini {model_name} получен ({sent} символов)")
+            return
+        except Exception as e:
+            error_class = classify_gemini_error(e)
+            _record_attempt_failure(error_class)
+            key_pool.record_error(key_index, e, error_class)
+            if error_class != ERROR_PERMANENT:
+                model_router.record(model_name, None, False)
+            logger.warning(f"⚠️ Попытка {attempt + 1}/{MAX_RETRIES} не удалась ({error_class}): {str(e) or type(e).__name__}")
+            delay = None if sent else _next_retry_delay(e, error_class, attempt, deadline)
+            if delay is None:
+                error_msg = handle_gemini_error(e, context)
+                logger.error(f"❌ Потоковый запрос прерван: {error_msg}")
+                raise RuntimeError(error_msg)
+        finally:
+            cancelled.set()
+            if is_probe:
+                circuit_breaker.release_probe()
+        await asyncio.sleep(delay)
+
+async def _prepare_analysis(image_data: bytes, occasion: str, preferences: Optional[str],
+                            user_id: Optional[int]) -> Dict[str, Any]:
+    """
+    Общая подготовка анализа: оптимизация фото и поиск в кеше (в т.ч. почти
+    одинаковых фото). Если "cached" пуст - в "parts" готовый запрос к модели.
+    """
+    optimized_image, dhash = await preprocess_image(image_data)
+    
+    cache_key = make_analysis_cache_key("analysis", [optimized_image], occasion, preferences)
+    prepared = {"cache_key": cache_key, "cached": None, "parts": None, "dhash": dhash, "phash_bucket": None}
+    cached = await cache_manager.get_from_cache(cache_key)
+    if cached is not None:
+        logger.info("✅ Анализ образа взят из кеша")
+        prepared["cached"] = cached
+        return prepared
+    
+    # То же фото, но пережатое/обрезанное: ищем среди прошлых фото пользователя
+    if user_id is not None and dhash is not None:
+        phash_bucket = prepared["phash_bucket"] = PerceptualHashIndex.bucket_key(user_id, occasion, preferences)
+        match = phash_index.find(phash_bucket, dhash)
+        if match:
+            similar_key, distance = match
+            cached = await cache_manager.get_from_cache(similar_key)
+            if cached is not None:
+                logger.info(f"✅ Анализ взят для почти одинакового фото (расстояние {distance})")
+                prepared["cached"] = cached
+                return prepared
+    
+    # Подготавливаем части запроса: статическая инструкция, данные запроса, фото
+    prepared["parts"] = [
+        *create_analysis_prompt(occasion, preferences),
+        {
+            "mime_type": "image/jpeg",
+            "data": optimized_image
+        }
+    ]
+    return prepared
+
+async def _remember_analysis(prepared: Dict[str, Any], response: str):
+    """Сохранить готовый анализ в кеш и индекс почти одинаковых фото"""
+    await cache_manager.save_to_cache(prepared["cache_key"], response, "analysis")
+    if prepared["phash_bucket"] is not None:
+        phash_index.add(prepared["phash_bucket"], prepared["dhash"], prepared["cache_key"])
+
+async def analyze_clothing_image(image_data: bytes, occasion: str, preferences: Optional[str] = None,
+                                 user_id: Optional[int] = None, usage: Optional[Dict[str, Any]] = None) -> str:
     """
     Анализирует одежду на изображении с помощью Gemini AI.
     
@@ -339,44 +1530,118 @@ async def analyze_clothing_image(image_data: bytes, occasion: str, preferences:
         image_data: Бинарные данные изображения
         occasion: Повод для консультации
         preferences: Предпочтения пользователя
+        user_id: Пользователь (для поиска его почти одинаковых фото)
+        usage: Словарь, в который записываются токены, задержка, модель и стоимость
         
     Returns:
         str: Анализ и рекомендации
     """
     logger.info(f"🎨 Начало анализа образа для повода: {occasion}")
+    started = time.monotonic()
     
     try:
-        # Оптимизируем изображение
-        img = Image.open(BytesIO(image_data))
-        optimized_image = optimize_image(img)
+        prepared = await _prepare_analysis(image_data, occasion, preferences, user_id)
+        if prepared["cached"] is not None:
+            _fill_usage(usage, "cache", started)
+            return prepared["cached"]
         
-        # Создаем промпт
-        prompt = create_analysis_prompt(occasion, preferences)
-        
-        # Подготавливаем части запроса
-        parts = [
-            prompt,
-            {
-                "mime_type": "image/jpeg",
-                "data": optimized_image
-            }
-        ]
+        # Отправляем запрос (одинаковые запросы в полете - один вызов)
+        call_usage: Dict[str, Any] = {}
+        async def call_gemini() -> str:
+            result = await _send_to_gemini_with_retries(
+                prepared["parts"],
+                f"анализ образа для {occasion}",
+                call_usage
+            )
+            await _remember_analysis(prepared, result)
+            return result
         
-        # Отправляем запрос
-        response = await _send_to_gemini_with_retries(
-            parts,
-            f"анализ образа для {occasion}"
-        )
+        response = await inflight.do(prepared["cache_key"], call_gemini)
+        # call_usage пуст - запрос выполнил другой вызывающий
+        _fill_usage(usage, "gemini" if call_usage else "coalesced", started, call_usage)
         
         logger.info("✅ Анализ образа завершен успешно")
         return response
         
+    except GeminiUnavailableError:
+        raise
     except Exception as e:
         error_msg = handle_gemini_error(e, f"анализ образа для {occasion}")
         logger.error(f"❌ Ошибка анализа: {error_msg}")
         raise RuntimeError(error_msg)
 
-async def compare_clothing_images(image_data_list: List[bytes], occasion: str, preferences: Optional[str] = None) -> str:
+async def stream_clothing_analysis(image_data: bytes, occasion: str, preferences: Optional[str] = None,
+                                   user_id: Optional[int] = None,
+                                   usage: Optional[Dict[str, Any]] = None) -> AsyncIterator[str]:
+    """
+    Потоковый вариант analyze_clothing_image: отдает текст фрагментами по мере
+    генерации. Результат из кеша отдается одним фрагментом. usage заполняется
+    после последнего фрагмента.
+    """
+    logger.info(f"🎨 Начало потокового анализа образа для повода: {occasion}")
+    started = time.monotonic()
+    
+    try:
+        prepared = await _prepare_analysis(image_data, occasion, preferences, user_id)
+    except Exception as e:
+        error_msg = handle_gemini_error(e, f"анализ образа для {occasion}")
+        logger.error(f"❌ Ошибка анализа: {error_msg}")
+        raise RuntimeError(error_msg)
+    
+    if prepared["cached"] is not None:
+        _fill_usage(usage, "cache", started)
+        yield prepared["cached"]
+        return
+    
+    # Такой же запрос уже выполняется - дожидаемся его результата целиком
+    call = inflight.join(prepared["cache_key"])
+    if call is not None:
+        result = await asyncio.shield(call)
+        _fill_usage(usage, "coalesced", started)
+        yield result
+        return
+    
+    call_usage: Dict[str, Any] = {}
+    chunks = []
+    async for text in _stream_from_gemini_with_retries(prepared["parts"], f"анализ образа для {occasion}",
+                                                       call_usage):
+        chunks.append(text)
+        yield text
+    _fill_usage(usage, "gemini", started, call_usage)
+    await _remember_analysis(prepared, "".join(chunks))
+    logger.info("✅ Потоковый анализ образа завершен успешно")
+
+async def _prepare_comparison(image_data_list: List[bytes], occasion: str,
+                              preferences: Optional[str]) -> Dict[str, Any]:
+    """Общая подготовка сравнения: оптимизация фото, кеш, запрос к модели"""
+    num_images = len(image_data_list)
+    # Оптимизируем изображения параллельно в пуле процессов
+    processed = await asyncio.gather(*[preprocess_image(img_data) for img_data in image_data_list])
+    optimized_images = [optimized for optimized, _ in processed]
+    # После оптимизации все изображения - JPEG
+    mime_types = ["image/jpeg"] * num_images
+    logger.info(f"📷 Оптимизировано изображений: {num_images}")
+    
+    cache_key = make_analysis_cache_key("compare", optimized_images, occasion, preferences)
+    prepared = {"cache_key": cache_key, "cached": None, "parts": None}
+    cached = await cache_manager.get_from_cache(cache_key)
+    if cached is not None:
+        logger.info("✅ Сравнение образов взято из кеша")
+        prepared["cached"] = cached
+        return prepared
+    
+    # Подготавливаем части запроса: статическая инструкция, данные запроса, фото
+    parts = create_comparison_prompt(occasion, num_images, preferences)
+    for img, mime_type in zip(optimized_images, mime_types):
+        parts.append({
+            "mime_type": mime_type, 
+            "data": img
+        })
+    prepared["parts"] = parts
+    return prepared
+
+async def compare_clothing_images(image_data_list: List[bytes], occasion: str, preferences: Optional[str] = None,
+                                  usage: Optional[Dict[str, Any]] = None) -> str:
     """
     Сравнивает несколько образов одежды.
     
@@ -384,52 +1649,84 @@ async def compare_clothing_images(image_data_list: List[bytes], occasion: str, p
         image_data_list: Список бинарных данных изображений
         occasion: Повод для консультации
         preferences: Предпочтения пользователя
+        usage: Словарь, в который записываются токены, задержка, модель и стоимость
         
     Returns:
         str: Сравнительный анализ
     """
     num_images = len(image_data_list)
     logger.info(f"⚖️ Начало сравнения {num_images} образов для: {occasion}")
+    started = time.monotonic()
     
     try:
-        # Оптимизируем изображения
-        optimized_images = []
-        mime_types = []
-        for i, img_data in enumerate(image_data_list):
-            img = Image.open(BytesIO(img_data))
-            optimized = optimize_image(img)
-            optimized_images.append(optimized)
-            # Определяем mime_type динамически
-            fmt = img.format if hasattr(img, 'format') and img.format else 'JPEG'
-            mime_type = f"image/{fmt.lower()}"
-            mime_types.append(mime_type)
-            logger.info(f"📷 Оптимизировано изображение {i+1}/{num_images}")
-        
-        # Создаем ДИНАМИЧЕСКИЙ промпт с учетом количества изображений
-        prompt = create_comparison_prompt(occasion, num_images, preferences)
+        prepared = await _prepare_comparison(image_data_list, occasion, preferences)
+        if prepared["cached"] is not None:
+            _fill_usage(usage, "cache", started)
+            return prepared["cached"]
         
-        # Подготавливаем части запроса
-        parts = [prompt]
-        for img, mime_type in zip(optimized_images, mime_types):
-            parts.append({
-                "mime_type": mime_type, 
-                "data": img
-            })
+        # Отправляем запрос (одинаковые запросы в полете - один вызов)
+        call_usage: Dict[str, Any] = {}
+        async def call_gemini() -> str:
+            result = await _send_to_gemini_with_retries(
+                prepared["parts"],
+                f"сравнение {num_images} образов для {occasion}",
+                call_usage
+            )
+            await cache_manager.save_to_cache(prepared["cache_key"], result, "compare")
+            return result
         
-        # Отправляем запрос
-        response = await _send_to_gemini_with_retries(
-            parts,
-            f"сравнение {num_images} образов для {occasion}"
-        )
+        response = await inflight.do(prepared["cache_key"], call_gemini)
+        _fill_usage(usage, "gemini" if call_usage else "coalesced", started, call_usage)
         
         logger.info("✅ Сравнение образов завершено успешно")
         return response
         
+    except GeminiUnavailableError:
+        raise
     except Exception as e:
         error_msg = handle_gemini_error(e, f"сравнение образов для {occasion}")
         logger.error(f"❌ Ошибка сравнения: {error_msg}\n{traceback.format_exc()}")
         raise RuntimeError(error_msg)
 
+async def stream_clothing_comparison(image_data_list: List[bytes], occasion: str,
+                                     preferences: Optional[str] = None,
+                                     usage: Optional[Dict[str, Any]] = None) -> AsyncIterator[str]:
+    """Потоковый вариант compare_clothing_images"""
+    num_images = len(image_data_list)
+    logger.info(f"⚖️ Начало потокового сравнения {num_images} образов для: {occasion}")
+    started = time.monotonic()
+    
+    try:
+        prepared = await _prepare_comparison(image_data_list, occasion, preferences)
+    except Exception as e:
+        error_msg = handle_gemini_error(e, f"сравнение образов для {occasion}")
+        logger.error(f"❌ Ошибка сравнения: {error_msg}")
+        raise RuntimeError(error_msg)
+    
+    if prepared["cached"] is not None:
+        _fill_usage(usage, "cache", started)
+        yield prepared["cached"]
+        return
+    
+    # Такой же запрос уже выполняется - дожидаемся его результата целиком
+    call = inflight.join(prepared["cache_key"])
+    if call is not None:
+        result = await asyncio.shield(call)
+        _fill_usage(usage, "coalesced", started)
+        yield result
+        return
+    
+    call_usage: Dict[str, Any] = {}
+    chunks = []
+    async for text in _stream_from_gemini_with_retries(
+        prepared["parts"], f"сравнение {num_images} образов для {occasion}", call_usage
+    ):
+        chunks.append(text)
+        yield text
+    _fill_usage(usage, "gemini", started, call_usage)
+    await cache_manager.save_to_cache(prepared["cache_key"], "".join(chunks), "compare")
+    logger.info("✅ Потоковое сравнение образов завершено успешно")
+
 # Версия модуля
 __version__ = "0.5.0"
 
@@ -439,17 +1736,32 @@ class MishuraGeminiAI:
     Обеспечивает совместимость с api.py и другими модулями.
     """
     
-    def __init__(self):
-        """Инициализация класса MishuraGeminiAI"""
-        self.cache_manager = cache_manager
-        self.model_name = VISION_MODEL
-        self.api_configured = API_CONFIGURED_SUCCESSFULLY
-        
-        if not self.api_configured:
-            logger.error("❌ Gemini API не сконфигурирован при инициализации класса")
-            raise RuntimeError("Gemini API не сконфигурирован")
+    def __init__(self, cache_store=None, api_keys: Optional[List[str]] = None):
+        """
+        Инициализация класса MishuraGeminiAI
         
-        logger.info(f"✅ MishuraGeminiAI инициализирован с моделью: {self.model_name}")
+        Args:
+            cache_store: постоянный уровень кеша анализов (AsyncMishuraDB)
+            api_keys: пул ключей Gemini API (по умолчанию GEMINI_API_KEYS / GEMINI_API_KEY)
+        """
+        if api_keys:
+            configure_api_keys(api_keys)
+        self.cache_manager = cache_manager
+        if cache_store is not None:
+            self.cache_manager.attach_store(cache_store)
+        logger.info("✅ MishuraGeminiAI инициализирован (Gemini API конфигурируется при первом запросе)")
+    
+    @property
+    def model_name(self) -> Optional[str]:
+        return VISION_MODEL
+    
+    @property
+    def api_configured(self) -> bool:
+        return API_CONFIGURED_SUCCESSFULLY
+    
+    def warm_up(self) -> Optional[str]:
+        """Сконфигурировать API и создать объект модели заранее"""
+        return warm_up()
     
     async def test_gemini_connection(self) -> bool:
         """
@@ -461,7 +1773,9 @@ class MishuraGeminiAI:
         return await test_gemini_connection()
     
     async def analyze_clothing_image(self, image_data: bytes, occasion: str, 
-                                   preferences: Optional[str] = None) -> str:
+                                   preferences: Optional[str] = None,
+                                   user_id: Optional[int] = None,
+                                   usage: Optional[Dict[str, Any]] = None) -> str:
         """
         Анализирует одежду на изображении с помощью Gemini AI.
         
@@ -469,14 +1783,17 @@ class MishuraGeminiAI:
             image_data: Бинарные данные изображения
             occasion: Повод для консультации
             preferences: Предпочтения пользователя
+            user_id: Пользователь (для поиска его почти одинаковых фото)
+            usage: Словарь, в который записываются токены, задержка, модель и стоимость
             
         Returns:
             str: Анализ и рекомендации
         """
-        return await analyze_clothing_image(image_data, occasion, preferences)
+        return await analyze_clothing_image(image_data, occasion, preferences, user_id, usage)
     
     async def compare_clothing_images(self, image_data_list: List[bytes], occasion: str, 
-                                    preferences: Optional[str] = None) -> str:
+                                    preferences: Optional[str] = None,
+                                    usage: Optional[Dict[str, Any]] = None) -> str:
         """
         Сравнивает несколько образов одежды.
         
@@ -484,11 +1801,25 @@ class MishuraGeminiAI:
             image_data_list: Список бинарных данных изображений
             occasion: Повод для консультации
             preferences: Предпочтения пользователя
+            usage: Словарь, в который записываются токены, задержка, модель и стоимость
             
         Returns:
             str: Сравнительный анализ
         """
-        return await compare_clothing_images(image_data_list, occasion, preferences)
+        return await compare_clothing_images(image_data_list, occasion, preferences, usage)
+    
+    def stream_clothing_analysis(self, image_data: bytes, occasion: str,
+                                 preferences: Optional[str] = None,
+                                 user_id: Optional[int] = None,
+                                 usage: Optional[Dict[str, Any]] = None) -> AsyncIterator[str]:
+        """Потоковый анализ: асинхронный итератор фрагментов текста"""
+        return stream_clothing_analysis(image_data, occasion, preferences, user_id, usage)
+    
+    def stream_clothing_comparison(self, image_data_list: List[bytes], occasion: str,
+                                   preferences: Optional[str] = None,
+                                   usage: Optional[Dict[str, Any]] = None) -> AsyncIterator[str]:
+        """Потоковое сравнение: асинхронный итератор фрагментов текста"""
+        return stream_clothing_comparison(image_data_list, occasion, preferences, usage)
     
     def get_model_info(self) -> Dict[str, Any]:
         """
@@ -499,10 +1830,25 @@ class MishuraGeminiAI:
         """
         return {
             "model_name": self.model_name,
+            "backend": GEMINI_BACKEND,
             "api_configured": self.api_configured,
             "version": __version__,
             "max_retries": MAX_RETRIES,
-            "retry_delay": RETRY_DELAY
+            "retry_base_delay": RETRY_BASE_DELAY,
+            "attempt_timeout": GEMINI_ATTEMPT_TIMEOUT,
+            "circuit_breaker": circuit_breaker.get_stats(),
+            "routing": model_router.get_stats(),
+            "api_keys": key_pool.get_stats(),
+            "max_concurrency": GEMINI_MAX_CONCURRENCY,
+            "prompt_version": PROMPT_VERSION,
+            "system_instruction": _SDK_SUPPORTS_SYSTEM_INSTRUCTION,
+            "prompt_cache": {
+                "analysis": _analysis_request_prompt.cache_info()._asdict(),
+                "comparison": _comparison_request_prompt.cache_info()._asdict(),
+            },
+            "cache": self.cache_manager.get_stats(),
+            "near_duplicates": phash_index.get_stats(),
+            "coalescing": inflight.get_stats()
         }
 
 # Тестирование при прямом запуске
@@ -0,0 +1,236 @@
+"""
+==========================================================================================
+ПРОЕКТ: МИШУРА - Ваш персональный ИИ-Стилист
+КОМПОНЕНТ: Планировщик запросов к Gemini (gemini_scheduler.py)
+
+Ограничивает одновременные запросы к Gemini: общий лимит и лимит на
+пользователя. Запросы сверх лимита ждут в ограниченной очереди с приоритетом
+(пользователи с оплатой обслуживаются первыми). Когда очередь заполнена,
+запрос отклоняется сразу - до списания средств - с оценкой Retry-After.
+==========================================================================================
+"""
+import os
+import time
+import math
+import heapq
+import asyncio
+import logging
+import itertools
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Лимиты планировщика
+GEMINI_SCHEDULER_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", 8))
+GEMINI_PER_USER_CONCURRENCY = int(os.getenv("GEMINI_PER_USER_CONCURRENCY", 2))
+# Сколько запросов одного пользователя может выполняться и ждать одновременно
+GEMINI_PER_USER_MAX_PENDING = int(os.getenv("GEMINI_PER_USER_MAX_PENDING", 4))
+GEMINI_QUEUE_SIZE = int(os.getenv("GEMINI_QUEUE_SIZE", 32))
+
+# Приоритеты: меньше - раньше
+PRIORITY_PAID = 0
+PRIORITY_FREE = 1
+PRIORITY_NAMES = {PRIORITY_PAID: "paid", PRIORITY_FREE: "free"}
+
+# Окно для перцентилей времени ожидания
+WAIT_SAMPLES = 1000
+
+
+class SchedulerBusyError(Exception):
+    """Очередь заполнена (или превышен лимит пользователя) - повторить позже"""
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class GeminiTicket:
+    """
+    Место в очереди планировщика. Создается через GeminiScheduler.reserve()
+    до списания средств; run() дожидается слота и выполняет запрос;
+    release() освобождает слот или место в очереди (повторный вызов безопасен).
+    """
+
+    def __init__(self, scheduler: "GeminiScheduler", user_id: Any, priority: int):
+        self.scheduler = scheduler
+        self.user_id = user_id
+        self.priority = priority
+        self.enqueued_at = time.monotonic()
+        self.started_at: Optional[float] = None
+        self.granted: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.released = False
+        self._on_release: List[Callable[[], Any]] = []
+
+    def add_release_callback(self, callback: Callable[[], Any]):
+        """Вызвать callback при освобождении места (один раз)"""
+        if self.released:
+            callback()
+        else:
+            self._on_release.append(callback)
+
+    async def acquire(self):
+        """Дождаться своей очереди"""
+        await asyncio.shield(self.granted)
+
+    async def run(self, func: Callable[[], Awaitable[Any]]) -> Any:
+        """Выполнить запрос в выделенном слоте и освободить его"""
+        try:
+            await self.acquire()
+            return await func()
+        finally:
+            self.release()
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.scheduler._release(self)
+            for callback in self._on_release:
+                try:
+                    callback()
+                except Exception as e:
+                    logger.error(f"❌ Ошибка callback при освобождении места: {e}")
+
+
+class GeminiScheduler:
+    """
+    🚦 Общий и пользовательский лимиты одновременных запросов к Gemini
+    с ограниченной приоритетной очередью и метриками ожидания.
+    Работает в одном event loop (без блокировок).
+    """
+
+    def __init__(self, max_concurrency: int = GEMINI_SCHEDULER_MAX_CONCURRENCY,
+                 per_user_concurrency: int = GEMINI_PER_USER_CONCURRENCY,
+                 per_user_max_pending: int = GEMINI_PER_USER_MAX_PENDING,
+                 max_queue: int = GEMINI_QUEUE_SIZE):
+        self.max_concurrency = max(1, max_concurrency)
+        self.per_user_concurrency = max(1, per_user_concurrency)
+        self.per_user_max_pending = max(self.per_user_concurrency, per_user_max_pending)
+        self.max_queue = max(0, max_queue)
+
+        self._queue: List[tuple] = []
+        self._queued = 0
+        self._seq = itertools.count()
+        self._active = 0
+        self._active_by_user: Dict[Any, int] = {}
+        self._pending_by_user: Dict[Any, int] = {}
+
+        self._wait_times: Dict[int, Deque[float]] = {p: deque(maxlen=WAIT_SAMPLES) for p in PRIORITY_NAMES}
+        self._service_time = 10.0  # EWMA длительности запроса, для Retry-After
+        self.stats = {'admitted': 0, 'queued': 0, 'rejected_queue_full': 0,
+                      'rejected_user_limit': 0, 'cancelled': 0, 'max_queue_depth': 0}
+        logger.info(f"🚦 GeminiScheduler: {self.max_concurrency} одновременно, "
+                    f"{self.per_user_concurrency} на пользователя, очередь {self.max_queue}")
+
+    def _retry_after(self) -> int:
+        """Оценка, через сколько секунд освободится место"""
+        waves = (self._queued + 1) / self.max_concurrency
+        return max(1, math.ceil(waves * self._service_time))
+
+    def _can_start(self, user_id: Any) -> bool:
+        return (self._active < self.max_concurrency
+                and self._active_by_user.get(user_id, 0) < self.per_user_concurrency)
+
+    def _start(self, ticket: GeminiTicket):
+        self._active += 1
+        self._active_by_user[ticket.user_id] = self._active_by_user.get(ticket.user_id, 0) + 1
+        ticket.started_at = time.monotonic()
+        self._wait_times[ticket.priority].append(ticket.started_at - ticket.enqueued_at)
+        ticket.granted.set_result(None)
+
+    def reserve(self, user_id: Any, priority: int = PRIORITY_FREE) -> GeminiTicket:
+        """
+        Занять место: сразу получить слот, встать в очередь или получить
+        SchedulerBusyError (очередь полна / у пользователя слишком много запросов).
+        """
+        pending = self._pending_by_user.get(user_id, 0)
+        if pending >= self.per_user_max_pending:
+            self.stats['rejected_user_limit'] += 1
+            raise SchedulerBusyError("Слишком много одновременных запросов от пользователя",
+                                     max(1, math.ceil(self._service_time)))
+
+        ticket = GeminiTicket(self, user_id, priority)
+        if not self._queue and self._can_start(user_id):
+            self._start(ticket)
+        else:
+            if self._queued >= self.max_queue:
+                self.stats['rejected_queue_full'] += 1
+                raise SchedulerBusyError("Очередь запросов заполнена", self._retry_after())
+            heapq.heappush(self._queue, (priority, next(self._seq), ticket))
+            self._queued += 1
+            self.stats['queued'] += 1
+            self.stats['max_queue_depth'] = max(self.stats['max_queue_depth'], self._queued)
+
+        self._pending_by_user[user_id] = pending + 1
+        self.stats['admitted'] += 1
+        if not ticket.granted.done():
+            # Впереди могут быть только запросы, упершиеся в лимит своего пользователя
+            self._dispatch()
+        return ticket
+
+    def _release(self, ticket: GeminiTicket):
+        user_id = ticket.user_id
+        pending = self._pending_by_user.get(user_id, 1) - 1
+        if pending:
+            self._pending_by_user[user_id] = pending
+        else:
+            self._pending_by_user.pop(user_id, None)
+
+        if ticket.started_at is not None:
+            self._active -= 1
+            active = self._active_by_user.get(user_id, 1) - 1
+            if active:
+                self._active_by_user[user_id] = active
+            else:
+                self._active_by_user.pop(user_id, None)
+            duration = time.monotonic() - ticket.started_at
+            self._service_time = 0.8 * self._service_time + 0.2 * duration
+        else:
+            # Ушел из очереди, не дождавшись слота: запись удаляется лениво в _dispatch
+            self._queued -= 1
+            self.stats['cancelled'] += 1
+            ticket.granted.cancel()
+        self._dispatch()
+
+    def _dispatch(self):
+        """Запустить ожидающие запросы в порядке приоритета, пока есть слоты"""
+        skipped = []
+        while self._queue and self._active < self.max_concurrency:
+            item = heapq.heappop(self._queue)
+            ticket = item[2]
+            if ticket.released:
+                continue
+            if self._can_start(ticket.user_id):
+                self._queued -= 1
+                self._start(ticket)
+            else:
+                # Лимит пользователя исчерпан - пропускаем его, не блокируя остальных
+                skipped.append(item)
+        for item in skipped:
+            heapq.heappush(self._queue, item)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Метрики: глубина очереди, занятые слоты, время ожидания по приоритетам"""
+        wait_times = {}
+        for priority, samples in self._wait_times.items():
+            ordered = sorted(samples)
+            wait_times[PRIORITY_NAMES[priority]] = {
+                'samples': len(ordered),
+                'avg_ms': round(sum(ordered) / len(ordered) * 1000, 1) if ordered else 0,
+                'p95_ms': round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000, 1) if ordered else 0,
+                'max_ms': round(ordered[-1] * 1000, 1) if ordered else 0,
+            }
+        return {
+            **self.stats,
+            'active': self._active,
+            'queue_depth': self._queued,
+            'max_concurrency': self.max_concurrency,
+            'per_user_concurrency': self.per_user_concurrency,
+            'per_user_max_pending': self.per_user_max_pending,
+            'max_queue': self.max_queue,
+            'avg_service_time_s': round(self._service_time, 2),
+            'wait_times': wait_times,
+        }
+
+
+gemini_scheduler = GeminiScheduler()
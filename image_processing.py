@@ -0,0 +1,236 @@
+"""
+==========================================================================================
+ПРОЕКТ: МИШУРА - Ваш персональный ИИ-Стилист
+КОМПОНЕНТ: Подготовка изображений (image_processing.py)
+
+Декодирование, уменьшение, JPEG-кодирование и перцептивный хеш выполняются
+в пуле процессов, чтобы CPU-нагрузка не задерживала event loop и другие
+запросы. Модуль намеренно не импортирует Gemini SDK: дочерние процессы
+загружают только PIL и NumPy.
+==========================================================================================
+"""
+import os
+import asyncio
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+from typing import Optional, Tuple, Union
+
+from PIL import Image
+
+# NumPy нужен только для перцептивного хеша (поиск почти одинаковых фото)
+try:
+    import numpy as np
+    NUMPY_AVAILABLE = True
+except ImportError:
+    NUMPY_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+# Процессы для подготовки изображений: по числу ядер, 0 - выполнять в потоке
+IMAGE_POOL_WORKERS = int(os.getenv("IMAGE_POOL_WORKERS", os.cpu_count() or 1))
+# Процессы не форкаются от сервера: к моменту (пере)создания пула в нем уже
+# работают потоки executor'ов и каналы gRPC, а fork при них небезопасен
+IMAGE_POOL_START_METHOD = os.getenv(
+    "IMAGE_POOL_START_METHOD",
+    "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+)
+
+# Быстрый путь: уже маленький JPEG отправляется без перекодирования
+IMAGE_PASSTHROUGH_ENABLED = os.getenv("IMAGE_PASSTHROUGH_ENABLED", "true").lower() == "true"
+IMAGE_PASSTHROUGH_MAX_BYTES = int(os.getenv("IMAGE_PASSTHROUGH_MAX_BYTES", 1024 * 1024))
+
+# Стандартная таблица квантования яркости JPEG (ITU T.81, приложение K) -
+# по ней оценивается качество, с которым сохранен исходный файл
+_STD_LUMINANCE_QTABLE_SUM = sum((
+    16, 11, 10, 16, 24, 40, 51, 61, 12, 12, 14, 19, 26, 58, 60, 55,
+    14, 13, 16, 24, 40, 57, 69, 56, 14, 17, 22, 29, 51, 87, 80, 62,
+    18, 22, 37, 56, 68, 109, 103, 77, 24, 35, 55, 64, 81, 104, 113, 92,
+    49, 64, 78, 87, 103, 121, 120, 101, 72, 92, 95, 98, 112, 100, 103, 99,
+))
+
+_image_pool: Optional[ProcessPoolExecutor] = None
+
+
+def compute_dhash(img_pil: Image.Image) -> Optional[int]:
+    """
+    Разностный хеш (dHash) изображения: 64 бита, устойчив к пережатию,
+    изменению размера и небольшой обрезке. None, если NumPy недоступен.
+    """
+    if not NUMPY_AVAILABLE:
+        return None
+    small = img_pil.convert("L").resize((9, 8), Image.Resampling.BOX)
+    pixels = np.asarray(small, dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+def optimize_image(img_pil: Image.Image, max_size: int = 1024, quality: int = 85,
+                   return_hash: bool = False) -> Union[bytes, Tuple[bytes, Optional[int]]]:
+    """
+    Оптимизирует изображение для отправки в API.
+    
+    Args:
+        img_pil: Объект PIL.Image
+        max_size: Максимальный размер стороны
+        quality: Качество JPEG
+        return_hash: Вернуть также dHash итогового изображения
+        
+    Returns:
+        bytes: Оптимизированные данные изображения
+        (или кортеж (bytes, dhash) при return_hash=True)
+    """
+    logger.info(f"📷 Оптимизация изображения: исходный размер {img_pil.size}")
+    
+    try:
+        # Изменение размера если нужно
+        width, height = img_pil.size
+        if width > max_size or height > max_size:
+            if width > height:
+                new_width = max_size
+                new_height = int(height * (max_size / width))
+            else:
+                new_height = max_size
+                new_width = int(width * (max_size / height))
+            
+            # JPEG декодируется сразу в уменьшенном масштабе (1/2, 1/4, 1/8):
+            # 12-мегапиксельное фото не разворачивается в память целиком
+            if img_pil.format == 'JPEG':
+                img_pil.draft('RGB', (new_width, new_height))
+            
+            # Грубое целочисленное уменьшение до ~2x от цели, затем точный LANCZOS
+            factor = min(img_pil.width // new_width, img_pil.height // new_height) // 2
+            if factor >= 2:
+                img_pil = img_pil.reduce(factor)
+            
+            img_pil = img_pil.resize((new_width, new_height), Image.Resampling.LANCZOS)
+            logger.info(f"📏 Размер изменен на {new_width}x{new_height}")
+        
+        # Конвертация в RGB если нужно
+        if img_pil.mode in ('RGBA', 'LA') or (img_pil.mode == 'P' and 'transparency' in img_pil.info):
+            background = Image.new("RGB", img_pil.size, (255, 255, 255))
+            if img_pil.mode == 'P':
+                img_pil = img_pil.convert('RGBA')
+            background.paste(img_pil, mask=img_pil.split()[-1] if img_pil.mode == 'RGBA' else None)
+            img_pil = background
+        elif img_pil.mode != 'RGB':
+            img_pil = img_pil.convert('RGB')
+        
+        # Сохранение в JPEG
+        img_byte_arr = BytesIO()
+        img_pil.save(img_byte_arr, format='JPEG', quality=quality, optimize=True)
+        optimized_bytes = img_byte_arr.getvalue()
+        
+        logger.info(f"✅ Изображение оптимизировано: {len(optimized_bytes)} байт")
+        if return_hash:
+            return optimized_bytes, compute_dhash(img_pil)
+        return optimized_bytes
+        
+    except Exception as e:
+        logger.error(f"❌ Ошибка оптимизации изображения: {str(e)}")
+        raise ValueError(f"Ошибка оптимизации изображения: {str(e)}")
+
+
+def estimate_jpeg_quality(img_pil: Image.Image) -> Optional[int]:
+    """Оценка качества (1-100), с которым сохранен JPEG, по таблице квантования яркости"""
+    qtables = getattr(img_pil, 'quantization', None)
+    if not qtables or 0 not in qtables:
+        return None
+    scale = sum(qtables[0]) * 100.0 / _STD_LUMINANCE_QTABLE_SUM
+    if scale <= 100:
+        return max(1, min(100, round((200 - scale) / 2)))
+    return max(1, round(5000 / scale))
+
+
+def can_passthrough(img_pil: Image.Image, image_data: bytes,
+                    max_size: int = 1024, quality: int = 85) -> bool:
+    """
+    Можно ли отправить исходные байты без перекодирования: это JPEG в RGB/L,
+    не больше max_size по сторонам, не тяжелее лимита, сохраненный с качеством
+    не выше нашего и без EXIF (метаданные камеры и геолокация не уходят наружу).
+    """
+    if not IMAGE_PASSTHROUGH_ENABLED or img_pil.format != 'JPEG':
+        return False
+    if len(image_data) > IMAGE_PASSTHROUGH_MAX_BYTES:
+        return False
+    if img_pil.mode not in ('RGB', 'L') or max(img_pil.size) > max_size:
+        return False
+    if 'exif' in img_pil.info:
+        return False
+    source_quality = estimate_jpeg_quality(img_pil)
+    return source_quality is not None and source_quality <= quality
+
+
+def preprocess_image_bytes(image_data: bytes, max_size: int = 1024,
+                           quality: int = 85) -> Tuple[bytes, Optional[int]]:
+    """
+    Полная подготовка загруженного изображения: декодирование, оптимизация, dHash.
+    Функция верхнего уровня - выполняется в дочернем процессе.
+    """
+    img = Image.open(BytesIO(image_data))
+    if can_passthrough(img, image_data, max_size, quality):
+        logger.info(f"⚡ JPEG {img.size} уже оптимален, отправляется без перекодирования")
+        # Для хеша достаточно уменьшенного декодирования
+        img.draft('L', (64, 64))
+        return image_data, compute_dhash(img)
+    return optimize_image(img, max_size, quality, return_hash=True)
+
+
+def _warm_up_worker() -> int:
+    """Пустая задача: заставляет процесс пула стартовать и импортировать PIL/NumPy"""
+    return os.getpid()
+
+
+def get_image_pool() -> Optional[ProcessPoolExecutor]:
+    """Пул процессов (создается при первом обращении)"""
+    global _image_pool
+    if IMAGE_POOL_WORKERS <= 0:
+        return None
+    if _image_pool is None:
+        context = multiprocessing.get_context(IMAGE_POOL_START_METHOD)
+        if IMAGE_POOL_START_METHOD == "forkserver":
+            # Fork-сервер загружает только этот модуль, а не __main__ с Gemini SDK
+            context.set_forkserver_preload([__name__])
+        _image_pool = ProcessPoolExecutor(max_workers=IMAGE_POOL_WORKERS, mp_context=context)
+        logger.info(f"🖼️ Пул подготовки изображений: {IMAGE_POOL_WORKERS} процессов ({IMAGE_POOL_START_METHOD})")
+    return _image_pool
+
+
+async def warm_up_image_pool():
+    """Запустить все процессы пула заранее, чтобы первый запрос не ждал их старта"""
+    pool = get_image_pool()
+    if pool is None:
+        return
+    loop = asyncio.get_running_loop()
+    pids = await asyncio.gather(*[loop.run_in_executor(pool, _warm_up_worker) for _ in range(IMAGE_POOL_WORKERS)])
+    logger.info(f"✅ Пул подготовки изображений прогрет ({len(set(pids))} процессов)")
+
+
+async def preprocess_image(image_data: bytes, max_size: int = 1024,
+                           quality: int = 85) -> Tuple[bytes, Optional[int]]:
+    """Подготовить изображение в пуле процессов -> (JPEG-байты, dHash)"""
+    global _image_pool
+    loop = asyncio.get_running_loop()
+    pool = get_image_pool()
+    if pool is not None:
+        try:
+            return await loop.run_in_executor(pool, preprocess_image_bytes, image_data, max_size, quality)
+        except BrokenProcessPool:
+            # Процесс пула упал (например, OOM) - пересоздаем пул при следующем запросе
+            logger.error("❌ Пул подготовки изображений поврежден, выполняем в потоке")
+            # Сбой видят все ожидавшие запросы - старый пул останавливает только первый,
+            # уже пересозданный не трогаем
+            if _image_pool is pool:
+                _image_pool = None
+                pool.shutdown(wait=False, cancel_futures=True)
+    return await loop.run_in_executor(None, preprocess_image_bytes, image_data, max_size, quality)
+
+
+def shutdown_image_pool():
+    """Остановить пул процессов (при остановке сервера)"""
+    global _image_pool
+    if _image_pool is not None:
+        _image_pool.shutdown(wait=False, cancel_futures=True)
+        _image_pool = None
@@ -0,0 +1,551 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+🗄️ МИШУРА - Миграции схемы базы данных
+Единственное место, где описана схема БД (SQLite и PostgreSQL).
+
+Каждая миграция применяется один раз, номер примененной версии хранится
+в таблице schema_version. Запуск: MishuraDB.init_db() при старте сервера
+или `python migrations.py` при деплое.
+"""
+
+import logging
+from typing import Callable, List, Optional, Union
+
+logger = logging.getLogger("MishuraDB")
+
+# Ключ pg_advisory_lock: не дает двум процессам мигрировать одновременно
+PG_MIGRATION_LOCK_ID = 7301947
+
+
+class Migration:
+    """
+    Одна версия схемы: SQL для каждого диалекта или функция (cursor, db_type).
+    transactional=False - в PostgreSQL миграция выполняется вне транзакции
+    (autocommit), например для CREATE INDEX CONCURRENTLY; такие шаги должны
+    быть идемпотентны - при сбое их повторит следующий запуск.
+    """
+
+    def __init__(self, version: int, name: str,
+                 sqlite: Union[str, Callable, None] = None,
+                 postgresql: Union[str, Callable, None] = None,
+                 transactional: bool = True):
+        self.version = version
+        self.name = name
+        self.sqlite = sqlite
+        self.postgresql = postgresql
+        self.transactional = transactional
+
+    def apply(self, cursor, db_type: str):
+        step = self.postgresql if db_type == 'postgresql' else self.sqlite
+        if step is None:
+            return
+        if callable(step):
+            step(cursor, db_type)
+            return
+        # executescript в SQLite делает COMMIT, поэтому выполняем по одному запросу
+        for statement in step.split(';'):
+            statement = statement.strip()
+            if statement:
+                cursor.execute(statement)
+
+
+def _sqlite_add_column(table: str, column: str, definition: str) -> Callable:
+    """ALTER TABLE ADD COLUMN для SQLite, если колонки еще нет"""
+    def step(cursor, db_type):
+        cursor.execute(f"PRAGMA table_info({table})")
+        if column not in [row[1] for row in cursor.fetchall()]:
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+    return step
+
+
+def _pg_create_index_concurrently(index: str, definition: str) -> Callable:
+    """
+    CREATE INDEX CONCURRENTLY для PostgreSQL: таблица не блокируется на запись.
+    Прерванная сборка оставляет невалидный индекс - его пересоздаем.
+    """
+    def step(cursor, db_type):
+        cursor.execute(
+            "SELECT i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+            "WHERE c.relname = %s", (index,)
+        )
+        row = cursor.fetchone()
+        if row is not None and not row[0]:
+            logger.warning(f"🗄️ Индекс {index} невалиден (прерванная сборка), пересоздаем")
+            cursor.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {index}")
+        cursor.execute(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {index} ON {definition}")
+    return step
+
+
+def _run_steps(*steps: Callable) -> Callable:
+    """Несколько шагов-функций одной миграции по порядку"""
+    def step(cursor, db_type):
+        for item in steps:
+            item(cursor, db_type)
+    return step
+
+
+MIGRATIONS: List[Migration] = [
+    Migration(1, 'core_schema', sqlite="""
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            telegram_id INTEGER UNIQUE NOT NULL,
+            username TEXT,
+            first_name TEXT,
+            last_name TEXT,
+            balance INTEGER DEFAULT 200,  -- STcoin баланс (стартовый бонус 200)
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+
+        CREATE TABLE IF NOT EXISTS consultations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            occasion TEXT,
+            preferences TEXT,
+            image_path TEXT,
+            advice TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(id)
+        );
+
+        CREATE TABLE IF NOT EXISTS payments (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            payment_id TEXT UNIQUE NOT NULL,
+            yookassa_payment_id TEXT,
+            user_id INTEGER NOT NULL,
+            telegram_id INTEGER NOT NULL,
+            plan_id TEXT NOT NULL,
+            amount REAL NOT NULL,
+            currency TEXT DEFAULT 'RUB',
+            status TEXT DEFAULT 'pending',
+            stcoins_amount INTEGER NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            processed_at TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(id),
+            FOREIGN KEY (telegram_id) REFERENCES users(telegram_id)
+        );
+
+        CREATE TABLE IF NOT EXISTS wardrobe (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            telegram_file_id TEXT NOT NULL,
+            item_name TEXT,
+            item_tag TEXT,
+            category TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(id)
+        );
+
+        CREATE INDEX IF NOT EXISTS idx_users_telegram_id ON users(telegram_id);
+        CREATE INDEX IF NOT EXISTS idx_consultations_user_id ON consultations(user_id);
+        CREATE INDEX IF NOT EXISTS idx_consultations_created_at ON consultations(created_at);
+        CREATE INDEX IF NOT EXISTS idx_payments_telegram_id ON payments(telegram_id);
+        CREATE INDEX IF NOT EXISTS idx_payments_payment_id ON payments(payment_id);
+        CREATE INDEX IF NOT EXISTS idx_payments_yookassa_id ON payments(yookassa_payment_id);
+        CREATE INDEX IF NOT EXISTS idx_payments_status ON payments(status);
+        CREATE INDEX IF NOT EXISTS idx_wardrobe_user_id ON wardrobe(user_id);
+
+        -- Демонстрационный пользователь
+        INSERT OR IGNORE INTO users (telegram_id, username, first_name, last_name, balance)
+        VALUES (12345, 'demo_user', 'Демо', 'Пользователь', 200)
+    """, postgresql="""
+        CREATE TABLE IF NOT EXISTS users (
+            id SERIAL PRIMARY KEY,
+            telegram_id BIGINT UNIQUE NOT NULL,
+            username TEXT,
+            first_name TEXT,
+            last_name TEXT,
+            balance INTEGER DEFAULT 200,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+
+        CREATE TABLE IF NOT EXISTS consultations (
+            id SERIAL PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            occasion TEXT,
+            preferences TEXT,
+            image_path TEXT,
+            advice TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(id)
+        );
+
+        CREATE TABLE IF NOT EXISTS payments (
+            id SERIAL PRIMARY KEY,
+            payment_id TEXT UNIQUE NOT NULL,
+            yookassa_payment_id TEXT,
+            user_id INTEGER NOT NULL,
+            telegram_id BIGINT NOT NULL,
+            plan_id TEXT NOT NULL,
+            amount DECIMAL(10,2) NOT NULL,
+            currency TEXT DEFAULT 'RUB',
+            status TEXT DEFAULT 'pending',
+            stcoins_amount INTEGER NOT NULL,
+            error_message TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            processed_at TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(id)
+        );
+
+        CREATE TABLE IF NOT EXISTS wardrobe (
+            id SERIAL PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            telegram_file_id TEXT NOT NULL,
+            item_name TEXT,
+            item_tag TEXT,
+            category TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(id)
+        );
+
+        CREATE INDEX IF NOT EXISTS idx_users_telegram_id ON users(telegram_id);
+        CREATE INDEX IF NOT EXISTS idx_consultations_user_id ON consultations(user_id);
+        CREATE INDEX IF NOT EXISTS idx_payments_telegram_id ON payments(telegram_id);
+        CREATE INDEX IF NOT EXISTS idx_payments_payment_id ON payments(payment_id);
+        CREATE INDEX IF NOT EXISTS idx_payments_yookassa_id ON payments(yookassa_payment_id);
+        CREATE INDEX IF NOT EXISTS idx_wardrobe_user_id ON wardrobe(user_id)
+    """),
+
+    Migration(2, 'feedback_tables', sqlite="""
+        CREATE TABLE IF NOT EXISTS feedback_submissions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            telegram_id INTEGER NOT NULL,
+            feedback_text TEXT NOT NULL,
+            feedback_rating TEXT DEFAULT 'positive',
+            character_count INTEGER NOT NULL,
+            consultation_id INTEGER,
+            ip_address TEXT,
+            user_agent TEXT,
+            google_sheets_synced INTEGER DEFAULT 0,
+            google_sheets_row_id TEXT,
+            bonus_awarded INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (consultation_id) REFERENCES consultations(id)
+        );
+
+        CREATE TABLE IF NOT EXISTS feedback_prompts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            telegram_id INTEGER NOT NULL,
+            consultation_id INTEGER NOT NULL,
+            prompt_shown_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            user_action TEXT DEFAULT 'shown',
+            dismissal_reason TEXT,
+            FOREIGN KEY (consultation_id) REFERENCES consultations(id)
+        );
+
+        CREATE INDEX IF NOT EXISTS idx_feedback_telegram_id ON feedback_submissions(telegram_id);
+        CREATE INDEX IF NOT EXISTS idx_feedback_created_at ON feedback_submissions(created_at);
+        CREATE INDEX IF NOT EXISTS idx_prompts_telegram_user_time ON feedback_prompts(telegram_id, prompt_shown_at)
+    """, postgresql="""
+        CREATE TABLE IF NOT EXISTS feedback_submissions (
+            id SERIAL PRIMARY KEY,
+            telegram_id BIGINT NOT NULL,
+            feedback_text TEXT NOT NULL,
+            feedback_rating VARCHAR(10) DEFAULT 'positive',
+            character_count INTEGER NOT NULL,
+            consultation_id INTEGER,
+            ip_address VARCHAR(45),
+            user_agent TEXT,
+            google_sheets_synced BOOLEAN DEFAULT FALSE,
+            google_sheets_row_id VARCHAR(50),
+            bonus_awarded BOOLEAN DEFAULT FALSE,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (consultation_id) REFERENCES consultations(id)
+        );
+
+        CREATE TABLE IF NOT EXISTS feedback_prompts (
+            id SERIAL PRIMARY KEY,
+            telegram_id BIGINT NOT NULL,
+            consultation_id INTEGER NOT NULL,
+            prompt_shown_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            user_action VARCHAR(20) DEFAULT 'shown',
+            dismissal_reason VARCHAR(50),
+            FOREIGN KEY (consultation_id) REFERENCES consultations(id)
+        );
+
+        CREATE INDEX IF NOT EXISTS idx_feedback_telegram_id ON feedback_submissions(telegram_id);
+        CREATE INDEX IF NOT EXISTS idx_feedback_created_at ON feedback_submissions(created_at);
+        CREATE INDEX IF NOT EXISTS idx_prompts_telegram_user_time ON feedback_prompts(telegram_id, prompt_shown_at)
+    """),
+
+    Migration(3, 'financial_tables', sqlite="""
+        -- Аудит транзакций
+        CREATE TABLE IF NOT EXISTS transaction_log (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            telegram_id INTEGER NOT NULL,
+            operation_type TEXT NOT NULL,
+            transaction_type TEXT NOT NULL,
+            amount INTEGER NOT NULL,
+            balance_before INTEGER NOT NULL,
+            balance_after INTEGER NOT NULL,
+            operation_id TEXT UNIQUE NOT NULL,
+            correlation_id TEXT,
+            metadata TEXT DEFAULT '{}',
+            status TEXT DEFAULT 'completed',
+            error_message TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            created_by TEXT DEFAULT 'system'
+        );
+
+        -- Optimistic locking балансов
+        CREATE TABLE IF NOT EXISTS balance_locks (
+            telegram_id INTEGER PRIMARY KEY,
+            version_number INTEGER DEFAULT 1,
+            last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            locked_by TEXT,
+            lock_expires_at TIMESTAMP
+        );
+
+        CREATE INDEX IF NOT EXISTS idx_tlog_user_time ON transaction_log (telegram_id, created_at DESC);
+        CREATE INDEX IF NOT EXISTS idx_tlog_operation_id ON transaction_log (operation_id);
+        CREATE INDEX IF NOT EXISTS idx_tlog_correlation ON transaction_log (correlation_id)
+    """, postgresql="""
+        -- Аудит транзакций
+        CREATE TABLE IF NOT EXISTS transaction_log (
+            id BIGSERIAL PRIMARY KEY,
+            telegram_id BIGINT NOT NULL,
+            operation_type VARCHAR(50) NOT NULL,
+            transaction_type VARCHAR(20) NOT NULL,
+            amount INTEGER NOT NULL,
+            balance_before INTEGER NOT NULL,
+            balance_after INTEGER NOT NULL,
+            operation_id VARCHAR(255) UNIQUE NOT NULL,
+            correlation_id VARCHAR(255),
+            metadata JSONB DEFAULT '{}',
+            status VARCHAR(20) DEFAULT 'completed',
+            error_message TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            created_by VARCHAR(100) DEFAULT 'system'
+        );
+
+        -- Optimistic locking балансов
+        CREATE TABLE IF NOT EXISTS balance_locks (
+            telegram_id BIGINT PRIMARY KEY,
+            version_number INTEGER DEFAULT 1,
+            last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            locked_by VARCHAR(255),
+            lock_expires_at TIMESTAMP
+        );
+
+        CREATE INDEX IF NOT EXISTS idx_tlog_user_time ON transaction_log (telegram_id, created_at DESC);
+        CREATE INDEX IF NOT EXISTS idx_tlog_operation_id ON transaction_log (operation_id);
+        CREATE INDEX IF NOT EXISTS idx_tlog_correlation ON transaction_log (correlation_id)
+    """),
+
+    # В schema.sql SQLite колонки не было, хотя update_payment_status ее пишет
+    Migration(4, 'payments_error_message',
+              sqlite=_sqlite_add_column('payments', 'error_message', 'TEXT'),
+              postgresql="ALTER TABLE payments ADD COLUMN IF NOT EXISTS error_message TEXT"),
+
+    Migration(5, 'consultations_user_created_index', sqlite="""
+        CREATE INDEX IF NOT EXISTS idx_consultations_user_created
+            ON consultations(user_id, created_at DESC, id DESC)
+    """, postgresql=_pg_create_index_concurrently(
+        'idx_consultations_user_created', 'consultations(user_id, created_at DESC, id DESC)'
+    ), transactional=False),
+
+    # Постоянный уровень кеша анализов Gemini (expires_at - unix-время)
+    Migration(6, 'analysis_cache', sqlite="""
+        CREATE TABLE IF NOT EXISTS analysis_cache (
+            cache_key TEXT PRIMARY KEY,
+            kind TEXT NOT NULL,
+            advice TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            expires_at INTEGER NOT NULL
+        );
+
+        CREATE INDEX IF NOT EXISTS idx_analysis_cache_expires ON analysis_cache(expires_at)
+    """, postgresql="""
+        CREATE TABLE IF NOT EXISTS analysis_cache (
+            cache_key VARCHAR(64) PRIMARY KEY,
+            kind VARCHAR(20) NOT NULL,
+            advice TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            expires_at BIGINT NOT NULL
+        );
+
+        CREATE INDEX IF NOT EXISTS idx_analysis_cache_expires ON analysis_cache(expires_at)
+    """),
+
+    # Учет токенов, задержки и стоимости Gemini для каждой консультации
+    Migration(7, 'consultation_usage', sqlite="""
+        CREATE TABLE IF NOT EXISTS consultation_usage (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            consultation_id INTEGER,
+            telegram_id INTEGER NOT NULL,
+            endpoint TEXT NOT NULL,
+            source TEXT NOT NULL,
+            model TEXT,
+            images INTEGER DEFAULT 0,
+            prompt_tokens INTEGER DEFAULT 0,
+            image_tokens INTEGER DEFAULT 0,
+            output_tokens INTEGER DEFAULT 0,
+            total_tokens INTEGER DEFAULT 0,
+            tokens_estimated INTEGER DEFAULT 0,
+            attempts INTEGER DEFAULT 0,
+            gemini_latency_ms INTEGER,
+            total_latency_ms INTEGER,
+            cost_usd REAL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (consultation_id) REFERENCES consultations(id)
+        );
+
+        CREATE INDEX IF NOT EXISTS idx_usage_created_at ON consultation_usage(created_at);
+        CREATE INDEX IF NOT EXISTS idx_usage_user_created ON consultation_usage(telegram_id, created_at);
+        CREATE INDEX IF NOT EXISTS idx_usage_consultation_id ON consultation_usage(consultation_id)
+    """, postgresql="""
+        CREATE TABLE IF NOT EXISTS consultation_usage (
+            id BIGSERIAL PRIMARY KEY,
+            consultation_id INTEGER,
+            telegram_id BIGINT NOT NULL,
+            endpoint VARCHAR(50) NOT NULL,
+            source VARCHAR(20) NOT NULL,
+            model VARCHAR(100),
+            images INTEGER DEFAULT 0,
+            prompt_tokens INTEGER DEFAULT 0,
+            image_tokens INTEGER DEFAULT 0,
+            output_tokens INTEGER DEFAULT 0,
+            total_tokens INTEGER DEFAULT 0,
+            tokens_estimated BOOLEAN DEFAULT FALSE,
+            attempts INTEGER DEFAULT 0,
+            gemini_latency_ms INTEGER,
+            total_latency_ms INTEGER,
+            cost_usd NUMERIC(12,8) DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (consultation_id) REFERENCES consultations(id)
+        );
+
+        CREATE INDEX IF NOT EXISTS idx_usage_created_at ON consultation_usage(created_at);
+        CREATE INDEX IF NOT EXISTS idx_usage_user_created ON consultation_usage(telegram_id, created_at);
+        CREATE INDEX IF NOT EXISTS idx_usage_consultation_id ON consultation_usage(consultation_id)
+    """),
+
+    # Индексы из schema.sql, которых не было в исходной схеме PostgreSQL
+    # (в SQLite они создаются миграцией 1)
+    Migration(8, 'postgres_history_status_indexes', postgresql=_run_steps(
+        _pg_create_index_concurrently('idx_consultations_created_at', 'consultations(created_at)'),
+        _pg_create_index_concurrently('idx_payments_status', 'payments(status)'),
+    ), transactional=False),
+
+    # Вызовы Gemini, ответа которых не дождались (проигравший hedged-запрос,
+    # таймаут попытки): Gemini их тарифицирует, но в токены консультации они не входят
+    Migration(9, 'consultation_usage_abandoned_calls',
+              sqlite=_sqlite_add_column('consultation_usage', 'abandoned_calls', 'INTEGER DEFAULT 0'),
+              postgresql="ALTER TABLE consultation_usage ADD COLUMN IF NOT EXISTS abandoned_calls INTEGER DEFAULT 0"),
+]
+
+LATEST_VERSION = MIGRATIONS[-1].version
+
+_SCHEMA_VERSION_DDL = """
+    CREATE TABLE IF NOT EXISTS schema_version (
+        version INTEGER PRIMARY KEY,
+        name TEXT NOT NULL,
+        applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+"""
+
+
+def get_schema_version(cursor) -> int:
+    """Текущая версия схемы (0 - таблицы schema_version еще нет)"""
+    try:
+        cursor.execute("SELECT MAX(version) FROM schema_version")
+        row = cursor.fetchone()
+    except Exception:
+        return 0
+    return (row[0] or 0) if row else 0
+
+
+def apply_migrations(conn, db_type: str, target: Optional[int] = None) -> List[int]:
+    """
+    Применить недостающие миграции на соединении conn. Возвращает примененные версии.
+    PostgreSQL: каждая миграция в своей транзакции под pg_advisory_lock.
+    SQLite: все миграции в одной транзакции BEGIN IMMEDIATE (блокирует других писателей).
+    """
+    target = LATEST_VERSION if target is None else target
+    cursor = conn.cursor()
+
+    if db_type == 'postgresql':
+        return _apply_postgres(conn, cursor, target)
+    return _apply_sqlite(conn, cursor, target)
+
+
+def _pending(current: int, target: int) -> List[Migration]:
+    return [m for m in MIGRATIONS if current < m.version <= target]
+
+
+def _record(cursor, migration: Migration, placeholder: str):
+    cursor.execute(
+        f"INSERT INTO schema_version (version, name) VALUES ({placeholder}, {placeholder})",
+        (migration.version, migration.name)
+    )
+
+
+def _apply_sqlite(conn, cursor, target: int) -> List[int]:
+    # Быстрый путь без блокировки записи: схема уже актуальна
+    if get_schema_version(cursor) >= target:
+        return []
+
+    applied = []
+    cursor.execute("BEGIN IMMEDIATE")
+    try:
+        cursor.execute(_SCHEMA_VERSION_DDL)
+        current = get_schema_version(cursor)
+        for migration in _pending(current, target):
+            logger.info(f"🗄️ Миграция {migration.version}: {migration.name}")
+            migration.apply(cursor, 'sqlite')
+            _record(cursor, migration, '?')
+            applied.append(migration.version)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return applied
+
+
+def _apply_postgres(conn, cursor, target: int) -> List[int]:
+    if get_schema_version(cursor) >= target:
+        conn.rollback()
+        return []
+    conn.rollback()
+
+    applied = []
+    cursor.execute("SELECT pg_advisory_lock(%s)", (PG_MIGRATION_LOCK_ID,))
+    try:
+        cursor.execute(_SCHEMA_VERSION_DDL)
+        conn.commit()
+        # Пока ждали блокировку, миграции мог применить другой процесс
+        current = get_schema_version(cursor)
+        for migration in _pending(current, target):
+            logger.info(f"🗄️ Миграция {migration.version}: {migration.name}")
+            try:
+                if migration.transactional:
+                    migration.apply(cursor, 'postgresql')
+                else:
+                    # CONCURRENTLY нельзя выполнять внутри транзакции
+                    conn.commit()
+                    conn.autocommit = True
+                    try:
+                        migration.apply(cursor, 'postgresql')
+                    finally:
+                        conn.autocommit = False
+                _record(cursor, migration, '%s')
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            applied.append(migration.version)
+    finally:
+        conn.rollback()
+        cursor.execute("SELECT pg_advisory_unlock(%s)", (PG_MIGRATION_LOCK_ID,))
+        conn.commit()
+    return applied
+
+
+if __name__ == "__main__":
+    from database import MishuraDB
+    MishuraDB().init_db()
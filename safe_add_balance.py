@@ -20,6 +20,7 @@ def safe_add_balance(telegram_id, amount):
             pass
         
         db = MishuraDB()
+        db.init_db()
         
         # Получаем текущий баланс
         current_balance = db.get_user_balance(telegram_id)
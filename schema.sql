@@ -1,78 +0,0 @@
--- ==========================================================================================
--- ПРОЕКТ: МИШУРА - Ваш персональный ИИ-Стилист
--- КОМПОНЕНТ: Схема базы данных SQLite (schema.sql)
--- ВЕРСИЯ: 1.5.0 - ИСПРАВЛЕНЫ FOREIGN KEY связи
--- ДАТА ОБНОВЛЕНИЯ: 2025-06-20
--- ==========================================================================================
-
--- Включаем поддержку внешних ключей
-PRAGMA foreign_keys = ON;
-
--- Таблица пользователей
-CREATE TABLE IF NOT EXISTS users (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    telegram_id INTEGER UNIQUE NOT NULL,
-    username TEXT,
-    first_name TEXT,
-    last_name TEXT,
-    balance INTEGER DEFAULT 200,  -- STcoin баланс (стартовый бонус 200)
-    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-);
-
--- Таблица консультаций (ИСПРАВЛЕНО: user_id ссылается на users.id)
-CREATE TABLE IF NOT EXISTS consultations (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    user_id INTEGER NOT NULL,
-    occasion TEXT,
-    preferences TEXT,
-    image_path TEXT,
-    advice TEXT,
-    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-    FOREIGN KEY (user_id) REFERENCES users(id)
-);
-
--- Таблица платежей
-CREATE TABLE IF NOT EXISTS payments (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    payment_id TEXT UNIQUE NOT NULL,
-    yookassa_payment_id TEXT,
-    user_id INTEGER NOT NULL,
-    telegram_id INTEGER NOT NULL,
-    plan_id TEXT NOT NULL,
-    amount REAL NOT NULL,
-    currency TEXT DEFAULT 'RUB',
-    status TEXT DEFAULT 'pending',
-    stcoins_amount INTEGER NOT NULL,
-    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-    processed_at TIMESTAMP,
-    FOREIGN KEY (user_id) REFERENCES users(id),
-    FOREIGN KEY (telegram_id) REFERENCES users(telegram_id)
-);
-
--- Таблица гардероба пользователей (ИСПРАВЛЕНО: user_id ссылается на users.id)
-CREATE TABLE IF NOT EXISTS wardrobe (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    user_id INTEGER NOT NULL,
-    telegram_file_id TEXT NOT NULL,
-    item_name TEXT,
-    item_tag TEXT,
-    category TEXT,
-    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-    FOREIGN KEY (user_id) REFERENCES users(id)
-);
-
--- Индексы для оптимизации запросов
-CREATE INDEX IF NOT EXISTS idx_users_telegram_id ON users(telegram_id);
-CREATE INDEX IF NOT EXISTS idx_consultations_user_id ON consultations(user_id);
-CREATE INDEX IF NOT EXISTS idx_consultations_created_at ON consultations(created_at);
-CREATE INDEX IF NOT EXISTS idx_payments_telegram_id ON payments(telegram_id);
-CREATE INDEX IF NOT EXISTS idx_payments_payment_id ON payments(payment_id);
-CREATE INDEX IF NOT EXISTS idx_payments_yookassa_id ON payments(yookassa_payment_id);
-CREATE INDEX IF NOT EXISTS idx_payments_status ON payments(status);
-CREATE INDEX IF NOT EXISTS idx_wardrobe_user_id ON wardrobe(user_id);
-
--- Демонстрационные данные (создаются только если таблицы пустые)
-INSERT OR IGNORE INTO users (telegram_id, username, first_name, last_name, balance) 
-VALUES (12345, 'demo_user', 'Демо', 'Пользователь', 200);
\ No newline at end of file
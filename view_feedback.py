@@ -17,6 +17,7 @@ def view_all_feedback():
     
     try:
         db = MishuraDB()
+        db.init_db()
         
         # Получаем все отзывы
         query = """
@@ -87,6 +88,7 @@ def view_user_feedback(telegram_id):
     
     try:
         db = MishuraDB()
+        db.init_db()
         
         query = """
             SELECT id, feedback_text, feedback_rating, character_count, 
@@ -326,6 +326,139 @@ class MishuraAPIService {
         }
     }
 
+    // ⚡ Потоковый запрос (SSE поверх POST): onChunk получает фрагменты текста по мере генерации
+    async streamRequest(endpoint, requestData, onChunk) {
+        const url = `${this.baseURL}${endpoint}`;
+        const controller = new AbortController();
+        // Лимит простоя, а не всего потока: таймер перезапускается на каждом фрагменте
+        let timeoutId = null;
+        const resetIdleTimer = () => {
+            clearTimeout(timeoutId);
+            timeoutId = setTimeout(() => controller.abort(), this.timeout);
+        };
+        resetIdleTimer();
+
+        try {
+            const response = await fetch(url, {
+                method: 'POST',
+                headers: {
+                    'Content-Type': 'application/json',
+                    'Accept': 'text/event-stream',
+                    'X-Requested-With': 'XMLHttpRequest'
+                },
+                body: JSON.stringify(requestData),
+                signal: controller.signal
+            });
+
+            if (!response.ok) {
+                let detail = response.statusText;
+                try {
+                    detail = (await response.json()).detail || detail;
+                } catch (e) {}
+                throw new Error(`HTTP ${response.status}: ${detail}`);
+            }
+
+            const reader = response.body.getReader();
+            const decoder = new TextDecoder();
+            let buffer = '';
+            let advice = '';
+
+            while (true) {
+                const { value, done } = await reader.read();
+                if (done) break;
+                resetIdleTimer();
+                buffer += decoder.decode(value, { stream: true });
+
+                // События SSE разделены пустой строкой
+                let boundary;
+                while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+                    const rawEvent = buffer.slice(0, boundary);
+                    buffer = buffer.slice(boundary + 2);
+
+                    let event = 'message';
+                    let data = '';
+                    for (const line of rawEvent.split('\n')) {
+                        if (line.startsWith('event:')) event = line.slice(6).trim();
+                        else if (line.startsWith('data:')) data += line.slice(5).trim();
+                    }
+                    const payload = data ? JSON.parse(data) : {};
+
+                    if (event === 'chunk') {
+                        advice += payload.text;
+                        if (onChunk) onChunk(payload.text, advice);
+                    } else if (event === 'error') {
+                        throw new Error(payload.detail || 'Ошибка потоковой консультации');
+                    } else if (event === 'done') {
+                        console.log('✅ Потоковая консультация завершена:', payload);
+                        return { ...payload, advice: advice };
+                    }
+                }
+            }
+            throw new Error('Поток консультации прерван');
+        } catch (error) {
+            if (error.name === 'AbortError') {
+                throw new Error(`Timeout: нет данных от сервера дольше ${this.timeout}ms`);
+            }
+            throw error;
+        } finally {
+            clearTimeout(timeoutId);
+        }
+    }
+
+    // ⚡ Анализ с потоковой выдачей совета
+    async analyzeSingleStream(imageFile, occasion = '💼 Деловая встреча', preferences = '', userId = null, onChunk = null) {
+        if (!userId) {
+            userId = this.getCurrentUserId();
+        }
+        if (!userId || isNaN(userId)) {
+            throw new Error('Не удалось получить user_id для запроса');
+        }
+
+        try {
+            const imageData = await this.fileToBase64(imageFile);
+            return await this.streamRequest('/consultations/analyze/stream', {
+                user_id: userId,
+                occasion: occasion,
+                preferences: preferences,
+                image_data: imageData
+            }, onChunk);
+        } catch (error) {
+            console.error('❌ Ошибка потокового анализа:', error);
+            throw new Error(`Ошибка анализа: ${error.message}`);
+        }
+    }
+
+    // ⚡ Сравнение с потоковой выдачей совета
+    async analyzeCompareStream(imageFiles, occasion = '💼 Деловая встреча', preferences = '', userId = null, onChunk = null) {
+        if (!Array.isArray(imageFiles) || imageFiles.length < 2) {
+            throw new Error('Необходимо минимум 2 изображения для сравнения');
+        }
+        if (imageFiles.length > 4) {
+            throw new Error('Максимум 4 изображения для сравнения');
+        }
+        if (!userId) {
+            userId = this.getCurrentUserId();
+        }
+        if (!userId || isNaN(userId)) {
+            throw new Error('Не удалось получить user_id для сравнения');
+        }
+
+        try {
+            const imagesData = await Promise.all(
+                imageFiles.map(file => this.fileToBase64(file))
+            );
+            return await this.streamRequest('/consultations/compare/stream', {
+                user_id: userId,
+                occasion: occasion,
+                preferences: preferences,
+                images_data: imagesData
+            }, onChunk);
+        } catch (error) {
+            console.error('❌ Ошибка потокового сравнения:', error);
+            throw new Error(`Ошибка сравнения: ${error.message}`);
+        }
+    }
+
     // Вспомогательная функция для конвертации файла в base64
     async fileToBase64(file) {
         return new Promise((resolve, reject) => {
@@ -1250,15 +1250,11 @@ class MishuraApp {
         this.showLoading();
         this.triggerHapticFeedback('medium');
         
-        const timeoutPromise = new Promise((_, reject) => {
-            setTimeout(() => {
-                reject(new Error(`Превышено время ожидания (${this.requestTimeout / 1000} сек)`));
-            }, this.requestTimeout);
-        });
-        
         try {
-            const apiPromise = this.api.analyzeSingle(this.singleImage, occasion, preferences);
-            const result = await Promise.race([apiPromise, timeoutPromise]);
+            const result = await this.requestConsultation(
+                'analyzeSingle', this.singleImage, occasion, preferences,
+                `Превышено время ожидания (${this.requestTimeout / 1000} сек)`
+            );
             
             if (!result) {
                 throw new Error('Пустой ответ от API');
@@ -1307,15 +1303,11 @@ class MishuraApp {
         this.showLoading();
         this.triggerHapticFeedback('medium');
         
-        const timeoutPromise = new Promise((_, reject) => {
-            setTimeout(() => {
-                reject(new Error(`Превышено время ожидания сравнения (${this.requestTimeout / 1000} сек)`));
-            }, this.requestTimeout);
-        });
-        
         try {
-            const apiPromise = this.api.analyzeCompare(images, occasion, preferences);
-            const result = await Promise.race([apiPromise, timeoutPromise]);
+            const result = await this.requestConsultation(
+                'analyzeCompare', images, occasion, preferences,
+                `Превышено время ожидания сравнения (${this.requestTimeout / 1000} сек)`
+            );
             
             if (!result) {
                 throw new Error('Пустой ответ от API сравнения');
@@ -1344,6 +1336,52 @@ class MishuraApp {
         }
     }
 
+    // ⚡ Потоковый запрос, если API его поддерживает (у Mock API - обычный)
+    async requestConsultation(method, images, occasion, preferences, timeoutMessage) {
+        const streamMethod = this.api[`${method}Stream`];
+        if (typeof streamMethod === 'function') {
+            // Простой потока ограничивает streamRequest; общий лимит оборвал бы медленный, но живой поток
+            return streamMethod.call(this.api, images, occasion, preferences, null,
+                (text, advice) => this.showPartialAdvice(advice));
+        }
+        
+        const timeoutPromise = new Promise((_, reject) => {
+            setTimeout(() => reject(new Error(timeoutMessage)), this.requestTimeout);
+        });
+        return Promise.race([this.api[method](images, occasion, preferences), timeoutPromise]);
+    }
+
+    // ⚡ Частичный совет во время генерации (не чаще одного раза за кадр)
+    showPartialAdvice(advice) {
+        this.partialAdvice = advice;
+        if (this.partialRenderScheduled) return;
+        this.partialRenderScheduled = true;
+        
+        requestAnimationFrame(() => {
+            this.partialRenderScheduled = false;
+            // Запрос уже завершился - итоговый совет выводит showResult/showError
+            if (!this.isLoading) return;
+            
+            const sections = {
+                loading: false,
+                'consultation-form': false,
+                result: true
+            };
+            
+            Object.entries(sections).forEach(([id, show]) => {
+                const element = document.getElementById(id);
+                if (element) {
+                    element.classList.toggle('active', show);
+                }
+            });
+            
+            const content = document.getElementById('result-content');
+            if (content) {
+                content.innerHTML = this.formatAdvice(this.partialAdvice);
+            }
+        });
+    }
+
     // === СИСТЕМА УВЕДОМЛЕНИЙ ===
     
     showNotification(message, type = 'info', duration = 3000) {